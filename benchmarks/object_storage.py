@@ -0,0 +1,86 @@
+# Uploads per second with a fresh boto3 session per upload and boto3's
+# default transfer settings (the old behaviour) versus the shared
+# per-process client and TransferConfig in object_storage.
+#
+#   python -m benchmarks.object_storage                           # moto, in process
+#   python -m benchmarks.object_storage http://localhost:9000     # MinIO
+#
+# MinIO credentials are read from MINIO_ACCESS_KEY / MINIO_SECRET_KEY.
+#
+# Results against moto in process (Python 3.11, boto3 1.43, moto 4.2),
+# three runs:
+#
+#    fresh:  10.1 /  9.7 /  9.0 uploads/s (200 x 64KB, 8 threads)
+#   shared: 662.1 / 611.9 / 660.9 uploads/s (200 x 64KB, 8 threads)
+#
+# moto has no network or TLS, so this is the cost of building a session and
+# client per upload on its own; against a real endpoint the shared client
+# also saves a connection and TLS handshake per upload.
+
+import io
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from flask import Flask
+
+import src.utils.object_storage as object_storage
+
+BUCKET_NAME = 'benchmark'
+UPLOADS = 200
+THREADS = 8
+PAYLOAD = os.urandom(64 * 1024)
+
+def make_app(endpoint_url):
+    app = Flask(__name__)
+    app.config.update(
+        S3_REGION_NAME = 'us-east-1',
+        S3_USE_SSL = endpoint_url is not None and endpoint_url.startswith('https'),
+        S3_ENDPOINT_URL = endpoint_url,
+        S3_AWS_ACCESS_KEY_ID = os.getenv('MINIO_ACCESS_KEY', 'benchmark'),
+        S3_AWS_SECRET_ACCESS_KEY = os.getenv('MINIO_SECRET_KEY', 'benchmark'),
+        S3_BUCKET_NAME = BUCKET_NAME
+    )
+    return app
+
+def get_fresh_client():
+    session = boto3.session.Session()
+    return session.client(
+        service_name = 's3',
+        region_name = object_storage.get_config('S3_REGION_NAME'),
+        use_ssl = object_storage.get_config('S3_USE_SSL'),
+        endpoint_url = object_storage.get_config('S3_ENDPOINT_URL'),
+        aws_access_key_id = object_storage.get_config('S3_AWS_ACCESS_KEY_ID'),
+        aws_secret_access_key = object_storage.get_config('S3_AWS_SECRET_ACCESS_KEY')
+    )
+
+def run(app, label, get_client, get_transfer_config):
+    def upload(i):
+        with app.app_context():
+            get_client().upload_fileobj(io.BytesIO(PAYLOAD), BUCKET_NAME, f'{label}/{i}', Config = get_transfer_config())
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers = THREADS) as executor:
+        list(executor.map(upload, range(UPLOADS)))
+    elapsed = time.perf_counter() - start
+    print(f'{label:>8}: {UPLOADS / elapsed:8.1f} uploads/s ({UPLOADS} x {len(PAYLOAD) // 1024}KB, {THREADS} threads)')
+
+def main(endpoint_url):
+    app = make_app(endpoint_url)
+    with app.app_context():
+        client = object_storage.get_client()
+        if BUCKET_NAME not in [bucket['Name'] for bucket in client.list_buckets()['Buckets']]:
+            client.create_bucket(Bucket = BUCKET_NAME)
+    run(app, 'fresh', get_fresh_client, TransferConfig)
+    run(app, 'shared', object_storage.get_client, object_storage.get_transfer_config)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(sys.argv[1])
+    else:
+        from moto import mock_s3
+        with mock_s3():
+            main(None)
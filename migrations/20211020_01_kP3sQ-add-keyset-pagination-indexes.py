@@ -0,0 +1,17 @@
+"""
+add composite indexes for keyset pagination
+"""
+
+from yoyo import step
+
+__depends__ = {'20210919_01_j8sfF-add-account-session-table'}
+
+steps = [
+    step("""
+        CREATE INDEX ON post (artist_id, published_at DESC, id DESC) WHERE is_import_finished = true;
+        CREATE INDEX ON post (added_at DESC, id DESC) WHERE is_import_finished = true;
+        CREATE INDEX ON artist (last_post_imported_at DESC, id DESC) WHERE last_post_imported_at IS NOT NULL;
+        CREATE INDEX ON account_post_favorite (account_id, id);
+        CREATE INDEX ON account_artist_favorite (account_id, id);
+    """)
+]
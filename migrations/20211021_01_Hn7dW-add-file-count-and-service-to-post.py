@@ -0,0 +1,32 @@
+"""
+add file_count and service to post
+"""
+
+from yoyo import step
+
+__depends__ = {'20211020_01_kP3sQ-add-keyset-pagination-indexes'}
+__transactional__ = False
+
+BATCH_SIZE = 10000
+
+def backfill_post_file_count_and_service(conn):
+    cursor = conn.cursor()
+    cursor.execute('SELECT coalesce(max(id), 0) FROM post')
+    max_id = cursor.fetchone()[0]
+    for start in range(0, max_id + 1, BATCH_SIZE):
+        cursor.execute("""
+            UPDATE post p
+            SET
+                file_count = (SELECT count(*) FROM post_file pf WHERE pf.post_id = p.id),
+                service = a.service
+            FROM artist a
+            WHERE a.id = p.artist_id AND p.id >= %s AND p.id < %s
+        """, (start, start + BATCH_SIZE,))
+
+steps = [
+    step("""
+        ALTER TABLE post ADD COLUMN file_count int NOT NULL DEFAULT 0;
+        ALTER TABLE post ADD COLUMN service varchar(20);
+    """),
+    step(backfill_post_file_count_and_service)
+]
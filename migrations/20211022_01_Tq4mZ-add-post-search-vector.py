@@ -0,0 +1,41 @@
+"""
+add stored search_vector to post
+"""
+
+from yoyo import step
+
+__depends__ = {'20211021_01_Hn7dW-add-file-count-and-service-to-post'}
+__transactional__ = False
+
+BATCH_SIZE = 10000
+
+def backfill_post_search_vector(conn):
+    cursor = conn.cursor()
+    cursor.execute('SELECT coalesce(max(id), 0) FROM post')
+    max_id = cursor.fetchone()[0]
+    for start in range(0, max_id + 1, BATCH_SIZE):
+        cursor.execute("""
+            UPDATE post
+            SET search_vector = to_tsvector('english', content || ' ' || title)
+            WHERE id >= %s AND id < %s
+        """, (start, start + BATCH_SIZE,))
+
+steps = [
+    step("""
+        ALTER TABLE post ADD COLUMN search_vector tsvector;
+
+        CREATE FUNCTION post_search_vector_update() RETURNS trigger AS $$
+        BEGIN
+            NEW.search_vector := to_tsvector('english', NEW.content || ' ' || NEW.title);
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER post_search_vector_update
+            BEFORE INSERT OR UPDATE OF title, content ON post
+            FOR EACH ROW EXECUTE PROCEDURE post_search_vector_update();
+    """),
+    step(backfill_post_search_vector),
+    step('CREATE INDEX CONCURRENTLY ON post USING GIN (search_vector)'),
+    step('DROP INDEX IF EXISTS post_to_tsvector_idx')
+]
@@ -0,0 +1,15 @@
+"""
+add trigram indexes for artist search
+"""
+
+from yoyo import step
+
+__depends__ = {'20211022_01_Tq4mZ-add-post-search-vector'}
+__transactional__ = False
+
+steps = [
+    step('CREATE EXTENSION IF NOT EXISTS pg_trgm'),
+    step('CREATE INDEX CONCURRENTLY ON artist USING GIN (display_name gin_trgm_ops)'),
+    step('CREATE INDEX CONCURRENTLY ON artist USING GIN (username gin_trgm_ops)'),
+    step('CREATE INDEX CONCURRENTLY ON artist (service, last_post_imported_at DESC) WHERE last_post_imported_at IS NOT NULL')
+]
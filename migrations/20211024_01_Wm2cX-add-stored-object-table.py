@@ -0,0 +1,59 @@
+"""
+add stored_object table for content-addressed post files
+"""
+
+from yoyo import step
+
+__depends__ = {'20211023_01_Rb8vE-add-artist-trigram-indexes'}
+__transactional__ = False
+
+BATCH_SIZE = 10000
+
+def backfill_stored_objects(conn):
+    cursor = conn.cursor()
+    cursor.execute('SELECT coalesce(max(id), 0) FROM post_file')
+    max_id = cursor.fetchone()[0]
+    for start in range(0, max_id + 1, BATCH_SIZE):
+        cursor.execute("""
+            INSERT INTO stored_object (sha256_hash, path, preview_path, bucket_name, refcount)
+            SELECT DISTINCT ON (sha256_hash) sha256_hash, path, preview_path, bucket_name, 0
+            FROM post_file
+            WHERE id >= %s AND id < %s AND is_upload_finished = true AND path IS NOT NULL AND bucket_name IS NOT NULL
+            ORDER BY sha256_hash, id
+            ON CONFLICT (sha256_hash) DO NOTHING
+        """, (start, start + BATCH_SIZE,))
+        cursor.execute("""
+            WITH linked AS (
+                UPDATE post_file pf
+                SET stored_object_id = so.id
+                FROM stored_object so
+                WHERE
+                    pf.id >= %s AND pf.id < %s
+                    AND so.sha256_hash = pf.sha256_hash
+                    AND so.path = pf.path
+                    AND so.bucket_name = pf.bucket_name
+                RETURNING so.id
+            )
+            UPDATE stored_object so
+            SET refcount = so.refcount + linked.count
+            FROM (SELECT id, count(*) count FROM linked GROUP BY id) linked
+            WHERE so.id = linked.id
+        """, (start, start + BATCH_SIZE,))
+
+steps = [
+    step("""
+        CREATE TABLE stored_object (
+            id serial primary key,
+            sha256_hash char(64) not null,
+            path varchar not null,
+            preview_path varchar,
+            bucket_name varchar not null,
+            refcount int not null default 0,
+            created_at timestamp not null default (now() at time zone 'utc'),
+            UNIQUE (sha256_hash)
+        );
+        ALTER TABLE post_file ADD COLUMN stored_object_id int REFERENCES stored_object(id);
+        CREATE INDEX ON post_file (stored_object_id);
+    """),
+    step(backfill_stored_objects)
+]
@@ -0,0 +1,21 @@
+"""
+add object_deletion_queue table
+"""
+
+from yoyo import step
+
+__depends__ = {'20211024_01_Wm2cX-add-stored-object-table'}
+
+steps = [
+    step("""
+        CREATE TABLE object_deletion_queue (
+            id serial primary key,
+            bucket_name varchar(63) not null,
+            path varchar not null,
+            attempts int not null default 0,
+            queued_at timestamp not null default (now() at time zone 'utc'),
+            UNIQUE (bucket_name, path)
+        );
+        CREATE INDEX ON object_deletion_queue (queued_at);
+    """)
+]
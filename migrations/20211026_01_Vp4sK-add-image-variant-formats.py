@@ -0,0 +1,15 @@
+"""
+add image variant formats to post, post_file and stored_object
+"""
+
+from yoyo import step
+
+__depends__ = {'20211025_01_Jc5tN-add-object-deletion-queue'}
+
+steps = [
+    step("""
+        ALTER TABLE post ADD COLUMN thumbnail_formats varchar(8)[] not null default '{}';
+        ALTER TABLE post_file ADD COLUMN preview_formats varchar(8)[] not null default '{}';
+        ALTER TABLE stored_object ADD COLUMN preview_formats varchar(8)[] not null default '{}';
+    """)
+]
@@ -0,0 +1,16 @@
+"""
+add job leases to ongoing_import
+"""
+
+from yoyo import step
+
+__depends__ = {'20211026_01_Vp4sK-add-image-variant-formats'}
+
+steps = [
+    step("""
+        ALTER TABLE ongoing_import ADD COLUMN leased_by varchar(255);
+        ALTER TABLE ongoing_import ADD COLUMN leased_until timestamp;
+        ALTER TABLE ongoing_import ADD COLUMN attempts int not null default 0;
+        CREATE INDEX ON ongoing_import (service, leased_until);
+    """)
+]
@@ -0,0 +1,30 @@
+"""
+add import_post_job table and import phases
+"""
+
+from yoyo import step
+
+__depends__ = {'20211027_01_Qd8rL-add-import-job-leases'}
+
+steps = [
+    step("""
+        ALTER TABLE ongoing_import ADD COLUMN status varchar(20) not null default 'enumerating';
+        ALTER TABLE ongoing_import ADD COLUMN import_state jsonb;
+
+        CREATE TABLE import_post_job (
+            id serial primary key,
+            ongoing_import_id int not null references ongoing_import(id) ON DELETE CASCADE,
+            service varchar(20) not null,
+            post_service_id varchar(255) not null,
+            data jsonb not null,
+            artist_id int,
+            leased_by varchar(255),
+            leased_until timestamp,
+            attempts int not null default 0,
+            finished_at timestamp,
+            UNIQUE (ongoing_import_id, post_service_id)
+        );
+        CREATE INDEX ON import_post_job (id) WHERE finished_at IS NULL;
+        CREATE INDEX ON import_post_job (service, leased_until);
+    """)
+]
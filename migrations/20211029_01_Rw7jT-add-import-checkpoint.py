@@ -0,0 +1,13 @@
+"""
+add checkpoint to ongoing_import
+"""
+
+from yoyo import step
+
+__depends__ = {'20211028_01_Xk2hN-add-import-post-jobs'}
+
+steps = [
+    step("""
+        ALTER TABLE ongoing_import ADD COLUMN checkpoint jsonb;
+    """)
+]
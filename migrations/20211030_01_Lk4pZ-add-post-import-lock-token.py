@@ -0,0 +1,13 @@
+"""
+add owner token to post_import_lock
+"""
+
+from yoyo import step
+
+__depends__ = {'20211029_01_Rw7jT-add-import-checkpoint'}
+
+steps = [
+    step("""
+        ALTER TABLE post_import_lock ADD COLUMN token varchar(36);
+    """)
+]
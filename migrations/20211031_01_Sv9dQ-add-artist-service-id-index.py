@@ -0,0 +1,12 @@
+"""
+add artist service_id index for artist search
+"""
+
+from yoyo import step
+
+__depends__ = {'20211030_01_Lk4pZ-add-post-import-lock-token'}
+__transactional__ = False
+
+steps = [
+    step('CREATE INDEX CONCURRENTLY ON artist (service_id)')
+]
@@ -1,10 +1,11 @@
 from flask import Blueprint, request, make_response, render_template, session, redirect, url_for, g, flash
 
+import json
 import re
 
-from ...utils.utils import make_template, count_to_pages, get_offset_from_url_query, get_value
+from ...utils.utils import make_template, count_to_pages, get_offset_from_url_query, get_page_cursor_from_url_query, get_next_page_cursor, get_value
 from ...internals.database.database import get_cursor
-from ...lib.artist import get_artist, get_artist_post_count, get_top_artists_by_faves, get_count_of_artists_faved, get_top_artists_by_recent_faves, get_count_of_artists_recently_faved, get_artist_search_results, get_recently_indexed_artists, get_artist_count, delete_artist, add_artist_to_dnp_list
+from ...lib.artist import get_artist, get_artist_post_count, get_top_artists_by_faves, get_count_of_artists_faved, get_top_artists_by_recent_faves, get_count_of_artists_recently_faved, get_artist_search_results, get_artist_autocomplete_results, get_recently_indexed_artists, get_artist_count, delete_artist, add_artist_to_dnp_list
 from ...lib.post import get_artist_posts_for_listing, is_post_flagged, get_artist_post_search_results
 from ...lib.favorites import is_artist_favorited
 from ...lib.account import load_account, is_admin
@@ -32,6 +33,20 @@ def get_list():
 
     return make_template('artist_list_search.html', 200)
 
+@artists.route('/api/artists/autocomplete')
+def get_autocomplete():
+    prefix = get_value(request.args, 'q', '').strip().lower()[:50]
+    results = []
+    if len(prefix) >= 2:
+        results = [
+            { 'id': artist['id'], 'service': artist['service'], 'name': artist['display_name'] }
+            for artist in get_artist_autocomplete_results(prefix)
+        ]
+    response = make_response(json.dumps(results), 200)
+    response.mimetype = 'application/json'
+    response.headers['Cache-Control'] = 'max-age=300'
+    return response
+
 @artists.route('/artists/popular')
 def get_popular():
     offset = get_offset_from_url_query()
@@ -55,9 +70,12 @@ def get_trending():
 @artists.route('/artists/recent')
 def get_recent():
     offset = get_offset_from_url_query()
+    page_cursor = get_page_cursor_from_url_query()
 
+    results = get_recently_indexed_artists(offset, 25, page_cursor)
     g.data['display'] = 'recently added artists'
-    g.data['results'] = get_recently_indexed_artists(offset, 25)
+    g.data['results'] = results
+    g.data['next_cursor'] = get_next_page_cursor(results, 'last_post_imported_at', 'id')
     g.data['max_pages'] = count_to_pages(get_artist_count())
 
     return make_template('artist_list_search.html', 200)
@@ -65,6 +83,7 @@ def get_recent():
 @artists.route('/artists/<service>/<artist_id>')
 def get(service, artist_id):
     offset = get_offset_from_url_query()
+    page_cursor = get_page_cursor_from_url_query()
     query = request.args.get('query')
 
     artist = get_artist(artist_id)
@@ -82,7 +101,8 @@ def get(service, artist_id):
 
     (posts, total_count) = ([], 0)
     if query is None:
-        (posts, total_count) = get_artist_post_page(artist_id, offset)
+        (posts, total_count) = get_artist_post_page(artist_id, offset, page_cursor)
+        g.data['next_cursor'] = get_next_page_cursor(posts, 'published_at', 'id')
     else:
         (posts, total_count) = get_artist_post_search_results(query, artist_id, offset)
 
@@ -108,8 +128,8 @@ def delete(artist_id):
     flash(f'Starting deletion of artist {artist_id}. If the artist has a lot of posts, it may take a while to delete them.')
     return redirect(url_for('artists.get_list'))
 
-def get_artist_post_page(artist_id, offset):
-    posts = get_artist_posts_for_listing(artist_id, offset, 'published desc')
+def get_artist_post_page(artist_id, offset, page_cursor = None):
+    posts = get_artist_posts_for_listing(artist_id, offset, page_cursor)
     total_count = get_artist_post_count(artist_id)
     return (posts, total_count)
 
@@ -8,7 +8,7 @@ from ...lib.post import get_post, is_post_flagged, get_next_post_id, get_previou
 from ...lib.artist import get_artist
 from ...lib.favorites import is_post_favorited
 from ...lib.account import load_account, is_admin
-from ...utils.utils import make_template, cdn, count_to_pages, parse_int, page_to_offset, get_offset_from_url_query, has_preview, get_value
+from ...utils.utils import make_template, cdn, count_to_pages, parse_int, page_to_offset, get_offset_from_url_query, get_page_cursor_from_url_query, get_next_page_cursor, has_preview, get_picture_sources, get_value
 
 post = Blueprint('post', __name__)
 
@@ -60,7 +60,9 @@ def get(service, artist_id, post_id):
 @post.route('/post/recent')
 def get_recent():
     offset = get_offset_from_url_query()
-    g.data['results'] = get_recent_posts_for_listing(offset)
+    results = get_recent_posts_for_listing(offset, get_page_cursor_from_url_query())
+    g.data['results'] = results
+    g.data['next_cursor'] = get_next_page_cursor(results, 'added_at', 'id')
     g.data['max_pages'] = count_to_pages(get_total_post_count())
 
     return make_template('posts.html', 200)
@@ -170,7 +172,8 @@ def inject_inline_images(content, files):
             inline_content = get_value(file, 'inline_content')
             injected_content = '';
             if has_preview(file):
-                injected_content = f'<a href="{cdn(file["path"], file["bucket_name"])}"><img src="{cdn(file["preview_path"], file["bucket_name"])}"/></a>'
+                sources = ''.join(f'<source srcset="{url}" type="{mime_type}"/>' for (url, mime_type) in get_picture_sources(file['preview_path'], file['bucket_name'], get_value(file, 'preview_formats')))
+                injected_content = f'<a href="{cdn(file["path"], file["bucket_name"])}"><picture>{sources}<img src="{cdn(file["preview_path"], file["bucket_name"])}"/></picture></a>'
             elif inline_content is not None:
                 injected_content = f'<a href="{cdn(file["path"], file["bucket_name"])}">{inline_content}</a>'
             else:
@@ -0,0 +1,31 @@
+import logging
+from flask import Flask
+
+import src.internals.database.database as database
+import src.internals.cache.redis as redis
+from src.utils.utils import get_config
+from src.utils.download import initialize_temp_download_directory
+from src.lib.importer import run_import_worker
+
+# Imports run here instead of in the uWSGI workers:
+#
+#   python3 -m src.import_worker
+#
+# Any number of these can run, on any number of hosts; they share the
+# `ongoing_import` queue.
+app = Flask(__name__)
+app.config.from_pyfile('../config.py')
+
+logging.getLogger('PIL').setLevel(logging.INFO)
+logging.getLogger('requests').setLevel(logging.INFO)
+logging.getLogger('urllib3').setLevel(logging.INFO)
+logging.getLogger('botocore').setLevel(logging.INFO)
+logging.getLogger('s3transfer').setLevel(logging.INFO)
+
+if __name__ == '__main__':
+    with app.app_context():
+        logging.basicConfig(filename=get_config('IMPORT_WORKER_LOG_LOCATION', get_config('LOG_LOCATION')), level=logging.DEBUG)
+        database.init()
+        redis.init()
+        initialize_temp_download_directory()
+        run_import_worker()
@@ -1,6 +1,3 @@
-import sys
-sys.setrecursionlimit(100000)
-
 import requests
 import config
 import json
@@ -12,15 +9,16 @@ from bs4 import BeautifulSoup
 from flask import current_app
 
 from ...lib.artist import is_artist_dnp, get_artist_id_from_service_data, create_artist_entry, reattempt_failed_artist_metadata_imports, finalize_artist_import, get_artist, get_artist_display_name
-from ...lib.post import remove_post_if_flagged_for_reimport, get_post_id_from_service_data, insert_post, is_post_import_finished, finalize_post_import, set_and_upload_post_thumbnail_if_needed, set_post_content, update_post, is_post_dnp, insert_extra_post_content, is_flagged_for_reimport, get_all_processed_sub_ids, mark_sub_id_processed, remove_content_with_sub_id, set_post_import_not_finished, insert_post_embed
+from ...lib.post import remove_post_if_flagged_for_reimport, get_post_id_from_service_data, insert_post, is_post_import_finished, finalize_post_import, set_and_upload_post_thumbnail_if_needed, set_post_content, update_post, is_post_dnp, insert_extra_post_content, is_flagged_for_reimport, get_all_processed_sub_ids, mark_sub_id_processed, remove_content_with_sub_id, set_post_import_not_finished, insert_post_embed, get_post_import_statuses
 from ...lib.account import mark_account_as_subscribed_to_artists, get_account_stats
 from ...lib.file import insert_and_upload_post_file
 from ...lib.auto_importer import decrease_session_retries_remaining
 from ...utils.proxy import get_proxy
-from ...utils.download import fetch_file_and_data, remove_temp_files
+from ...utils.download import fetch_files_and_data, remove_temp_files
 from ...utils.utils import get_import_id, date_to_utc, do_with_retries, replace_many, get_value, filter_urls, create_scrapper_session, get_multi_level_value, any_not_in
 from ...utils.logger import log
-from ...utils.import_lock import take_lock, release_lock
+from ...utils.import_lock import take_lock, release_lock, PostLocked
+from ...utils.import_checkpoint import get_walker_checkpoint
 
 # In the future, if the timeline API proves itself to be unreliable, we should probably move to scanning fanclubs individually.
 # https://fantia.jp/api/v1/me/fanclubs',
@@ -77,181 +75,211 @@ def disable_adult_mode(import_id, jar):
         }
     ).raise_for_status()
 
-def import_fanclub(import_id, fanclub_id, account_id, jar):
+def get_jar(key):
+    jar = requests.cookies.RequestsCookieJar()
+    jar.set('_session_id', key)
+    return jar
+
+def import_fanclub(import_id, fanclub_id, jar, queue_posts, page_number = 1):
     log(import_id, f'Importing fanclub {fanclub_id}')
+    walker = f'fanclub {fanclub_id}'
     user_id = str(fanclub_id)
+    for (post_ids, next_page_number) in get_post_ids_for_fanclub(import_id, fanclub_id, jar, page_number):
+        # Whether a post is finished depends on which of its contents are
+        # visible now, which only the post itself tells, so only DNP posts
+        # are settled for the whole page here.
+        statuses = get_post_import_statuses('fantia', [(user_id, post_id) for post_id in post_ids])
+        posts = []
+        for post_id in post_ids:
+            status = statuses[(user_id, post_id)]
+            if status['is_post_dnp']:
+                log(import_id, f'Post {post_id} from artist {user_id} is in do not post list. Skipping.')
+            elif status['is_artist_dnp']:
+                log(import_id, f'Artist {user_id} is in do not post list. Skipping post {post_id}')
+            else:
+                posts.append((post_id, { 'fanclub_id': fanclub_id, 'post_id': post_id }))
+        queue_posts(posts, walker, next_page_number)
+
+def import_post(import_id, key, data):
+    jar = get_jar(key)
+    user_id = str(data['fanclub_id'])
+    post_id = data['post_id']
+    resource_id = None
+    import_lock_id = None
+    internal_post_id = None
     artist_id = None
-    
-    for post_id in get_post_ids_for_fanclub(import_id, fanclub_id, jar):
-        resource_id = None
-        import_lock_id = None
-        internal_post_id = None
+    try:
+        if is_post_dnp('fantia', user_id, post_id):
+            log(import_id, f'Post {post_id} from artist {user_id} is in do not post list. Skipping.')
+            return None
 
-        try:
-            if is_post_dnp('fantia', user_id, post_id):
-                log(import_id, f'Post {post_id} from artist {user_id} is in do not post list. Skipping.')
-                continue
+        if is_artist_dnp('fantia', user_id):
+            log(import_id, f'Artist {user_id} is in do not post list. Skipping post {post_id}')
+            return None
 
-            if is_artist_dnp('fantia', user_id):
-                log(import_id, f'Artist {user_id} is in do not post list. Skipping post {post_id}')
-                continue
+        import_lock_id = take_lock('fantia', user_id, post_id)
+        if import_lock_id is None:
+            log(import_id, f'Post {post_id} from artist {user_id} is being imported by someone else right now. It will be retried later')
+            raise PostLocked(post_id)
 
-            import_lock_id = take_lock('fantia', user_id, post_id)
-            if import_lock_id is None:
-                log(import_id, f'Skipping post {post_id} from artist {user_id} because it is being imported by someone else right now')
-                continue
+        try:
+            post_scraper = create_scrapper_session(useCloudscraper = False).get(
+                f'https://fantia.jp/api/v1/posts/{post_id}',
+                cookies = jar,
+                proxies = get_proxy()
+            )
+            post_json = post_scraper.json()
+            post_scraper.raise_for_status()
+        except requests.HTTPError as exc:
+            log(import_id, f'Error contacting Fantia API for post {post_id}', 'exception')
+            return None
+
+        any_visible = False
+        any_paid_visible = False
+        visible_content_ids = []
+        for content in get_multi_level_value(post_json, 'post', 'post_contents', default = []):
+            content_id = get_value(content, 'id')
+            visible_status = get_value(content, 'visible_status')
+            plan_price = get_multi_level_value(content, 'plan', 'price', default = 0)
+            if visible_status == 'visible':
+                any_visible = True
+                visible_content_ids.append(str(content_id))
+            if visible_status == 'visible' and plan_price > 0:
+                any_paid_visible = True
+        if not any_visible:
+            log(import_id, f'No content from post {post_id} by artist {user_id} is visible. Skipping')
+            return None
+        if not any_paid_visible:
+            log(import_id, f'Skipping post {post_id} from artist {user_id} because no paid content is visible', to_client = False)
+            return None
+
+        is_reimport = is_flagged_for_reimport('fantia', user_id, post_id)
+        processed_content_ids = get_all_processed_sub_ids('fantia', user_id, post_id)
+        if not any_not_in(visible_content_ids, processed_content_ids) and not is_reimport:
+            log(import_id, f'Skipping post {post_id} from artist {user_id} because it was already imported')
+            return None
+
+        artist_id = get_artist_id_from_service_data('fantia', user_id)
+        if artist_id is None:
+            display_name = get_artist_display_name('fantia', user_id)
+            artist_id = create_artist_entry('fantia', user_id, display_name)
+        reattempt_failed_artist_metadata_imports('fantia', user_id, artist_id)
+
+        post_data = {
+            'service': 'fantia',
+            'service_artist_id': user_id,
+            'service_id': post_id,
+            'artist_id': artist_id,
+            'title': post_json['post']['title'],
+            'content': post_json['post']['comment'] or '',
+            'is_manual_upload': False,
+            'added_at': datetime.datetime.utcnow(),
+            'published_at': post_json['post']['posted_at'],
+            'updated_at': None,
+            'import_succeeded': False
+        }
 
-            try:
-                post_scraper = create_scrapper_session(useCloudscraper = False).get(
-                    f'https://fantia.jp/api/v1/posts/{post_id}',
-                    cookies = jar,
-                    proxies = get_proxy()
-                )
-                post_json = post_scraper.json()
-                post_scraper.raise_for_status()
-            except requests.HTTPError as exc:
-                log(import_id, f'Error contacting Fantia API for post {post_id}', 'exception')
-                continue
 
-            any_visible = False
-            any_paid_visible = False
-            visible_content_ids = []
-            for content in get_multi_level_value(post_json, 'post', 'post_contents', default = []):
-                content_id = get_value(content, 'id')
-                visible_status = get_value(content, 'visible_status')
-                plan_price = get_multi_level_value(content, 'plan', 'price', default = 0)
-                if visible_status == 'visible':
-                    any_visible = True
-                    visible_content_ids.append(str(content_id))
-                if visible_status == 'visible' and plan_price > 0:
-                    any_paid_visible = True
-            if not any_visible:
-                log(import_id, f'No content from post {post_id} by artist {user_id} is visible. Skipping')
-                continue
-            if not any_paid_visible:
-                log(import_id, f'Skipping post {post_id} from artist {user_id} because no paid content is visible', to_client = False)
-                continue
+        if is_reimport:
+            log(import_id, f'Post {post_id} from artist {user_id} was flagged for reimport. Reimporting')
+            internal_post_id = get_post_id_from_service_data('fantia', user_id, post_id)
+            update_post(post_data, internal_post_id)
+            set_post_import_not_finished(internal_post_id, artist_id)
+        else:
+            log(import_id, f'Importing post {post_id} from artist {user_id}')
+            internal_post_id = insert_post(post_data)
 
-            is_reimport = is_flagged_for_reimport('fantia', user_id, post_id)
-            processed_content_ids = get_all_processed_sub_ids('fantia', user_id, post_id)
-            if not any_not_in(visible_content_ids, processed_content_ids) and not is_reimport:
-                log(import_id, f'Skipping post {post_id} from artist {user_id} because it was already imported')
-                continue
+        resource_id = f'post{internal_post_id}'
 
-            artist_id = get_artist_id_from_service_data('fantia', user_id)
-            if artist_id is None:
-                display_name = get_artist_display_name('fantia', user_id)
-                artist_id = create_artist_entry('fantia', user_id, display_name)
-            reattempt_failed_artist_metadata_imports('fantia', user_id, artist_id)
-
-            post_data = {
-                'service': 'fantia',
-                'service_artist_id': user_id,
-                'service_id': post_id,
-                'artist_id': artist_id,
-                'title': post_json['post']['title'],
-                'content': post_json['post']['comment'] or '',
-                'is_manual_upload': False,
-                'added_at': datetime.datetime.utcnow(),
-                'published_at': post_json['post']['posted_at'],
-                'updated_at': None,
-                'import_succeeded': False
-            }
+        downloads = []
+        if get_multi_level_value(post_json, 'post', 'thumb') is not None:
+            downloads.append({ 'url': post_json['post']['thumb']['original'], 'kwargs': { 'cookies': jar }, 'thumbnail_only': True })
 
+        pending_downloads = {}
+        for content in get_multi_level_value(post_json, 'post', 'post_contents', default = []):
+            sub_id = str(get_value(content, 'id'))
+
+            if get_value(content, 'visible_status') != 'visible':
+                continue
 
             if is_reimport:
-                log(import_id, f'Post {post_id} from artist {user_id} was flagged for reimport. Reimporting')
-                internal_post_id = get_post_id_from_service_data('fantia', user_id, post_id)
-                update_post(post_data, internal_post_id)
-                set_post_import_not_finished(internal_post_id, artist_id)
+                remove_content_with_sub_id(internal_post_id, sub_id)
+
+            content_downloads = []
+            if get_value(content, 'category') == 'photo_gallery':
+                for photo in get_value(content, 'post_content_photos', []):
+                    content_downloads.append({ 'url': photo['url']['original'], 'comment': get_value(photo, 'comment') })
+            elif get_value(content, 'category') == 'file':
+                content_downloads.append({ 'url': urljoin('https://fantia.jp/posts', content['download_uri']), 'name': get_value(content, 'filename') })
+            elif get_value(content, 'category') == 'embed':
+                embed = {
+                    'url': content['embed_url'],
+                    'subject': '(embedded link)',
+                    'description': '',
+                    'sub_id': sub_id
+                }
+                insert_post_embed(internal_post_id, embed)
+            elif get_value(content, 'category') == 'blog':
+                for op in get_value(json.loads(get_value(content, 'comment', '{}')), 'ops', []):
+                    if get_multi_level_value(op, 'insert', 'fantiaImage'):
+                        content_downloads.append({ 'url': urljoin('https://fantia.jp/', op['insert']['fantiaImage']['original_url']) })
+            elif get_value(content, 'category') == 'text':
+                comment = get_value(content, 'comment')
+                if comment is not None:
+                    title = get_value(content, 'title')
+                    insert_extra_post_content(internal_post_id, comment, title, sub_id)
             else:
-                log(import_id, f'Importing post {post_id} from artist {user_id}')
-                internal_post_id = insert_post(post_data)
+                log(import_id, f'Skipping content {content["id"]} from post {post_id}; unsupported type: {content["category"]}')
+                log(import_id, json.dumps(content), to_client = False)
+
+            if len(content_downloads) == 0:
+                mark_sub_id_processed(internal_post_id, sub_id)
+                continue
 
-            resource_id = f'post{internal_post_id}'
+            pending_downloads[sub_id] = len(content_downloads)
+            for download in content_downloads:
+                download['kwargs'] = { 'cookies': jar }
+                download['sub_id'] = sub_id
+                downloads.append(download)
 
-            if get_multi_level_value(post_json, 'post', 'thumb') is not None:
-                file_data = fetch_file_and_data(post_json['post']['thumb']['original'], cookies = jar, resource_id = resource_id)
-                file_data['post_id'] = internal_post_id
-                file_data['service'] = 'fantia'
+        for (download, file_data) in zip(downloads, fetch_files_and_data(downloads, resource_id)):
+            file_data['post_id'] = internal_post_id
+            file_data['service'] = 'fantia'
+            if get_value(download, 'thumbnail_only'):
                 set_and_upload_post_thumbnail_if_needed(file_data)
+                continue
+
+            sub_id = download['sub_id']
+            file_data['name'] = get_value(download, 'name') or file_data['name']
+            file_data['path'] = f'files/fantia/{internal_post_id}/{file_data["name"]}'
+            file_data['sub_id'] = sub_id
+            if 'comment' in download:
+                file_data['comment'] = download['comment']
+
+            set_and_upload_post_thumbnail_if_needed(file_data)
+            insert_and_upload_post_file(file_data)
 
-            for content in get_multi_level_value(post_json, 'post', 'post_contents', default = []):
-                sub_id = str(get_value(content, 'id'))
-
-                if get_value(content, 'visible_status') != 'visible':
-                    continue
-
-                if is_reimport:
-                    remove_content_with_sub_id(internal_post_id, sub_id)
-
-                if get_value(content, 'category') == 'photo_gallery':
-                    for photo in get_value(content, 'post_content_photos', []):
-                        file_data = fetch_file_and_data(photo['url']['original'], cookies = jar, resource_id = resource_id)
-                        file_data['path'] = f'files/fantia/{internal_post_id}/{file_data["name"]}'
-                        file_data['post_id'] = internal_post_id
-                        file_data['service'] = 'fantia'
-                        file_data['comment'] = get_value(photo, 'comment')
-                        file_data['sub_id'] = sub_id
-                        set_and_upload_post_thumbnail_if_needed(file_data)
-                        insert_and_upload_post_file(file_data)
-                elif get_value(content, 'category') == 'file':
-                    file_data = fetch_file_and_data(urljoin('https://fantia.jp/posts', content['download_uri']), cookies = jar, resource_id = resource_id)
-                    file_data['name'] = get_value(content, 'filename') or file_data['name']
-                    file_data['path'] = f'files/fantia/{internal_post_id}/{file_data["name"]}'
-                    file_data['post_id'] = internal_post_id
-                    file_data['service'] = 'fantia'
-                    file_data['sub_id'] = sub_id
-
-                    set_and_upload_post_thumbnail_if_needed(file_data)
-                    insert_and_upload_post_file(file_data)
-                elif get_value(content, 'category') == 'embed':
-                    embed = {
-                        'url': content['embed_url'],
-                        'subject': '(embedded link)',
-                        'description': '',
-                        'sub_id': sub_id
-                    }
-                    insert_post_embed(internal_post_id, embed)
-                elif get_value(content, 'category') == 'blog':
-                    for op in get_value(json.loads(get_value(content, 'comment', '{}')), 'ops', []):
-                        if get_multi_level_value(op, 'insert', 'fantiaImage'):
-                            file_data = fetch_file_and_data(urljoin('https://fantia.jp/', op['insert']['fantiaImage']['original_url']), cookies = jar, resource_id = resource_id)
-                            file_data['path'] = f'files/fantia/{internal_post_id}/{file_data["name"]}'
-                            file_data['post_id'] = internal_post_id
-                            file_data['service'] = 'fantia'
-                            file_data['sub_id'] = sub_id
-                            set_and_upload_post_thumbnail_if_needed(file_data)
-                            insert_and_upload_post_file(file_data)
-                elif get_value(content, 'category') == 'text':
-                    comment = get_value(content, 'comment')
-                    if comment is not None:
-                        title = get_value(content, 'title')
-                        insert_extra_post_content(internal_post_id, comment, title, sub_id)
-                else:
-                    log(import_id, f'Skipping content {content["id"]} from post {post_id}; unsupported type: {content["category"]}')
-                    log(import_id, json.dumps(content), to_client = False)
-            
+            pending_downloads[sub_id] -= 1
+            if pending_downloads[sub_id] == 0:
                 mark_sub_id_processed(internal_post_id, sub_id)
-            finalize_post_import(internal_post_id, artist_id)
+        finalize_post_import(internal_post_id, artist_id)
 
-            log(import_id, f'Finished importing {post_id} for artist {user_id}', to_client = False)
-        except Exception:
-            log(import_id, f'Error importing post {post_id} from artist {user_id}', 'exception')
-            continue
-        finally:
-            if import_lock_id is not None:
-                release_lock(import_lock_id)
-            if resource_id is not None:
-                remove_temp_files(resource_id)
+        log(import_id, f'Finished importing {post_id} for artist {user_id}', to_client = False)
+    except PostLocked:
+        raise
+    except Exception:
+        log(import_id, f'Error importing post {post_id} from artist {user_id}', 'exception')
+    finally:
+        if import_lock_id is not None:
+            release_lock(import_lock_id)
+        if resource_id is not None:
+            remove_temp_files(resource_id)
 
-    if artist_id is not None:
-        finalize_artist_import(artist_id)
+    return artist_id
+
+def import_posts(import_id, key, account_id, queue_posts, checkpoints = None, state = None):
+    jar = get_jar(key)
 
-def import_posts(import_id, key, account_id):
-    jar = requests.cookies.RequestsCookieJar()
-    jar.set('_session_id', key)
-    
     (unauthorized, mode_switched) = enable_adult_mode(import_id, jar)
     if unauthorized:
         if account_id is not None:
@@ -259,27 +287,43 @@ def import_posts(import_id, key, account_id):
         log(import_id, 'Invalid key. No posts will be imported')
         return
 
+    # Adult mode has to stay on until every queued post has been fetched, so
+    # switching it back is left to `finish_import`, even if the walk fails.
+    # Whether this import switched it on is saved before walking: a restarted
+    # walk finds it already on and must not forget to switch it back.
+    paid_fanclubs = sorted(get_paid_fanclubs(import_id, jar))
+    state['mode_switched'] = get_value(state, 'mode_switched', False) or mode_switched
+    state['fanclub_ids'] = sorted(set(get_value(state, 'fanclub_ids', [])) | set(paid_fanclubs))
+    queue_posts([])
+
+    for fanclub_id in paid_fanclubs:
+        page_number = get_walker_checkpoint(import_id, checkpoints, f'fanclub {fanclub_id}', 1)
+        if page_number is not None:
+            import_fanclub(import_id, fanclub_id, jar, queue_posts, page_number)
+
+def finish_import(import_id, key, account_id, artist_ids, state):
+    jar = get_jar(key)
     try:
-        paid_fanclubs = get_paid_fanclubs(import_id, jar)
-        artist_ids = []
-        for fanclub_id in paid_fanclubs:
-            import_fanclub(import_id, fanclub_id, account_id, jar)
-            artist_ids.append(get_artist_id_from_service_data('fantia', fanclub_id))
+        for artist_id in artist_ids:
+            finalize_artist_import(artist_id)
+
+        subscribed_artist_ids = set(artist_ids)
+        for fanclub_id in get_value(state, 'fanclub_ids', []):
+            artist_id = get_artist_id_from_service_data('fantia', fanclub_id)
+            if artist_id is not None:
+                subscribed_artist_ids.add(artist_id)
+        if account_id is not None:
+            mark_account_as_subscribed_to_artists(account_id, subscribed_artist_ids, 'fantia')
+
+        if len(get_value(state, 'fanclub_ids', [])) > 0:
+            log(import_id, 'Finished scanning for posts')
+        else:
+            log(import_id, f'Finished scanning for posts. No posts detected')
     finally:
-        if mode_switched:
+        if get_value(state, 'mode_switched'):
             disable_adult_mode(import_id, jar)
 
-    if account_id is not None:
-        mark_account_as_subscribed_to_artists(account_id, artist_ids, 'fantia')
-        get_account_stats(account_id, True)
-
-    if len(paid_fanclubs) > 0:
-        log(import_id, 'Finished scanning for posts')
-    else:
-        log(import_id, f'Finished scanning for posts. No posts detected')
-
-def get_post_ids_for_fanclub(import_id, fanclub_id, jar):
-    page_number = 1
+def get_post_ids_for_fanclub(import_id, fanclub_id, jar, page_number = 1):
     while True:
         list_scraper = create_scrapper_session(useCloudscraper = False).get(
             f'https://fantia.jp/fanclubs/{fanclub_id}/posts?page={page_number}',
@@ -292,15 +336,17 @@ def get_post_ids_for_fanclub(import_id, fanclub_id, jar):
         response_page = BeautifulSoup(list_data, 'html.parser')
         posts = response_page.select('div.post')
 
-        post_count = 0
+        post_ids = []
         for post in posts:
             link = post.select_one('a.link-block')['href']
-            post_id = link.lstrip('/posts/')
-            post_count += 1
-            yield post_id
+            post_ids.append(link.lstrip('/posts/'))
 
-        if post_count == 0:
+        # The last page isn't known until an empty one comes back, so that
+        # empty page is the one that marks the fanclub as finished.
+        if len(post_ids) == 0:
+            yield ([], None)
             return
+        yield (post_ids, page_number + 1)
 
         page_number += 1
 
@@ -1,6 +1,3 @@
-import sys
-sys.setrecursionlimit(100000)
-
 import datetime
 import dateutil
 import requests
@@ -12,24 +9,28 @@ from gallery_dl import text
 from flask import current_app
 
 from ...lib.artist import is_artist_dnp, get_artist_id_from_service_data, create_artist_entry, reattempt_failed_artist_metadata_imports, finalize_artist_import, get_artist, get_artist_display_name
-from ...lib.post import remove_post_if_flagged_for_reimport, get_post_id_from_service_data, insert_post, is_post_import_finished, finalize_post_import, set_and_upload_post_thumbnail_if_needed, insert_post_embed, set_post_content, update_post, is_post_dnp
+from ...lib.post import remove_post_if_flagged_for_reimport, get_post_id_from_service_data, insert_post, is_post_import_finished, finalize_post_import, set_and_upload_post_thumbnail_if_needed, insert_post_embed, set_post_content, update_post, is_post_dnp, get_post_import_statuses
 from ...lib.account import mark_account_as_subscribed_to_artists
 from ...lib.file import insert_and_upload_post_file
 from ...lib.auto_importer import decrease_session_retries_remaining
 from ...utils.proxy import get_proxy
-from ...utils.download import fetch_file_and_data, remove_temp_files
+from ...utils.download import fetch_files_and_data, remove_temp_files
 from ...utils.utils import date_to_utc, parse_date, head, get_value, do_with_retries, limit_string, slugify, get_multi_level_value, get_scraper_json, is_http_success
 from ...utils.logger import log
-from ...utils.import_lock import take_lock, release_lock
+from ...utils.import_lock import take_lock, release_lock, PostLocked
+from ...utils.import_checkpoint import get_walker_checkpoint
 
 image_tag_before = '<img data-media-id="'
 image_tag_after = '>'
 
-def import_posts(import_id, key, account_id):
+def get_jar(key):
     jar = requests.cookies.RequestsCookieJar()
     jar.set('session_id', key)
+    return jar
+
+def import_posts(import_id, key, account_id, queue_posts, checkpoints = None, state = None):
+    jar = get_jar(key)
 
-    artists_in_import = set()
     campaign_ids = get_campaign_ids(jar, import_id)
     if campaign_ids is None:
         if account_id is not None:
@@ -39,179 +40,245 @@ def import_posts(import_id, key, account_id):
 
     current_app.logger.debug(f'Account {account_id} has campaigns {campaign_ids}')
     if len(campaign_ids) > 0:
-        for campaign_id in campaign_ids:
-            log(import_id, f'Importing pledge {campaign_id}')
-            import_campaign_page(posts_url + str(campaign_id), jar, import_id, artists_in_import)
-
-        if account_id is not None:
-            mark_account_as_subscribed_to_artists(account_id, artists_in_import, 'patreon')
+        for campaign_id in sorted(campaign_ids):
+            walker = f'pledge {campaign_id}'
+            url = get_walker_checkpoint(import_id, checkpoints, walker, posts_url + str(campaign_id))
+            if url is not None:
+                log(import_id, f'Importing pledge {campaign_id}')
+                import_campaign(import_id, walker, url, jar, queue_posts)
         log(import_id, 'Finished scanning for posts')
     else:
         log(import_id, 'No active subscriptions. No posts will be imported')
 
-def import_campaign_page(url, jar, import_id, artists_in_import):
+def finish_import(import_id, key, account_id, artist_ids, state):
+    for artist_id in artist_ids:
+        finalize_artist_import(artist_id)
+    if account_id is not None:
+        mark_account_as_subscribed_to_artists(account_id, artist_ids, 'patreon')
+
+def import_campaign(import_id, walker, url, jar, queue_posts):
+    # Artists of posts that are only seen here still get their missing
+    # banner and icon retried, once per walk.
+    retried_artist_ids = set()
+    for (scraper_data, next_url) in get_campaign_pages(import_id, url, jar):
+        page_posts = []
+        for post in get_value(scraper_data, 'data', []):
+            try:
+                page_posts.append((str(post['relationships']['user']['data']['id']), str(post['id']), post))
+            except Exception:
+                log(import_id, f'Error reading post {get_value(post, "id")} from page', 'exception')
+
+        # Posts that are DNP or already imported are settled for the whole
+        # page at once and never queued as jobs.
+        statuses = get_post_import_statuses('patreon', [(user_id, post_id) for (user_id, post_id, _) in page_posts])
+        posts = []
+        done = []
+        for (user_id, post_id, post) in page_posts:
+            status = statuses[(user_id, post_id)]
+            if status['is_post_dnp']:
+                log(import_id, f'Post {post_id} from artist {user_id} is in do not post list. Skipping.')
+            elif status['is_artist_dnp']:
+                log(import_id, f'Artist {user_id} is in do not post list. Skipping post {post_id}', to_client = True)
+            elif get_multi_level_value(post, 'attributes', 'current_user_can_view') is False:
+                log(import_id, f'Skipping {post_id} from artist {user_id} because post is from higher subscription tier')
+            elif status['is_import_finished'] and not status['is_flagged_for_reimport']:
+                log(import_id, f'Skipping post {post_id} from artist {user_id} because it was already imported')
+                done.append((post_id, status['artist_id']))
+                if status['artist_id'] not in retried_artist_ids:
+                    retried_artist_ids.add(status['artist_id'])
+                    try:
+                        reattempt_failed_artist_metadata_imports('patreon', user_id, status['artist_id'])
+                    except Exception:
+                        log(import_id, f'Error retrying metadata for artist {user_id}', 'exception')
+            else:
+                # Each post is queued with the parts of the page it needs: the
+                # name of its creator and the media it references.
+                try:
+                    posts.append((post_id, {
+                        'post': post,
+                        'user_name': get_user_name_from_data(scraper_data, user_id),
+                        'included': get_included_media(post, scraper_data)
+                    }))
+                except Exception:
+                    log(import_id, f'Error reading post {post_id} from page', 'exception')
+        queue_posts(posts, walker, next_url, done)
+
+def get_campaign_pages(import_id, url, jar):
+    # Yields (page, next page url) one page at a time, so only the current
+    # page is held in memory however long the campaign is.
+    while url is not None:
+        try:
+            scraper_data = get_scraper_json(url, jar)
+        except Exception:
+            log(import_id, 'Error connecting to Patreon. Skipping pledge', 'exception')
+            return
+
+        next_url = get_multi_level_value(scraper_data, 'links', 'next')
+        yield (scraper_data, next_url)
+        if next_url is not None:
+            log(import_id, 'Processing next page')
+        url = next_url
+
+# The media urls of a queued page are signed and expire, and a job may run
+# hours after its page was fetched, so the post is fetched again when the
+# job runs. The queued data is only used if that fails.
+def refresh_post_data(import_id, post_id, jar, data):
     try:
-        scraper_data = get_scraper_json(url, jar)
+        scraper_data = get_scraper_json(f'https://www.patreon.com/api/posts/{post_id}?{post_query}&json-api-use-default-includes=false&json-api-version=1.0', jar)
+        post = scraper_data['data']
+        user_id = str(post['relationships']['user']['data']['id'])
+        return {
+            'post': post,
+            'user_name': get_user_name_from_data(scraper_data, user_id) or data['user_name'],
+            'included': get_included_media(post, scraper_data)
+        }
     except Exception:
-        log(import_id, 'Error connecting to Patreon. Skipping pledge', 'exception')
-        return set()
-
-    for post in get_value(scraper_data, 'data', []):
-        internal_post_id = None
-        resource_id = None
-        import_lock_id = None
-        try:
-            user_id = str(post['relationships']['user']['data']['id'])
-            post_id = str(post['id'])
-
-            if is_post_dnp('patreon', user_id, post_id):
-                    log(import_id, f'Post {post_id} from artist {user_id} is in do not post list. Skipping.')
-                    continue
-
-            if is_artist_dnp('patreon', user_id):
-                log(import_id, f'Artist {user_id} is in do not post list. Skipping post {post_id}', to_client = True)
-                continue
-
-            import_lock_id = take_lock('patreon', user_id, post_id)
-            if import_lock_id is None:
-                log(import_id, f'Skipping post {post_id} from artist {user_id} because it is being imported by someone else right now')
-                continue
+        log(import_id, f'Error refreshing post {post_id}; using the data from its page', 'exception')
+        return data
+
+def get_included_media(post, scraper_data):
+    media_ids = set(image['id'] for image in get_multi_level_value(post, 'relationships', 'images', 'data', default = []) or [])
+    audio_id = get_multi_level_value(post, 'relationships', 'audio', 'data', 'id')
+    if audio_id is not None:
+        media_ids.add(audio_id)
+    return [included for included in get_value(scraper_data, 'included', []) if included['id'] in media_ids]
+
+def import_post(import_id, key, data):
+    jar = get_jar(key)
+    post = data['post']
+    internal_post_id = None
+    resource_id = None
+    import_lock_id = None
+    artist_id = None
+    try:
+        user_id = str(post['relationships']['user']['data']['id'])
+        post_id = str(post['id'])
+
+        if is_post_dnp('patreon', user_id, post_id):
+            log(import_id, f'Post {post_id} from artist {user_id} is in do not post list. Skipping.')
+            return None
+
+        if is_artist_dnp('patreon', user_id):
+            log(import_id, f'Artist {user_id} is in do not post list. Skipping post {post_id}', to_client = True)
+            return None
+
+        import_lock_id = take_lock('patreon', user_id, post_id)
+        if import_lock_id is None:
+            log(import_id, f'Post {post_id} from artist {user_id} is being imported by someone else right now. It will be retried later')
+            raise PostLocked(post_id)
+
+        data = refresh_post_data(import_id, post_id, jar, data)
+        post = data['post']
+
+        can_view = get_multi_level_value(post, 'attributes', 'current_user_can_view')
+        if can_view is not None and not can_view:
+            log(import_id, f'Skipping {post_id} from artist {user_id} because post is from higher subscription tier')
+            return None
+
+        artist_id = get_artist_id_from_service_data('patreon', user_id)
+        if artist_id is None:
+            user_name = data['user_name']
+            display_name = get_artist_display_name('patreon', user_id)
+            artist_id = create_artist_entry('patreon', user_id, display_name, user_name)
+        reattempt_failed_artist_metadata_imports('patreon', user_id, artist_id)
+
+        is_reimport = remove_post_if_flagged_for_reimport('patreon', user_id, post_id)
+
+        if is_post_import_finished('patreon', user_id, post_id):
+            log(import_id, f'Skipping post {post_id} from artist {user_id} because it was already imported')
+            return artist_id
+
+        post_data = {
+            'service': 'patreon',
+            'service_artist_id': user_id,
+            'service_id': post_id,
+            'artist_id': artist_id,
+            'title': post['attributes']['title'] or '',
+            'content': '',
+            'is_manual_upload': False,
+            'added_at': datetime.datetime.utcnow(),
+            'published_at': date_to_utc(parse_date(post['attributes']['published_at'])),
+            'updated_at': date_to_utc(parse_date(post['attributes']['edited_at'])),
+            'import_succeeded': False
+        }
+
+
+        if is_reimport:
+            log(import_id, f'Post {post_id} from artist {user_id} was flagged for reimport. Reimporting')
+            internal_post_id = get_post_id_from_service_data('patreon', user_id, post_id)
+            update_post(post_data, internal_post_id)
+        else:
+            log(import_id, f'Importing post {post_id} from artist {user_id}')
+            internal_post_id = insert_post(post_data)
+
+        resource_id = f'post{internal_post_id}'
+
+        downloads = []
+        post_content = get_multi_level_value(post, 'attributes', 'content')
+        if post_content is not None:
+            for image in get_embedded_images(post_content):
+                download_url = text.extract(image, 'src="', '"')[0]
+                downloads.append({ 'url': download_url, 'inline_image': image })
+
+        if get_multi_level_value(post, 'attributes', 'embed') is not None:
+            embed = {
+                'subject': post['attributes']['embed']['subject'],
+                'description': post['attributes']['embed']['description'],
+                'url': post['attributes']['embed']['url']
+            }
+            insert_post_embed(internal_post_id, embed)
 
-            can_view = get_multi_level_value(post, 'attributes', 'current_user_can_view')
-            if can_view is not None and not can_view:
-                log(import_id, f'Skipping {post_id} from artist {user_id} because post is from higher subscription tier')
-                continue
+        if get_multi_level_value(post, 'attributes', 'post_file') is not None:
+            downloads.append({ 'url': post['attributes']['post_file']['url'] })
 
-            artist_id = get_artist_id_from_service_data('patreon', user_id)
-            if artist_id is None:
-                user_name = get_user_name_from_data(scraper_data, user_id)
-                display_name = get_artist_display_name('patreon', user_id)
-                artist_id = create_artist_entry('patreon', user_id, display_name, user_name)
-            reattempt_failed_artist_metadata_imports('patreon', user_id, artist_id)
-            artists_in_import.add(artist_id)
+        for attachment in get_multi_level_value(post, 'relationships', 'attachments', 'data', default = []):
+            downloads.append({ 'url': f'https://www.patreon.com/file?h={post_id}&i={attachment["id"]}', 'kwargs': { 'cookies': jar } })
 
-            is_reimport = remove_post_if_flagged_for_reimport('patreon', user_id, post_id)
+        if get_multi_level_value(post, 'relationships', 'images', 'data') is not None:
+            for image in post['relationships']['images']['data']:
+                for media in list(filter(lambda included: included['id'] == image['id'], data['included'])):
+                    if media['attributes']['state'] != 'ready':
+                        continue
+                    downloads.append({ 'url': media['attributes']['download_url'], 'name': media['attributes']['file_name'] })
 
-            if is_post_import_finished('patreon', user_id, post_id):
-                log(import_id, f'Skipping post {post_id} from artist {user_id} because it was already imported')
-                continue
+        if get_multi_level_value(post, 'relationships', 'audio', 'data') is not None:
+            for media in list(filter(lambda included: included['id'] == post['relationships']['audio']['data']['id'], data['included'])):
+                if media['attributes']['state'] != 'ready':
+                    continue
+                downloads.append({ 'url': media['attributes']['download_url'], 'name': media['attributes']['file_name'] })
 
-            post_data = {
-                'service': 'patreon',
-                'service_artist_id': user_id,
-                'service_id': post_id,
-                'artist_id': artist_id,
-                'title': post['attributes']['title'] or '',
-                'content': '',
-                'is_manual_upload': False,
-                'added_at': datetime.datetime.utcnow(),
-                'published_at': date_to_utc(parse_date(post['attributes']['published_at'])),
-                'updated_at': date_to_utc(parse_date(post['attributes']['edited_at'])),
-                'import_succeeded': False
-            }
+        for (download, file_data) in zip(downloads, fetch_files_and_data(downloads, resource_id)):
+            if 'name' in download:
+                file_data['name'] = limit_string(slugify(download['name'] or str(uuid.uuid4())), 255)
+            file_data['path'] = f'files/patreon/{internal_post_id}/{file_data["name"]}'
+            file_data['post_id'] = internal_post_id
+            file_data['service'] = 'patreon'
+            if 'inline_image' in download:
+                file_data['is_inline'] = True
 
+            set_and_upload_post_thumbnail_if_needed(file_data)
+            post_file_id = insert_and_upload_post_file(file_data)
 
-            if is_reimport:
-                log(import_id, f'Post {post_id} from artist {user_id} was flagged for reimport. Reimporting')
-                internal_post_id = get_post_id_from_service_data('patreon', user_id, post_id)
-                update_post(post_data, internal_post_id)
-            else:
-                log(import_id, f'Importing post {post_id} from artist {user_id}')
-                internal_post_id = insert_post(post_data)
-
-            resource_id = f'post{internal_post_id}'
-
-            if get_multi_level_value(post, 'attributes', 'content') is not None:
-                post_content = post['attributes']['content']
-                for image in get_embedded_images(post_content):
-                    download_url = text.extract(image, 'src="', '"')[0]
-
-                    file_data = fetch_file_and_data(download_url, resource_id = resource_id)
-                    file_data['path'] = f'files/patreon/{internal_post_id}/{file_data["name"]}'
-                    file_data['post_id'] = internal_post_id
-                    file_data['service'] = 'patreon'
-                    file_data['is_inline'] = True
-
-                    set_and_upload_post_thumbnail_if_needed(file_data)
-                    post_file_id = insert_and_upload_post_file(file_data)
-
-                    post_content = post_content.replace(image_tag_before + image + image_tag_after, f"{{{{post_file_{post_file_id}}}}}")
-                set_post_content(internal_post_id, post_content)
-
-            if get_multi_level_value(post, 'attributes', 'embed') is not None:
-                embed = {
-                    'subject': post['attributes']['embed']['subject'],
-                    'description': post['attributes']['embed']['description'],
-                    'url': post['attributes']['embed']['url']
-                }
-                insert_post_embed(internal_post_id, embed)
-
-            if get_multi_level_value(post, 'attributes', 'post_file') is not None:
-                file_data = fetch_file_and_data(post['attributes']['post_file']['url'], resource_id = resource_id)
-                file_data['path'] = f'files/patreon/{internal_post_id}/{file_data["name"]}'
-                file_data['post_id'] = internal_post_id
-                file_data['service'] = 'patreon'
-
-                set_and_upload_post_thumbnail_if_needed(file_data)
-                insert_and_upload_post_file(file_data)
-
-            for attachment in get_multi_level_value(post, 'relationships', 'attachments', 'data', default = []):
-                file_data = fetch_file_and_data(f'https://www.patreon.com/file?h={post_id}&i={attachment["id"]}', cookies = jar, resource_id = resource_id)
-                file_data['path'] = f'files/patreon/{internal_post_id}/{file_data["name"]}'
-                file_data['post_id'] = internal_post_id
-                file_data['service'] = 'patreon'
-
-                set_and_upload_post_thumbnail_if_needed(file_data)
-                insert_and_upload_post_file(file_data)                
-
-            if get_multi_level_value(post, 'relationships', 'images', 'data') is not None:
-                for image in post['relationships']['images']['data']:
-                    for media in list(filter(lambda included: included['id'] == image['id'], scraper_data['included'])):
-                        if media['attributes']['state'] != 'ready':
-                            continue
-                        file_data = fetch_file_and_data(media['attributes']['download_url'], resource_id = resource_id)
-                        file_data['name'] = limit_string(slugify(media['attributes']['file_name'] or str(uuid.uuid4())), 255)
-                        file_data['path'] = f'files/patreon/{internal_post_id}/{file_data["name"]}'
-                        file_data['post_id'] = internal_post_id
-                        file_data['service'] = 'patreon'
-
-                        set_and_upload_post_thumbnail_if_needed(file_data)
-                        insert_and_upload_post_file(file_data)
-
-            if get_multi_level_value(post, 'relationships', 'audio', 'data') is not None:
-                for media in list(filter(lambda included: included['id'] == post['relationships']['audio']['data']['id'], scraper_data['included'])):
-                    if media['attributes']['state'] != 'ready':
-                        continue
+            if 'inline_image' in download:
+                post_content = post_content.replace(image_tag_before + download['inline_image'] + image_tag_after, f"{{{{post_file_{post_file_id}}}}}")
 
-                    file_data = fetch_file_and_data(media['attributes']['download_url'], resource_id = resource_id)
-                    file_data['name'] = limit_string(slugify(media['attributes']['file_name'] or str(uuid.uuid4())), 255)
-                    file_data['path'] = f'files/patreon/{internal_post_id}/{file_data["name"]}'
-                    file_data['post_id'] = internal_post_id
-                    file_data['service'] = 'patreon'
+        if post_content is not None:
+            set_post_content(internal_post_id, post_content)
 
-                    set_and_upload_post_thumbnail_if_needed(file_data)
-                    insert_and_upload_post_file(file_data)
+        finalize_post_import(internal_post_id, artist_id)
 
-            finalize_post_import(internal_post_id, artist_id)
+        log(import_id, f'Finished importing {post_id} from artist {user_id}', to_client = False)
+    except PostLocked:
+        raise
+    except Exception:
+        log(import_id, f'Error while importing {post_id} from artist {user_id}', 'exception')
+    finally:
+        if import_lock_id is not None:
+            release_lock(import_lock_id)
+        if resource_id is not None:
+            remove_temp_files(resource_id)
 
-            log(import_id, f'Finished importing {post_id} from artist {user_id}', to_client = False)
-        except Exception:
-            log(import_id, f'Error while importing {post_id} from artist {user_id}', 'exception')
-            continue
-        finally:
-            if import_lock_id is not None:
-                release_lock(import_lock_id)
-            if resource_id is not None:
-                remove_temp_files(resource_id)
-
-    next_url = get_multi_level_value(scraper_data, 'links', 'next')
-    if next_url is not None:
-        del scraper_data # Memory usage optimization
-        log(import_id, 'Processing next page')
-        import_campaign_page(next_url, jar, import_id, artists_in_import)
-    else:
-        for artist_id in artists_in_import:
-            finalize_artist_import(artist_id)
+    return artist_id
 
 def get_active_campaign_ids(jar, import_id):
     try:
@@ -314,7 +381,7 @@ def get_user_name_from_data(data, service_id):
 def get_embedded_images(content):
     return text.extract_iter(content, image_tag_before, image_tag_after)
 
-posts_url = 'https://www.patreon.com/api/posts' + '?include=' + ','.join([
+post_query = 'include=' + ','.join([
     'user',
     'attachments',
     'campaign,poll.choices',
@@ -372,7 +439,10 @@ posts_url = 'https://www.patreon.com/api/posts' + '?include=' + ','.join([
     'metadata',
     'file_name',
     'state'
-]) + '&sort=-published_at' \
+])
+
+posts_url = 'https://www.patreon.com/api/posts?' + post_query \
++ '&sort=-published_at' \
 + '&filter[is_draft]=false' \
 + '&filter[contains_exclusive_posts]=true' \
 + '&json-api-use-default-includes=false&json-api-version=1.0' \
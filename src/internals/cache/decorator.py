@@ -0,0 +1,206 @@
+import functools
+import inspect
+import time
+from threading import Lock
+
+from .redis import get_redis, serialize, deserialize, set_tagged
+
+# Every read-through cached getter is declared here so key versions and TTLs
+# can be tuned from one place. Bump `version` whenever the shape of a cached
+# value changes; the old keys are simply left to expire.
+#   version: appended to the key prefix as `_v{version}` (1 means no suffix)
+#   ttl: seconds a value lives in Redis
+#   negative_ttl: seconds a `None` result lives in Redis
+#   tag: optional invalidation tag, formatted with the getter's arguments;
+#        every key is registered under it so `delete_tag` can drop the whole
+#        family without scanning the keyspace
+#   generation: optional scope whose counter (for the getter's first
+#        argument) is embedded in the key; `bump_generation` makes every
+#        existing key unreachable with a single INCR and they age out by TTL
+cache_definitions = {
+    'post': { 'version': 4, 'ttl': 86400, 'negative_ttl': 300 },
+    'post_files': { 'version': 2, 'ttl': 86400, 'negative_ttl': 300 },
+    'post_embeds': { 'version': 1, 'ttl': 86400, 'negative_ttl': 300 },
+    'post_extra_contents': { 'version': 1, 'ttl': 86400, 'negative_ttl': 300 },
+    'post_for_listing': { 'version': 3, 'ttl': 86400, 'negative_ttl': 300 },
+    'post_flagged': { 'version': 1, 'ttl': 86400, 'negative_ttl': 300 },
+    'artist_posts_for_list': { 'version': 5, 'ttl': 21600, 'negative_ttl': 300, 'generation': 'artist' },
+    'artist_post_search': { 'version': 2, 'ttl': 3600, 'negative_ttl': 300 },
+    'random_post_keys': { 'version': 1, 'ttl': 900, 'negative_ttl': 60 },
+    'total_post_count': { 'version': 1, 'ttl': 3600, 'negative_ttl': 60 },
+    'artist': { 'version': 2, 'ttl': 86400, 'negative_ttl': 300 },
+    'artist_count': { 'version': 2, 'ttl': 3600, 'negative_ttl': 60 },
+    'artist_post_count': { 'version': 2, 'ttl': 86400, 'negative_ttl': 300 },
+    'recently_indexed_artists': { 'version': 2, 'ttl': 3600, 'negative_ttl': 60, 'tag': 'recently_indexed_artists' },
+    'artist_autocomplete': { 'version': 1, 'ttl': 3600, 'negative_ttl': 300 },
+    'random_artist_ids': { 'version': 1, 'ttl': 900, 'negative_ttl': 60 },
+    'favorite_post_count': { 'version': 1, 'ttl': 86400, 'negative_ttl': 300 },
+    'favorite_artist_count': { 'version': 1, 'ttl': 86400, 'negative_ttl': 300 },
+    'artist_favorited': { 'version': 1, 'ttl': 86400, 'negative_ttl': 300 },
+    'post_favorited': { 'version': 1, 'ttl': 86400, 'negative_ttl': 300 },
+    'account': { 'version': 3, 'ttl': 86400, 'negative_ttl': 300 },
+    'account_stats': { 'version': 1, 'ttl': 3600, 'negative_ttl': 60 },
+    'account_auto_imports': { 'version': 1, 'ttl': 86400, 'negative_ttl': 300 },
+    'request_list': { 'version': 1, 'ttl': 3600, 'negative_ttl': 60, 'tag': 'request_list' },
+    'request': { 'version': 1, 'ttl': 86400, 'negative_ttl': 300 },
+    'request_count': { 'version': 1, 'ttl': 3600, 'negative_ttl': 60 },
+    'top_25_account_scores': { 'version': 3, 'ttl': 7200, 'negative_ttl': 60 },
+}
+
+# A miss takes a short-lived lock so only one worker rebuilds a value while
+# the others wait for it to show up instead of all hitting Postgres at once.
+FILL_LOCK_TIMEOUT = 10
+FILL_WAIT_INTERVAL = 0.05
+FILL_WAIT_ATTEMPTS = 40
+
+STATS_KEY = 'cache_stats'
+STATS_FLUSH_EVENTS = 100
+
+stats_lock = Lock()
+pending_stats = {}
+pending_stats_events = 0
+
+def cached(name):
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            reload = bound.arguments.get('reload', False)
+            key_args = [value for (arg, value) in bound.arguments.items() if arg != 'reload']
+            scope = cache_definitions[name].get('generation')
+            if scope is None:
+                key = make_key(name, *key_args)
+            else:
+                key = make_key(name, key_args[0], f'g{get_generation(scope, key_args[0])}', *key_args[1:])
+            tag = get_tag(name, *key_args)
+            return read_through(name, key, lambda: func(*bound.args, **bound.kwargs), reload, tag)
+
+        wrapper.cache_name = name
+        return wrapper
+    return decorator
+
+def read_through(name, key, loader, reload = False, tag = None):
+    redis = get_redis()
+    if not reload:
+        value = redis.get(key)
+        if value is not None:
+            record_stat(name, 'hits')
+            return deserialize(value)
+    record_stat(name, 'misses')
+
+    lock_key = f'{key}:fill_lock'
+    has_lock = redis.set(lock_key, 1, nx = True, ex = FILL_LOCK_TIMEOUT)
+    if not has_lock and not reload:
+        value = wait_for_fill(redis, key)
+        if value is not None:
+            return deserialize(value)
+
+    try:
+        value = loader()
+        if tag is None:
+            redis.set(key, serialize(value), ex = get_ttl(name, value))
+        else:
+            set_tagged(key, serialize(value), tag, ex = get_ttl(name, value))
+    finally:
+        if has_lock:
+            redis.delete(lock_key)
+    return value
+
+# Batch counterpart of `cached` for single-id getters: one MGET for every id,
+# one call to `loader` with the ids that missed (it returns a dict keyed by
+# id) and one pipeline to backfill them. Results come back in `ids` order.
+def read_through_many(name, ids, loader):
+    if len(ids) == 0:
+        return []
+
+    redis = get_redis()
+    values = redis.mget([make_key(name, id) for id in ids])
+
+    results = {}
+    missing_ids = []
+    for (id, value) in zip(ids, values):
+        if value is None:
+            missing_ids.append(id)
+            record_stat(name, 'misses')
+        else:
+            results[str(id)] = deserialize(value)
+            record_stat(name, 'hits')
+
+    if len(missing_ids) > 0:
+        loaded = { str(id): value for (id, value) in loader(missing_ids).items() }
+        pipe = redis.pipeline(transaction = False)
+        for id in missing_ids:
+            value = loaded.get(str(id))
+            results[str(id)] = value
+            pipe.set(make_key(name, id), serialize(value), ex = get_ttl(name, value))
+        pipe.execute()
+
+    return [results[str(id)] for id in ids]
+
+def wait_for_fill(redis, key):
+    for _ in range(FILL_WAIT_ATTEMPTS):
+        time.sleep(FILL_WAIT_INTERVAL)
+        value = redis.get(key)
+        if value is not None:
+            return value
+    return None
+
+def make_key(name, *args):
+    version = cache_definitions[name]['version']
+    prefix = name if version == 1 else f'{name}_v{version}'
+    return ':'.join([prefix, *[str(arg) for arg in args]])
+
+def get_generation_key(scope, id):
+    return f'cache_generation:{scope}:{id}'
+
+def get_generation(scope, id):
+    generation = get_redis().get(get_generation_key(scope, id))
+    if generation is None:
+        return 0
+    return int(generation)
+
+def bump_generation(scope, id):
+    return get_redis().incr(get_generation_key(scope, id))
+
+def get_tag(name, *args):
+    tag = cache_definitions[name].get('tag')
+    if tag is None:
+        return None
+    return tag.format(*args)
+
+def get_ttl(name, value):
+    definition = cache_definitions[name]
+    if value is None:
+        return definition['negative_ttl']
+    return definition['ttl']
+
+def record_stat(name, kind):
+    global pending_stats_events
+    with stats_lock:
+        field = f'{name}:{kind}'
+        pending_stats[field] = pending_stats.get(field, 0) + 1
+        pending_stats_events += 1
+        if pending_stats_events < STATS_FLUSH_EVENTS:
+            return
+        to_flush = dict(pending_stats)
+        pending_stats.clear()
+        pending_stats_events = 0
+
+    try:
+        pipe = get_redis().pipeline(transaction = False)
+        for (field, count) in to_flush.items():
+            pipe.hincrby(STATS_KEY, field, count)
+        pipe.execute()
+    except Exception:
+        pass
+
+def get_cache_stats():
+    raw_stats = get_redis().hgetall(STATS_KEY)
+    stats = {}
+    for (field, count) in raw_stats.items():
+        (name, kind) = field.decode('utf-8').rsplit(':', 1)
+        stats.setdefault(name, { 'hits': 0, 'misses': 0 })[kind] = int(count)
+    return stats
@@ -20,16 +20,53 @@ def get_pool():
 def get_redis():
     return redis.Redis(connection_pool=pool)
 
-def delete_keys(pattern):
-    redis = get_redis()
-    keys = redis.keys(pattern)
-    if len(keys) > 0:
-        redis.delete(*keys)
-
-def delete_key_list(keys):
-    conn = get_redis()
-    for key in keys:
-        conn.delete(key)
+def get_tag_key(tag):
+    return f'cache_tag:{tag}'
+
+# Sets a key and adds it to a tag set in one script, so a `delete_tag`
+# can't run in between and miss the new key. The set must outlive every key
+# in it, so its TTL is only ever extended: a short-lived (e.g. negative)
+# entry can't expire the set early and leave longer-lived members that can
+# no longer be invalidated. A key without a TTL makes the set persistent.
+# (EXPIRE ... GT needs Redis 7.)
+set_tagged_script = """
+    if ARGV[2] == '' then
+        redis.call('SET', KEYS[2], ARGV[1])
+    else
+        redis.call('SET', KEYS[2], ARGV[1], 'EX', ARGV[2])
+    end
+    local existed = redis.call('EXISTS', KEYS[1])
+    redis.call('SADD', KEYS[1], KEYS[2])
+    if ARGV[2] == '' then
+        return redis.call('PERSIST', KEYS[1])
+    end
+    local ttl = redis.call('TTL', KEYS[1])
+    if existed == 0 or (ttl ~= -1 and ttl < tonumber(ARGV[2])) then
+        return redis.call('EXPIRE', KEYS[1], ARGV[2])
+    end
+    return 0
+"""
+
+def set_tagged(key, value, tag, ex = None):
+    get_redis().eval(set_tagged_script, 2, get_tag_key(tag), key, value, '' if ex is None else int(ex))
+
+# Removes every key registered under `tag`. The member list is read and the
+# tag set dropped atomically, so keys tagged while this runs land in a fresh
+# set instead of being lost.
+def delete_tag(tag):
+    pipe = get_redis().pipeline(transaction = True)
+    pipe.smembers(get_tag_key(tag))
+    pipe.delete(get_tag_key(tag))
+    (keys, _) = pipe.execute()
+    delete_key_list(list(keys))
+
+def delete_key_list(keys, chunk_size = 500):
+    if len(keys) == 0:
+        return
+    pipe = get_redis().pipeline(transaction = False)
+    for i in range(0, len(keys), chunk_size):
+        pipe.delete(*keys[i:i + chunk_size])
+    pipe.execute()
 
 def serialize(data):
     return pickle.dumps(data)
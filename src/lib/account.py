@@ -2,7 +2,7 @@ from flask import session, current_app, flash
 
 from ..internals.database.database import get_cursor
 from ..utils.utils import get_value
-from ..internals.cache.redis import get_redis, serialize, deserialize
+from ..internals.cache.decorator import cached
 from ..lib.security import is_login_rate_limited
 from .artist import get_artist
 
@@ -16,23 +16,18 @@ def load_account(account_id = None, reload = False):
     elif account_id is None and 'account_id' not in session:
         return None
 
-    redis = get_redis()
-    key = f'account_v3:{account_id}'
-    account = redis.get(key)
-    if account is None or reload:
-        with get_cursor() as cursor:
-            query = 'SELECT id, username, display_name, created_at FROM account WHERE id = %s'
-            cursor.execute(query, (account_id,))
-            account = cursor.fetchone()
-            if account is not None:
-                query = 'SELECT role FROM account_role WHERE account_id = %s'
-                cursor.execute(query, (account_id,))
-                account['roles'] = [row['role'] for row in cursor.fetchall()]
-
-        redis.set(key, serialize(account))
-    else:
-        account = deserialize(account)
+    return get_account(account_id, reload)
 
+@cached('account')
+def get_account(account_id, reload = False):
+    with get_cursor() as cursor:
+        query = 'SELECT id, username, display_name, created_at FROM account WHERE id = %s'
+        cursor.execute(query, (account_id,))
+        account = cursor.fetchone()
+        if account is not None:
+            query = 'SELECT role FROM account_role WHERE account_id = %s'
+            cursor.execute(query, (account_id,))
+            account['roles'] = [row['role'] for row in cursor.fetchall()]
     return account
 
 def get_login_info_for_username(username):
@@ -157,36 +152,29 @@ def mark_account_as_subscribed_to_artists(account_id, artist_ids, service):
     for artist_id in artist_ids:
         upsert_account_supports_artist(account_id, artist_id, True)
 
+@cached('account_stats')
 def get_account_stats(account_id, reload = False):
-    redis = get_redis()
-    key = f'account_stats:{account_id}'
-    stats = redis.get(key)
-    if stats is None or reload:
-        stats = {
-            'artists_imported': 0,
-            'artist_favorites': 0,
-            'posts_imported': 0,
-        }
-
-        with get_cursor() as cursor:
-            query = 'SELECT count(*) count FROM account_artist_subscription aas INNER JOIN artist a ON aas.artist_id = a.id LEFT JOIN do_not_post_request dnpr ON a.service = dnpr.service AND a.service_id = dnpr.service_id WHERE aas.account_id = %s AND dnpr.id IS NULL'
-            cursor.execute(query, (account_id,))
-            count = cursor.fetchone()['count']
-            stats['artists_imported'] = count
-
-            query = 'SELECT count(*) count FROM account_artist_subscription aas INNER JOIN account_artist_favorite aaf ON aas.artist_id = aaf.artist_id WHERE aas.account_id = %s'
-            cursor.execute(query, (account_id,))
-            count = cursor.fetchone()['count']
-            stats['artist_favorites'] = count
-
-            query = 'SELECT count(*) FROM post p INNER JOIN account_artist_subscription aas ON p.artist_id = aas.artist_id WHERE aas.account_id = %s AND (p.published_at <= aas.last_imported_at OR p.added_at <= aas.last_imported_at)'
-            cursor.execute(query, (account_id,))
-            count = cursor.fetchone()['count']
-            stats['posts_imported'] = count
+    stats = {
+        'artists_imported': 0,
+        'artist_favorites': 0,
+        'posts_imported': 0,
+    }
 
-        redis.set(key, serialize(stats), ex = 3600)
-    else:
-        stats = deserialize(stats)
+    with get_cursor() as cursor:
+        query = 'SELECT count(*) count FROM account_artist_subscription aas INNER JOIN artist a ON aas.artist_id = a.id LEFT JOIN do_not_post_request dnpr ON a.service = dnpr.service AND a.service_id = dnpr.service_id WHERE aas.account_id = %s AND dnpr.id IS NULL'
+        cursor.execute(query, (account_id,))
+        count = cursor.fetchone()['count']
+        stats['artists_imported'] = count
+
+        query = 'SELECT count(*) count FROM account_artist_subscription aas INNER JOIN account_artist_favorite aaf ON aas.artist_id = aaf.artist_id WHERE aas.account_id = %s'
+        cursor.execute(query, (account_id,))
+        count = cursor.fetchone()['count']
+        stats['artist_favorites'] = count
+
+        query = 'SELECT count(*) FROM post p INNER JOIN account_artist_subscription aas ON p.artist_id = aas.artist_id WHERE aas.account_id = %s AND (p.published_at <= aas.last_imported_at OR p.added_at <= aas.last_imported_at)'
+        cursor.execute(query, (account_id,))
+        count = cursor.fetchone()['count']
+        stats['posts_imported'] = count
     return stats
 
 def is_admin(account):
@@ -221,23 +209,17 @@ def change_display_name(account_id, display_name):
         cursor.execute(query, (display_name, account_id,))
     load_account(account_id, True)
 
+@cached('account_auto_imports')
 def get_account_auto_imports(account_id, reload = False):
-    redis = get_redis()
-    key = f'account_auto_imports:{account_id}'
-    imports = redis.get(key)
-    if imports is None or reload:
-        imports = []
-        with get_cursor() as cursor:
-            query = 'SELECT * FROM account_session WHERE account_id = %s'
-            cursor.execute(query, (account_id,))
-            for row in cursor.fetchall():
-                imports.append({
-                    'service': row['service'],
-                    'retries_remaining': row['retries_remaining'],
-                    'created_at': row['created_at'],
-                    'last_imported_at': row['last_imported_at']
-                })
-        redis.set(key, serialize(imports))
-    else:
-        imports = deserialize(imports)
+    imports = []
+    with get_cursor() as cursor:
+        query = 'SELECT * FROM account_session WHERE account_id = %s'
+        cursor.execute(query, (account_id,))
+        for row in cursor.fetchall():
+            imports.append({
+                'service': row['service'],
+                'retries_remaining': row['retries_remaining'],
+                'created_at': row['created_at'],
+                'last_imported_at': row['last_imported_at']
+            })
     return imports
@@ -6,245 +6,137 @@ import datetime
 import cloudscraper
 import requests
 
-from ..internals.cache.redis import get_redis, serialize, deserialize, delete_keys
+from ..internals.cache.redis import delete_tag
+from ..internals.cache.decorator import cached, get_tag, read_through_many, bump_generation
 from ..internals.database.database import get_cursor, get_conn
-from ..utils.utils import get_value, get_columns_from_row_by_prefix, take, offset, get_multi_level_value, get_config, create_scrapper_session
+from .artist_directory import search_artist_directory, invalidate_artist_directory
+from .file import get_post_storage, delete_post_storage
+from .artist_ranking import get_ranked_artist_ids, get_ranked_artist_count, remove_artist_from_rankings
+from ..utils.utils import get_value, get_columns_from_row_by_prefix, take, offset, get_multi_level_value, get_config, create_scrapper_session, decode_page_cursor, get_keyset_condition
 from ..utils.proxy import get_proxy
-from ..utils.object_storage import upload_file_bytes, delete_file
+from ..utils.object_storage import upload_file_bytes
 from ..utils.download import fetch_file_and_data, remove_temp_files
 from ..utils.image_processing import make_banner, make_icon
 
-def get_recently_indexed_artists(offset, limit):
-    redis = get_redis()
-    key = f'recently_indexed_artists:{offset}:{limit}'
-    artists = redis.get(key)
-    if artists is None:
-        with get_cursor() as cursor:
-            query = """
-                SELECT
-                    a.id artist_id,
-                    a.service artist_service,
-                    a.service_id artist_service_id,
-                    a.display_name artist_display_name,
-                    a.created_at artist_created_at,
-                    a.last_indexed artist_last_indexed,
-                    a.last_post_imported_at last_post_imported_at,
-                    ab.path banner_path,
-                    ab.retries_remaining banner_retries_remaining,
-                    ab.id banner_id,
-                    ab.updated_at banner_updated_at,
-                    ab.bucket_name banner_bucket_name,
-                    ai.path icon_path,
-                    ai.retries_remaining icon_retries_remaining,
-                    ai.id icon_id,
-                    ai.updated_at icon_updated_at,
-                    ai.bucket_name icon_bucket_name
-                FROM artist a
-                LEFT JOIN artist_banner ab ON ab.artist_id = a.id
-                LEFT JOIN artist_icon ai ON ai.artist_id = a.id
-                WHERE last_post_imported_at IS NOT NULL
-                ORDER BY last_post_imported_at DESC
-                OFFSET %s
-                LIMIT %s
-            """
-            cursor.execute(query, (offset, limit,))
-            rows = cursor.fetchall()
+@cached('recently_indexed_artists')
+def get_recently_indexed_artists(offset, limit, page_cursor = None):
+    keyset = decode_page_cursor(page_cursor, 2)
+    with get_cursor() as cursor:
+        if keyset is None:
+            page_condition = 'true'
+            params = (offset, limit,)
+        else:
+            page_condition = get_keyset_condition(['a.last_post_imported_at', 'a.id'])
+            params = (*keyset, 0, limit,)
+        query = f"""
+            SELECT
+                a.id artist_id,
+                a.service artist_service,
+                a.service_id artist_service_id,
+                a.display_name artist_display_name,
+                a.created_at artist_created_at,
+                a.last_indexed artist_last_indexed,
+                a.last_post_imported_at artist_last_post_imported_at,
+                ab.path banner_path,
+                ab.retries_remaining banner_retries_remaining,
+                ab.id banner_id,
+                ab.updated_at banner_updated_at,
+                ab.bucket_name banner_bucket_name,
+                ai.path icon_path,
+                ai.retries_remaining icon_retries_remaining,
+                ai.id icon_id,
+                ai.updated_at icon_updated_at,
+                ai.bucket_name icon_bucket_name
+            FROM artist a
+            LEFT JOIN artist_banner ab ON ab.artist_id = a.id
+            LEFT JOIN artist_icon ai ON ai.artist_id = a.id
+            WHERE a.last_post_imported_at IS NOT NULL AND {page_condition}
+            ORDER BY a.last_post_imported_at DESC, a.id DESC
+            OFFSET %s
+            LIMIT %s
+        """
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
 
-            artists = []
-            for row in rows:
-                artist = get_columns_from_row_by_prefix(row, 'artist')
-                artist['banner'] = get_columns_from_row_by_prefix(row, 'banner')
-                artist['icon'] = get_columns_from_row_by_prefix(row, 'icon')
-                artists.append(artist)
-        redis.set(key, serialize(artists))
-    else:
-        artists = deserialize(artists)
+    artists = []
+    for row in rows:
+        artist = get_columns_from_row_by_prefix(row, 'artist')
+        artist['banner'] = get_columns_from_row_by_prefix(row, 'banner')
+        artist['icon'] = get_columns_from_row_by_prefix(row, 'icon')
+        artists.append(artist)
     return artists
 
+@cached('artist_count')
 def get_artist_count(reload = False):
-    redis = get_redis()
-    key = 'artist_count'
-    count = redis.get(key)
-    if count is None or reload:
-        with get_cursor() as cursor:
-            query = 'SELECT count(*) as count FROM artist WHERE last_post_imported_at IS NOT NULL'
-            cursor.execute(query)
-            count = cursor.fetchone()['count']
-        redis.set(key, count)
-    else:
-        count = int(count)
-    return count
+    with get_cursor() as cursor:
+        query = 'SELECT count(*) as count FROM artist WHERE last_post_imported_at IS NOT NULL'
+        cursor.execute(query)
+        return cursor.fetchone()['count']
 
 def is_artist_dnp(service, service_id):
     with get_cursor() as cursor:
         cursor.execute("SELECT * FROM do_not_post_request WHERE service_id = %s AND service = %s", (service_id, service,))
         return cursor.fetchone() is not None
 
-def get_top_artists_by_faves(offset, count, reload = False):
-    redis = get_redis()
-    key = f'top_artists:{offset}:{count}'
-    artists = redis.get(key)
-    if artists is None or reload:
-        with get_cursor() as cursor:
-            query = """
-                SELECT
-                    a.id artist_id,
-                    a.service artist_service,
-                    a.service_id artist_service_id,
-                    a.display_name artist_display_name,
-                    a.created_at artist_created_at,
-                    a.last_indexed artist_last_indexed,
-                    a.last_post_imported_at last_post_imported_at,
-                    ab.path banner_path,
-                    ab.retries_remaining banner_retries_remaining,
-                    ab.id banner_id,
-                    ab.updated_at banner_updated_at,
-                    ab.bucket_name banner_bucket_name,
-                    ai.path icon_path,
-                    ai.retries_remaining icon_retries_remaining,
-                    ai.id icon_id,
-                    ai.updated_at icon_updated_at,
-                    ai.bucket_name icon_bucket_name
-                FROM artist a
-                LEFT JOIN artist_banner ab ON ab.artist_id = a.id
-                LEFT JOIN artist_icon ai ON ai.artist_id = a.id
-                INNER JOIN account_artist_favorite aaf
-                    ON a.id = aaf.artist_id
-                GROUP BY a.id, ab.id, ai.id
-                ORDER BY count(*) DESC
-                OFFSET %s
-                LIMIT %s
-            """
-            cursor.execute(query, (offset, count,))
-            rows = cursor.fetchall()
+def get_top_artists_by_faves(offset, count):
+    return get_artists(get_ranked_artist_ids('popular', offset, count))
 
-            artists = []
-            for row in rows:
-                artist = get_columns_from_row_by_prefix(row, 'artist')
-                artist['banner'] = get_columns_from_row_by_prefix(row, 'banner')
-                artist['icon'] = get_columns_from_row_by_prefix(row, 'icon')
-                artists.append(artist)
-
-        redis.set(key, serialize(artists), ex = 3600)
-        get_count_of_artists_faved(True)
-    else:
-        artists = deserialize(artists)
-    return artists
+def get_count_of_artists_faved():
+    return get_ranked_artist_count('popular')
 
-def get_count_of_artists_faved(reload = False):
-    redis = get_redis()
-    key = 'artists_faved_count'
-    count = redis.get(key)
-    if count is None or reload:
-        with get_cursor() as cursor:
-            query = """
-                SELECT count(distinct(a.id))
-                FROM artist a
-                INNER JOIN account_artist_favorite aaf
-                    ON a.id = aaf.artist_id
-            """
-            cursor.execute(query)
-            count = cursor.fetchone()['count']
-        redis.set(key, count, ex = 3600)
-    else:
-        count = int(count)
-    return count
-
-def get_top_artists_by_recent_faves(offset, count, reload = False):
-    redis = get_redis()
-    key = f'top_artists_recently_v2:{offset}:{count}'
-    artists = redis.get(key)
-    if artists is None or reload:
-        with get_cursor() as cursor:
-            query = """
-                SELECT
-                    a.id artist_id,
-                    a.service artist_service,
-                    a.service_id artist_service_id,
-                    a.display_name artist_display_name,
-                    a.created_at artist_created_at,
-                    a.last_indexed artist_last_indexed,
-                    a.last_post_imported_at last_post_imported_at,
-                    ab.path banner_path,
-                    ab.retries_remaining banner_retries_remaining,
-                    ab.id banner_id,
-                    ab.updated_at banner_updated_at,
-                    ab.bucket_name banner_bucket_name,
-                    ai.path icon_path,
-                    ai.retries_remaining icon_retries_remaining,
-                    ai.id icon_id,
-                    ai.updated_at icon_updated_at,
-                    ai.bucket_name icon_bucket_name
-                FROM artist a
-                LEFT JOIN artist_banner ab ON ab.artist_id = a.id
-                LEFT JOIN artist_icon ai ON ai.artist_id = a.id
-                INNER JOIN (
-                    SELECT * FROM account_artist_favorite
-                    ORDER BY id DESC LIMIT 1000
-                ) aaf
-                ON a.id = aaf.artist_id
-                GROUP BY a.id, ab.id, ai.id
-                ORDER BY count(*) DESC
-                OFFSET %s
-                LIMIT %s
-            """
-            cursor.execute(query, (offset, count,))
-            rows = cursor.fetchall()
+def get_top_artists_by_recent_faves(offset, count):
+    return get_artists(get_ranked_artist_ids('trending', offset, count))
 
-            artists = []
-            for row in rows:
-                artist = get_columns_from_row_by_prefix(row, 'artist')
-                artist['banner'] = get_columns_from_row_by_prefix(row, 'banner')
-                artist['icon'] = get_columns_from_row_by_prefix(row, 'icon')
-                artists.append(artist)
-
-        redis.set(key, serialize(artists), ex = 3600)
-        get_count_of_artists_recently_faved(True)
-    else:
-        artists = deserialize(artists)
-    return artists
-
-def get_count_of_artists_recently_faved(reload = False):
-    redis = get_redis()
-    key = 'artists_recently_faved_count_v2'
-    count = redis.get(key)
-    if count is None or reload:
-        with get_cursor() as cursor:
-            query = """
-                SELECT count(distinct(a.id))
-                FROM artist a
-                INNER JOIN (
-                    SELECT * FROM account_artist_favorite
-                    ORDER BY id DESC LIMIT 1000
-                ) aaf
-                ON a.id = aaf.artist_id
-            """
-            cursor.execute(query)
-            count = cursor.fetchone()['count']
-        redis.set(key, count, ex = 3600)
-    else:
-        count = int(count)
-    return count
+def get_count_of_artists_recently_faved():
+    return get_ranked_artist_count('trending')
 
+@cached('random_artist_ids')
 def get_random_artist_ids(count, reload = False):
-    redis = get_redis()
-    key = f'random_artist_ids:{count}'
-    artist_ids = redis.get(key)
-    if artist_ids is None or reload:
-        with get_cursor() as cursor:
-            query = 'SELECT id FROM artist ORDER BY random() LIMIT %s'
-            cursor.execute(query, (count,))
-            artist_ids = [row['id'] for row in cursor.fetchall()]
-        redis.set(key, serialize(artist_ids), ex = 900)
-    else:
-        artist_ids = deserialize(artist_ids)
-    return artist_ids
+    with get_cursor() as cursor:
+        query = 'SELECT id FROM artist ORDER BY random() LIMIT %s'
+        cursor.execute(query, (count,))
+        return [row['id'] for row in cursor.fetchall()]
 
+@cached('artist')
 def get_artist(artist_id, reload = False):
-    redis = get_redis()
-    key = f'artist_v2:{artist_id}'
-    artist = redis.get(key)
-    if artist is None or reload:
+    with get_cursor() as cursor:
+        query = """
+            SELECT
+                a.id artist_id,
+                a.service artist_service,
+                a.service_id artist_service_id,
+                a.display_name artist_display_name,
+                a.created_at artist_created_at,
+                a.last_indexed artist_last_indexed,
+                a.last_post_imported_at artist_last_post_imported_at,
+                ab.path banner_path,
+                ab.retries_remaining banner_retries_remaining,
+                ab.id banner_id,
+                ab.updated_at banner_updated_at,
+                ab.bucket_name banner_bucket_name,
+                ai.path icon_path,
+                ai.retries_remaining icon_retries_remaining,
+                ai.id icon_id,
+                ai.updated_at icon_updated_at,
+                ai.bucket_name icon_bucket_name
+            FROM artist a
+            LEFT JOIN artist_banner ab ON ab.artist_id = a.id
+            LEFT JOIN artist_icon ai ON ai.artist_id = a.id
+            WHERE a.id = %s
+        """
+        cursor.execute(query, (artist_id,))
+        row = cursor.fetchone()
+
+    if row is None:
+        return None
+
+    artist = get_columns_from_row_by_prefix(row, 'artist')
+    artist['banner'] = get_columns_from_row_by_prefix(row, 'banner')
+    artist['icon'] = get_columns_from_row_by_prefix(row, 'icon')
+    return artist
+
+def get_artists(artist_ids):
+    def load(missing_ids):
         with get_cursor() as cursor:
             query = """
                 SELECT
@@ -254,7 +146,7 @@ def get_artist(artist_id, reload = False):
                     a.display_name artist_display_name,
                     a.created_at artist_created_at,
                     a.last_indexed artist_last_indexed,
-                    a.last_post_imported_at last_post_imported_at,
+                    a.last_post_imported_at artist_last_post_imported_at,
                     ab.path banner_path,
                     ab.retries_remaining banner_retries_remaining,
                     ab.id banner_id,
@@ -268,57 +160,85 @@ def get_artist(artist_id, reload = False):
                 FROM artist a
                 LEFT JOIN artist_banner ab ON ab.artist_id = a.id
                 LEFT JOIN artist_icon ai ON ai.artist_id = a.id
-                WHERE a.id = %s
+                WHERE a.id = ANY(%s)
             """
-            cursor.execute(query, (artist_id,))
-            row = cursor.fetchone()
+            cursor.execute(query, ([int(artist_id) for artist_id in missing_ids],))
+            rows = cursor.fetchall()
 
-        if row is not None:
+        artists = {}
+        for row in rows:
             artist = get_columns_from_row_by_prefix(row, 'artist')
             artist['banner'] = get_columns_from_row_by_prefix(row, 'banner')
             artist['icon'] = get_columns_from_row_by_prefix(row, 'icon')
-        else:
-            artist = None
+            artists[artist['id']] = artist
+        return artists
 
-        redis.set(key, serialize(artist))
-    else:
-        artist = deserialize(artist)
-    return artist
+    artists = read_through_many('artist', artist_ids, load)
+    return [artist for artist in artists if artist is not None]
 
 def get_artist_search_results(q, service, o, limit):
+    directory_results = search_artist_directory(q, service, o, limit)
+    if directory_results is not None:
+        (artist_ids, total_count) = directory_results
+        return (get_artists(artist_ids), total_count)
+
+    if q == '' and service == '':
+        with get_cursor() as cursor:
+            query = """
+                SELECT id artist_id
+                FROM artist
+                WHERE last_post_imported_at IS NOT NULL
+                ORDER BY last_post_imported_at DESC, id DESC
+                OFFSET %s
+                LIMIT %s
+            """
+            cursor.execute(query, (o, limit,))
+            rows = cursor.fetchall()
+        return (get_artists([row['artist_id'] for row in rows]), get_artist_count())
+
     with get_cursor() as cursor:
         query = """
-            SELECT id artist_id
+            SELECT id artist_id, count(*) OVER () total_count
             FROM artist
             WHERE
                 (%(raw_query)s = '' OR display_name ILIKE %(like_query)s OR username ILIKE %(like_query)s OR service_id = %(raw_query)s)
                 AND
                 (%(service)s = '' OR service = %(service)s)
                 AND last_post_imported_at IS NOT NULL
-            ORDER BY last_post_imported_at DESC
+            ORDER BY last_post_imported_at DESC, id DESC
+            OFFSET %(offset)s
+            LIMIT %(limit)s
         """
-        like_query = f'%{q}%'
-        cursor.execute(query, {'like_query': like_query, 'raw_query': q, 'service': service})
+        like_query = f'%{escape_like_query(q)}%'
+        cursor.execute(query, {'like_query': like_query, 'raw_query': q, 'service': service, 'offset': o, 'limit': limit})
         rows = cursor.fetchall()
-    artists = []
-    for row in take(limit, offset(o, rows)):
-        artists.append(get_artist(row['artist_id']))
+    total_count = rows[0]['total_count'] if len(rows) > 0 else 0
+    return (get_artists([row['artist_id'] for row in rows]), total_count)
+
+@cached('artist_autocomplete')
+def get_artist_autocomplete_results(prefix, reload = False):
+    with get_cursor() as cursor:
+        query = """
+            SELECT id, service, display_name
+            FROM artist
+            WHERE
+                (display_name ILIKE %(like_query)s OR username ILIKE %(like_query)s)
+                AND last_post_imported_at IS NOT NULL
+            ORDER BY greatest(similarity(display_name, %(prefix)s), similarity(coalesce(username, ''), %(prefix)s)) DESC, last_post_imported_at DESC
+            LIMIT 10
+        """
+        cursor.execute(query, {'like_query': f'{escape_like_query(prefix)}%', 'prefix': prefix})
+        return cursor.fetchall()
 
-    return (artists, len(rows))
+def escape_like_query(q):
+    return q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
 
+@cached('artist_post_count')
 def get_artist_post_count(artist_id, reload = False):
-    redis = get_redis()
-    key = f'artist_post_count:{artist_id}'
-    count = redis.get(key)
-    if count is None or reload:
-        with get_cursor() as cursor:
-            query = 'SELECT count(*) as count FROM post WHERE artist_id = %s AND is_import_finished = true'
-            cursor.execute(query, (artist_id,))
-            count = cursor.fetchone()['count']
-        redis.set(key, str(count))
-    else:
-        count = int(count)
-    return count
+    with get_cursor() as cursor:
+        query = 'SELECT count(*) as count FROM post WHERE artist_id = %s AND is_import_finished = true'
+        cursor.execute(query, (artist_id,))
+        return cursor.fetchone()['count']
 
 def get_artist_id_from_service_data(service, service_id):
     with get_cursor() as cursor:
@@ -512,30 +432,25 @@ def finalize_artist_import(artist_id):
         cursor.execute("UPDATE artist SET last_indexed = timezone('utc', now()) WHERE id = %s", (artist_id,))
     get_artist_count(True)
     get_artist(artist_id, True)
-    delete_keys('recently_indexed_artists:*')
+    delete_tag(get_tag('recently_indexed_artists'))
 
 def delete_artist(artist_id):
     current_app.logger.debug(f'Deleting artist {artist_id}')
     try:
         files = []
         with get_cursor() as cursor:
+            cursor.execute('SELECT id FROM post WHERE artist_id = %s', (artist_id,))
+            post_ids = [row['id'] for row in cursor.fetchall()]
             query = """
-                SELECT preview_path path, pf.bucket_name bucket_name FROM post_file pf INNER JOIN post p ON pf.post_id = p.id WHERE p.artist_id = %(artist_id)s
-                UNION ALL
-                SELECT path, pf.bucket_name bucket_name FROM post_file pf INNER JOIN post p ON pf.post_id = p.id WHERE p.artist_id = %(artist_id)s
-                UNION ALL
-                SELECT thumbnail_path path, bucket_name FROM post WHERE artist_id = %(artist_id)s
+                SELECT bucket_name, path FROM artist_banner WHERE artist_id = %(artist_id)s
                 UNION ALL
-                SELECT path, bucket_name FROM artist_banner WHERE artist_id = %(artist_id)s
-                UNION ALL
-                SELECT path, bucket_name FROM artist_icon WHERE artist_id = %(artist_id)s
+                SELECT bucket_name, path FROM artist_icon WHERE artist_id = %(artist_id)s
             """
             cursor.execute(query, {'artist_id': artist_id})
-            rows = cursor.fetchall()
+            artist_objects = [(row['bucket_name'], row['path']) for row in cursor.fetchall()]
 
-        for row in rows:
-            if row['path'] is not None:
-                delete_file(row['path'], row['bucket_name'])
+        storage = get_post_storage(post_ids)
+        storage['objects'].extend(artist_objects)
 
         with get_conn() as conn:
             cursor = conn.cursor()
@@ -551,15 +466,17 @@ def delete_artist(artist_id):
             cursor.execute('DELETE FROM account_artist_subscription WHERE artist_id = %s', (artist_id,))
             cursor.execute('DELETE FROM artist WHERE id = %s', (artist_id,))
             conn.commit()
+
+        delete_post_storage(storage, f'artist {artist_id}')
     except Exception:
         current_app.logger.exception(f'Error deleting artist {artist_id}')
     current_app.logger.debug(f'Finished deleting artist {artist_id}')
     get_artist(artist_id, True)
+    invalidate_artist_directory()
+    get_artist_post_count(artist_id, True)
+    bump_generation('artist', artist_id)
     get_artist_count(True)
-    delete_keys('top_artists:*')
-    delete_keys('top_artists_recently:*')
-    get_count_of_artists_faved(True)
-    get_count_of_artists_recently_faved(True)
+    remove_artist_from_rankings(artist_id)
 
 def add_artist_to_dnp_list(artist_id):
     artist = get_artist(artist_id)
@@ -0,0 +1,118 @@
+from flask import current_app
+
+import datetime
+import time
+from threading import Lock
+
+from ..internals.database.database import get_cursor
+from ..internals.cache.decorator import get_generation, bump_generation
+
+# Every worker keeps the searchable columns of all listed artists in parallel
+# lists, newest `last_post_imported_at` first, so /artists can list, filter by
+# service and substring match without touching Postgres. The snapshot is
+# topped up from the `last_post_imported_at` watermark at most once every
+# REFRESH_INTERVAL seconds; removals bump the `artist_directory` generation,
+# which makes every worker rebuild from scratch on its next refresh.
+REFRESH_INTERVAL = 30
+# now() is taken at transaction start, so rows can commit slightly behind
+# the watermark; re-reading a small window picks them up.
+WATERMARK_OVERLAP = datetime.timedelta(seconds = 60)
+
+refresh_lock = Lock()
+snapshot = None
+last_refresh = 0
+
+def search_artist_directory(q, service, o, limit):
+    directory = get_artist_directory()
+    if directory is None:
+        return None
+
+    indices = directory['by_service'].get(service, []) if service != '' else None
+    if q != '':
+        q = q.lower()
+        candidates = indices if indices is not None else range(len(directory['ids']))
+        indices = [
+            i for i in candidates
+            if q in directory['search_names'][i] or q == directory['service_ids'][i].lower()
+        ]
+
+    if indices is None:
+        return (directory['ids'][o:o + limit], len(directory['ids']))
+    return ([directory['ids'][i] for i in indices[o:o + limit]], len(indices))
+
+def get_artist_directory():
+    global last_refresh
+    if snapshot is not None and time.monotonic() - last_refresh < REFRESH_INTERVAL:
+        return snapshot
+
+    if not refresh_lock.acquire(blocking = snapshot is None):
+        return snapshot
+    try:
+        if snapshot is None or time.monotonic() - last_refresh >= REFRESH_INTERVAL:
+            refresh_artist_directory()
+            last_refresh = time.monotonic()
+    except Exception:
+        current_app.logger.exception('Error refreshing artist directory')
+    finally:
+        refresh_lock.release()
+    return snapshot
+
+def refresh_artist_directory():
+    global snapshot
+    generation = get_generation('artist_directory', 'all')
+    if snapshot is None or snapshot['generation'] != generation:
+        rows = get_directory_rows()
+        snapshot = build_artist_directory(rows, generation)
+        return
+
+    rows = get_directory_rows(snapshot['watermark'] - WATERMARK_OVERLAP)
+    if len(rows) == 0:
+        return
+
+    updated_ids = set(row['id'] for row in rows)
+    previous = snapshot
+    for i in range(len(previous['ids'])):
+        if previous['ids'][i] not in updated_ids:
+            rows.append({
+                'id': previous['ids'][i],
+                'service': previous['services'][i],
+                'service_id': previous['service_ids'][i],
+                'search_name': previous['search_names'][i],
+                'last_post_imported_at': previous['imported_at'][i]
+            })
+    snapshot = build_artist_directory(rows, generation)
+
+def get_directory_rows(since = None):
+    with get_cursor() as cursor:
+        query = """
+            SELECT
+                id,
+                service,
+                service_id,
+                lower(display_name || chr(10) || coalesce(username, '')) search_name,
+                last_post_imported_at
+            FROM artist
+            WHERE last_post_imported_at IS NOT NULL AND last_post_imported_at > %s
+            ORDER BY last_post_imported_at DESC, id DESC
+        """
+        cursor.execute(query, (since or datetime.datetime.min,))
+        return cursor.fetchall()
+
+def build_artist_directory(rows, generation):
+    rows.sort(key = lambda row: (row['last_post_imported_at'], row['id']), reverse = True)
+    directory = {
+        'generation': generation,
+        'watermark': rows[0]['last_post_imported_at'] if len(rows) > 0 else datetime.datetime.min + WATERMARK_OVERLAP,
+        'ids': [row['id'] for row in rows],
+        'services': [row['service'] for row in rows],
+        'service_ids': [row['service_id'] for row in rows],
+        'search_names': [row['search_name'] for row in rows],
+        'imported_at': [row['last_post_imported_at'] for row in rows],
+        'by_service': {}
+    }
+    for (i, service) in enumerate(directory['services']):
+        directory['by_service'].setdefault(service, []).append(i)
+    return directory
+
+def invalidate_artist_directory():
+    bump_generation('artist_directory', 'all')
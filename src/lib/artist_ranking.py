@@ -0,0 +1,109 @@
+from flask import current_app
+
+import time
+
+from ..internals.cache.redis import get_redis
+from ..internals.database.database import get_cursor
+from ..utils.flask_thread import FlaskThread
+
+# Popular and trending artists are ranked by a background job instead of on
+# request. Each ranking is a Redis sorted set of artist id -> favorite count;
+# pages read a slice by rank and the set size is the total. A new set is
+# built under a temporary key and renamed over the live one, so readers
+# always see a complete ranking. Every worker runs the job loop, but a Redis
+# marker lets only one of them rebuild per interval. When a ranking is
+# missing (a fresh deploy, a Redis flush or an eviction) the request that
+# notices builds it, under the same marker; requests that can't read it
+# from Redis rank with SQL instead.
+RANKING_REFRESH_INTERVAL = 600
+RANKING_CHUNK_SIZE = 1000
+
+ranking_queries = {
+    'popular': """
+        SELECT artist_id, count(*) score
+        FROM account_artist_favorite
+        GROUP BY artist_id
+    """,
+    'trending': """
+        SELECT artist_id, count(*) score
+        FROM (
+            SELECT artist_id FROM account_artist_favorite
+            ORDER BY id DESC LIMIT 1000
+        ) aaf
+        GROUP BY artist_id
+    """
+}
+
+def get_ranking_key(name):
+    return f'artist_ranking:{name}'
+
+def get_ranked_artist_ids(name, offset, count):
+    if not ensure_ranking(name):
+        with get_cursor() as cursor:
+            query = f'SELECT artist_id FROM ({ranking_queries[name]}) ranking ORDER BY score DESC, artist_id DESC OFFSET %s LIMIT %s'
+            cursor.execute(query, (offset, count,))
+            return [row['artist_id'] for row in cursor.fetchall()]
+    ids = get_redis().zrevrange(get_ranking_key(name), offset, offset + count - 1)
+    return [int(id) for id in ids]
+
+def get_ranked_artist_count(name):
+    if not ensure_ranking(name):
+        with get_cursor() as cursor:
+            cursor.execute(f'SELECT count(*) count FROM ({ranking_queries[name]}) ranking')
+            return cursor.fetchone()['count']
+    return get_redis().zcard(get_ranking_key(name))
+
+def ensure_ranking(name):
+    redis = get_redis()
+    if redis.exists(get_ranking_key(name)):
+        return True
+    try:
+        refresh_artist_rankings()
+    except Exception:
+        current_app.logger.exception('Error building missing artist rankings')
+        return False
+    return redis.exists(get_ranking_key(name)) > 0
+
+def remove_artist_from_rankings(artist_id):
+    pipe = get_redis().pipeline(transaction = False)
+    for name in ranking_queries:
+        pipe.zrem(get_ranking_key(name), artist_id)
+    pipe.execute()
+
+def refresh_artist_rankings():
+    redis = get_redis()
+    claimed = redis.set('artist_ranking:refreshing', 1, nx = True, ex = RANKING_REFRESH_INTERVAL)
+    if not claimed:
+        return
+
+    try:
+        for (name, query) in ranking_queries.items():
+            with get_cursor() as cursor:
+                cursor.execute(query)
+                rows = cursor.fetchall()
+
+            key = get_ranking_key(name)
+            building_key = f'{key}:building'
+            pipe = redis.pipeline(transaction = False)
+            pipe.delete(building_key)
+            for i in range(0, len(rows), RANKING_CHUNK_SIZE):
+                pipe.zadd(building_key, { row['artist_id']: row['score'] for row in rows[i:i + RANKING_CHUNK_SIZE] })
+            if len(rows) > 0:
+                pipe.rename(building_key, key)
+            else:
+                pipe.delete(key)
+            pipe.execute()
+    except Exception:
+        redis.delete('artist_ranking:refreshing')
+        raise
+
+def run_artist_ranking_job():
+    while True:
+        try:
+            refresh_artist_rankings()
+        except Exception:
+            current_app.logger.exception('Error refreshing artist rankings')
+        time.sleep(RANKING_REFRESH_INTERVAL)
+
+def start_artist_ranking_job():
+    FlaskThread(target = run_artist_ranking_job, daemon = True).start()
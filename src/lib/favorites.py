@@ -1,121 +1,117 @@
 from ..internals.database.database import get_cursor
-from ..utils.utils import get_value
-from ..internals.cache.redis import get_redis, serialize, deserialize, delete_keys
-from ..lib.artist import get_artist
-from ..lib.post import get_post_for_listing
+from ..utils.utils import get_value, decode_page_cursor, encode_page_cursor, get_keyset_condition
+from ..internals.cache.decorator import cached
+from ..lib.artist import get_artists
+from ..lib.post import get_posts_for_listing
 
 import ujson
 import copy
 
-def get_favorite_artists(account_id, offset, sort_field, sort_direction):
+def get_favorite_artists(account_id, offset, sort_field, sort_direction, page_cursor = None):
     if sort_field == 'id':
         sort_field = 'aaf.id'
+    else:
+        # Artists that were never indexed have no last_indexed; a row
+        # comparison against NULL matches nothing, so they sort as the epoch.
+        sort_field = f"coalesce(a.{sort_field}, '1970-01-01'::timestamp)"
+    columns = [sort_field, 'aaf.id']
 
+    keyset = decode_page_cursor(page_cursor, 2)
     with get_cursor() as cursor:
+        if keyset is None:
+            page_condition = 'true'
+            params = (account_id, offset,)
+        else:
+            page_condition = get_keyset_condition(columns, sort_direction)
+            params = (account_id, *keyset, 0,)
         query = f"""
-            SELECT artist_id
+            SELECT artist_id, {sort_field} as sort_value, aaf.id as favorite_id
             FROM account_artist_favorite aaf
             INNER JOIN artist a ON aaf.artist_id = a.id
-            WHERE account_id = %s
-            ORDER BY {sort_field} {sort_direction}
+            WHERE account_id = %s AND {page_condition}
+            ORDER BY {sort_field} {sort_direction}, aaf.id {sort_direction}
             OFFSET %s
             LIMIT 25
         """
-        cursor.execute(query, (account_id, offset,))
+        cursor.execute(query, params)
         favorites = cursor.fetchall()
 
-    artists = []
-    for favorite in favorites:
-        artist = get_artist(favorite['artist_id'])
-        if artist is not None:
-            artists.append(artist)
-    return artists
+    next_cursor = None
+    if len(favorites) == 25:
+        next_cursor = encode_page_cursor(favorites[-1]['sort_value'], favorites[-1]['favorite_id'])
+    return (get_artists([favorite['artist_id'] for favorite in favorites]), next_cursor)
 
-def get_favorite_posts(account_id, offset, sort_field, sort_direction):
+def get_favorite_posts(account_id, offset, sort_field, sort_direction, page_cursor = None):
     if sort_field == 'id':
         sort_field = 'apf.id'
+    columns = [sort_field, 'apf.id']
 
+    keyset = decode_page_cursor(page_cursor, 2)
     with get_cursor() as cursor:
+        if keyset is None:
+            page_condition = 'true'
+            params = (account_id, offset,)
+        else:
+            page_condition = get_keyset_condition(columns, sort_direction)
+            params = (account_id, *keyset, 0,)
         query = f"""
-            SELECT post_id
+            SELECT post_id, {sort_field} as sort_value, apf.id as favorite_id
             FROM account_post_favorite apf
             INNER JOIN post p ON apf.post_id = p.id
-            WHERE account_id = %s
-            ORDER BY {sort_field} {sort_direction}
+            WHERE account_id = %s AND {page_condition}
+            ORDER BY {sort_field} {sort_direction}, apf.id {sort_direction}
             OFFSET %s
             LIMIT 25
         """
-        cursor.execute(query, (account_id, offset,))
+        cursor.execute(query, params)
         favorites = cursor.fetchall()
 
-    posts = []
-    for favorite in favorites:
-        post = get_post_for_listing(favorite['post_id'])
-        if post is not None:
-            posts.append(post)
-    return posts
+    # Posts without a published date sort last when ascending, where a row
+    # comparison would skip them, so that order stays on page numbers.
+    next_cursor = None
+    if len(favorites) == 25 and (sort_field == 'apf.id' or sort_direction == 'desc'):
+        next_cursor = encode_page_cursor(favorites[-1]['sort_value'], favorites[-1]['favorite_id'])
+    return (get_posts_for_listing([favorite['post_id'] for favorite in favorites]), next_cursor)
 
+@cached('favorite_post_count')
 def get_favorite_post_count(account_id, reload = False):
-    redis = get_redis()
-    key = f'favorite_post_count:{account_id}'
-    count = redis.get(key)
-    if count is None or reload:
-        with get_cursor() as cursor:
-            query = "SELECT count(*) as count FROM account_post_favorite WHERE account_id = %s"
-            cursor.execute(query, (account_id,))
-            count = cursor.fetchone()['count']
-        redis.set(key, serialize(count))
-    else:
-        count = deserialize(count)
-    return count
+    with get_cursor() as cursor:
+        query = "SELECT count(*) as count FROM account_post_favorite WHERE account_id = %s"
+        cursor.execute(query, (account_id,))
+        return cursor.fetchone()['count']
 
+@cached('favorite_artist_count')
 def get_favorite_artist_count(account_id, reload = False):
-    redis = get_redis()
-    key = f'favorite_artist_count:{account_id}'
-    count = redis.get(key)
-    if count is None or reload:
-        with get_cursor() as cursor:
-            query = "SELECT count(*) as count FROM account_artist_favorite WHERE account_id = %s"
-            cursor.execute(query, (account_id,))
-            count = cursor.fetchone()['count']
-        redis.set(key, serialize(count))
-    else:
-        count = deserialize(count)
-    return count
+    with get_cursor() as cursor:
+        query = "SELECT count(*) as count FROM account_artist_favorite WHERE account_id = %s"
+        cursor.execute(query, (account_id,))
+        return cursor.fetchone()['count']
 
+@cached('artist_favorited')
 def is_artist_favorited(account_id, artist_id, reload = False):
-    redis = get_redis()
-    key = f'artist_favorited:{account_id}:{artist_id}'
-    value = redis.get(key)
-    if value is None or reload:
-        with get_cursor() as cursor:
-            query = "SELECT 1 FROM account_artist_favorite WHERE account_id = %s AND artist_id = %s"
-            cursor.execute(query, (account_id, artist_id,))
-            value = cursor.fetchone() is not None
-        redis.set(key, serialize(value))
-    else:
-        value = deserialize(value)
-    return value
+    with get_cursor() as cursor:
+        query = "SELECT 1 FROM account_artist_favorite WHERE account_id = %s AND artist_id = %s"
+        cursor.execute(query, (account_id, artist_id,))
+        return cursor.fetchone() is not None
 
+@cached('post_favorited')
 def is_post_favorited(account_id, post_id, reload = False):
-    redis = get_redis()
-    key = f'post_favorited:{account_id}:{post_id}'
-    value = redis.get(key)
-    if value is None or reload:
-        with get_cursor() as cursor:
-            query = "SELECT 1 FROM account_post_favorite WHERE account_id = %s AND post_id = %s"
-            cursor.execute(query, (account_id, post_id,))
-            value = cursor.fetchone() is not None
-        redis.set(key, serialize(value))
-    else:
-        value = deserialize(value)
-    return value
+    with get_cursor() as cursor:
+        query = "SELECT 1 FROM account_post_favorite WHERE account_id = %s AND post_id = %s"
+        cursor.execute(query, (account_id, post_id,))
+        return cursor.fetchone() is not None
 
-def get_posts_by_favorited_artists(account_id, offset):
-    posts = []
+def get_posts_by_favorited_artists(account_id, offset, page_cursor = None):
+    keyset = decode_page_cursor(page_cursor, 2)
     with get_cursor() as cursor:
-        query = """
-            SELECT p.id as post_id
+        if keyset is None:
+            page_condition = 'true'
+            params = (account_id, offset,)
+        else:
+            page_condition = get_keyset_condition(['p.published_at', 'p.id'])
+            params = (account_id, *keyset, 0,)
+        query = f"""
+            SELECT p.id as post_id, p.published_at
             FROM post p
             INNER JOIN account_artist_favorite aaf
                 ON p.artist_id = aaf.artist_id
@@ -123,19 +119,19 @@ def get_posts_by_favorited_artists(account_id, offset):
                 aaf.account_id = %s
                 AND
                 p.is_import_finished = true
-            ORDER BY p.published_at DESC
+                AND
+                {page_condition}
+            ORDER BY p.published_at DESC, p.id DESC
             OFFSET %s
             LIMIT 25
         """
-        cursor.execute(query, (account_id, offset,))
+        cursor.execute(query, params)
         rows = cursor.fetchall()
 
-    for row in rows:
-        post = get_post_for_listing(row['post_id'])
-        if post is not None:
-            posts.append(post)
-
-    return posts
+    next_cursor = None
+    if len(rows) == 25:
+        next_cursor = encode_page_cursor(rows[-1]['published_at'], rows[-1]['post_id'])
+    return (get_posts_for_listing([row['post_id'] for row in rows]), next_cursor)
 
 def get_count_of_posts_by_favorite_artists(account_id):
      with get_cursor() as cursor:
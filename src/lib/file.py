@@ -1,9 +1,10 @@
 from flask import current_app
 
-from ..internals.database.database import get_cursor
-from ..utils.utils import is_mime_type_image, get_value, get_config
+from ..internals.database.database import get_cursor, get_conn
+from ..utils.utils import is_mime_type_image, get_value, get_config, get_variant_path, get_variant_objects
 from ..utils.object_storage import upload_file, upload_file_bytes
-from ..utils.image_processing import make_preview
+from ..utils.image_processing import make_post_file_derivatives, get_derivative_variants
+from .storage import delete_storage_objects, cancel_object_deletions
 
 def does_post_file_exist(file):
     query = "SELECT id FROM post_file WHERE sha256_hash = %s AND post_id = %s"
@@ -40,6 +41,8 @@ def insert_post_file(file):
     with get_cursor() as cursor:
         cursor.execute(query, (file['post_id'], file['sha256']))
         result = cursor.fetchone()
+        if result is not None:
+            cursor.execute('UPDATE post SET file_count = file_count + 1 WHERE id = %s', (file['post_id'],))
 
     if result is None:
         file_id = get_post_file_id(file['post_id'], file['sha256'])
@@ -50,48 +53,171 @@ def insert_post_file(file):
         return file_id
     return result['id']
 
-def mark_post_file_upload_finished(post_file_id, file):
-    with get_cursor() as cursor:
-        query = "UPDATE post_file SET is_upload_finished = true, name = %s, path = %s, mime_type = %s, is_inline = %s, inline_content = %s, file_size = %s, bucket_name = %s, comment = %s, sub_id = %s WHERE id = %s"
-        cursor.execute(query, (
-            file['name'],
-            file['path'],
-            file['mime_type'],
-            get_value(file, 'is_inline', False),
-            get_value(file, 'inline_content'),
-            get_value(file, 'size'),
-            get_config('S3_BUCKET_NAME'),
-            get_value(file, 'comment'),
-            get_value(file, 'sub_id'),
-            post_file_id,
-        ))
-
-def set_post_file_preview(post_file_id, preview_path):
+# Runs in the transaction that takes the post file's reference on
+# `stored_object`. Returns False if the post file was finished in the
+# meantime.
+def mark_post_file_upload_finished(cursor, post_file_id, file, stored_object):
+    query = "UPDATE post_file SET is_upload_finished = true, name = %s, path = %s, preview_path = %s, preview_formats = %s, mime_type = %s, is_inline = %s, inline_content = %s, file_size = %s, bucket_name = %s, comment = %s, sub_id = %s, stored_object_id = %s WHERE id = %s AND is_upload_finished = false"
+    cursor.execute(query, (
+        file['name'],
+        stored_object['path'],
+        stored_object['preview_path'],
+        stored_object['preview_formats'],
+        file['mime_type'],
+        get_value(file, 'is_inline', False),
+        get_value(file, 'inline_content'),
+        get_value(file, 'size'),
+        stored_object['bucket_name'],
+        get_value(file, 'comment'),
+        get_value(file, 'sub_id'),
+        stored_object['id'],
+        post_file_id,
+    ))
+    return cursor.rowcount > 0
+
+def set_post_file_preview(post_file_id, preview_path, preview_formats = None):
     with get_cursor() as cursor:
-        cursor.execute("UPDATE post_file SET preview_path = %s WHERE id = %s", (preview_path, post_file_id,))
+        cursor.execute("UPDATE post_file SET preview_path = %s, preview_formats = %s WHERE id = %s", (preview_path, preview_formats or [], post_file_id,))
 
 def insert_and_upload_post_file(file):
     post_file_id = insert_post_file(file)
     if not is_post_file_upload_finished(post_file_id):
-        make_and_upload_post_preview(file, post_file_id)
-        upload_file(file['path'], file['local_path'], file['mime_type'])
-        mark_post_file_upload_finished(post_file_id, file)
+        stored_object = reference_stored_object(post_file_id, file)
+        if stored_object is None and file['local_path'] is None:
+            raise Exception(f'Skipped download of {file["sha256"]} but it is no longer stored')
+        if stored_object is None:
+            (preview_path, preview_formats) = make_and_upload_post_preview(file, post_file_id)
+            upload_file(file['path'], file['local_path'], file['mime_type'])
+            bucket_name = get_config('S3_BUCKET_NAME')
+            objects = [(bucket_name, file['path'])] + get_variant_objects(bucket_name, preview_path, preview_formats)
+            cancel_object_deletions(objects)
+            stored_object = insert_stored_object(post_file_id, file, preview_path, preview_formats, bucket_name)
+            if stored_object['path'] != file['path']:
+                # Another import stored the same content first; keep theirs.
+                delete_storage_objects(objects, f'duplicate of {file["sha256"]}')
+        else:
+            current_app.logger.debug(f'Reusing stored object {stored_object["id"]} for file {post_file_id}')
     return post_file_id
 
 def make_and_upload_post_preview(file, post_file_id):
     post_id = file['post_id']
     if is_mime_type_image(file['mime_type']):
         preview_path = f'previews/{file["service"]}/{post_id}/{file["name"]}'
-        image = make_preview(file['local_path'])
+        derivatives = make_post_file_derivatives(file)
+        image = derivatives.get('preview')
         if image is None:
             current_app.logger.debug(f'Skipping preview for file {post_file_id} (mime: {file["mime_type"]})')
-            return
+            return (None, [])
 
         (preview_bytes, preview_mime) = image
+        preview_formats = []
+        for (format, variant_bytes, variant_mime) in get_derivative_variants(derivatives, 'preview'):
+            upload_file_bytes(get_variant_path(preview_path, format), variant_bytes, variant_mime)
+            preview_formats.append(format)
         upload_file_bytes(preview_path, preview_bytes, preview_mime)
-        set_post_file_preview(post_file_id, preview_path)
+        set_post_file_preview(post_file_id, preview_path, preview_formats)
+        return (preview_path, preview_formats)
+    return (None, [])
+
+# Uploaded content is stored once per sha256 and shared by every post_file
+# with that hash; `refcount` tracks how many post_file rows point at it.
+# Rows from before this table existed have no stored_object_id and own
+# their objects outright.
+#
+# A reference is taken in the same transaction that finishes the post file
+# holding it, so a failure in between can't leak one. If the post file was
+# already finished, nothing is counted.
+def reference_stored_object(post_file_id, file):
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        query = 'UPDATE stored_object SET refcount = refcount + 1 WHERE sha256_hash = %s RETURNING *'
+        cursor.execute(query, (file['sha256'],))
+        stored_object = cursor.fetchone()
+        if stored_object is not None and mark_post_file_upload_finished(cursor, post_file_id, file, stored_object):
+            conn.commit()
+        else:
+            conn.rollback()
+        cursor.close()
+    return stored_object
+
+def insert_stored_object(post_file_id, file, preview_path, preview_formats, bucket_name):
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        query = """
+            INSERT INTO stored_object (sha256_hash, path, preview_path, preview_formats, bucket_name, refcount)
+            VALUES (%s, %s, %s, %s, %s, 1)
+            ON CONFLICT (sha256_hash) DO UPDATE SET refcount = stored_object.refcount + 1
+            RETURNING *
+        """
+        cursor.execute(query, (file['sha256'], file['path'], preview_path, preview_formats, bucket_name,))
+        stored_object = cursor.fetchone()
+        if mark_post_file_upload_finished(cursor, post_file_id, file, stored_object):
+            conn.commit()
+        else:
+            conn.rollback()
+        cursor.close()
+    return stored_object
+
+def release_stored_objects(stored_object_ids):
+    stored_object_ids = [id for id in stored_object_ids if id is not None]
+    if len(stored_object_ids) == 0:
+        return []
+
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        query = """
+            UPDATE stored_object so
+            SET refcount = so.refcount - released.count
+            FROM (
+                SELECT id, count(*) count FROM unnest(%s::int[]) id GROUP BY id
+            ) released
+            WHERE so.id = released.id
+        """
+        cursor.execute(query, (stored_object_ids,))
+        cursor.execute('DELETE FROM stored_object WHERE id = ANY(%s) AND refcount <= 0 RETURNING path, preview_path, preview_formats, bucket_name', (stored_object_ids,))
+        unreferenced = cursor.fetchall()
+        conn.commit()
+    return unreferenced
+
+# Everything a set of posts keeps in object storage, gathered before their
+# rows are deleted: (bucket_name, path) pairs for thumbnails and files that
+# own their object, plus the stored objects whose references they hold.
+# With `sub_id` only that part of the post's files is collected.
+def get_post_storage(post_ids, sub_id = None):
+    storage = { 'objects': [], 'stored_object_ids': [] }
+    with get_cursor() as cursor:
+        query = 'SELECT bucket_name, path, preview_path, preview_formats, stored_object_id FROM post_file WHERE post_id = ANY(%s) AND (%s::varchar IS NULL OR sub_id = %s)'
+        cursor.execute(query, (list(post_ids), sub_id, sub_id,))
+        for row in cursor.fetchall():
+            if row['stored_object_id'] is not None:
+                storage['stored_object_ids'].append(row['stored_object_id'])
+            else:
+                storage['objects'].append((row['bucket_name'], row['path']))
+                storage['objects'].extend(get_variant_objects(row['bucket_name'], row['preview_path'], row['preview_formats']))
+
+        if sub_id is None:
+            cursor.execute('SELECT bucket_name, thumbnail_path, thumbnail_formats FROM post WHERE id = ANY(%s)', (list(post_ids),))
+            for row in cursor.fetchall():
+                storage['objects'].extend(get_variant_objects(row['bucket_name'], row['thumbnail_path'], row['thumbnail_formats']))
+    return storage
+
+def delete_post_storage(storage, label):
+    delete_storage_objects(storage['objects'], label)
+    delete_unreferenced_stored_objects(storage['stored_object_ids'])
+
+def delete_unreferenced_stored_objects(stored_object_ids):
+    objects = []
+    for stored_object in release_stored_objects(stored_object_ids):
+        objects.extend(get_variant_objects(stored_object['bucket_name'], stored_object['preview_path'], stored_object['preview_formats']))
+        objects.append((stored_object['bucket_name'], stored_object['path']))
+    delete_storage_objects(objects, 'stored objects')
 
 def clean_up_unfinished_files(post_id):
     with get_cursor() as cursor:
-        query = 'DELETE FROM post_file WHERE post_id = %s AND is_upload_finished = false'
-        cursor.execute(query, (post_id,))
+        query = """
+            WITH deleted AS (
+                DELETE FROM post_file WHERE post_id = %(post_id)s AND is_upload_finished = false RETURNING id
+            )
+            UPDATE post SET file_count = file_count - (SELECT count(*) FROM deleted) WHERE id = %(post_id)s
+        """
+        cursor.execute(query, {'post_id': post_id})
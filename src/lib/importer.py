@@ -1,33 +1,127 @@
 from flask import current_app
 
 import ujson
-import uwsgi
 import os
+import signal
+import socket
+import time
+import logging
+from threading import Event, get_ident
+
+from psycopg2.extras import Json, execute_values
 
 from ..importer.importers import patreon
 from ..importer.importers import fanbox
 from ..importer.importers import fantia
-from ..internals.database.database import get_cursor
+from ..internals.database.database import get_conn, get_cursor
 from ..utils.utils import sha256, get_value, get_config, get_import_id
 from ..utils.logger import log
 from ..utils.encryption import aes_encrypt_session_key, aes_decrypt_session_key
 from ..utils.flask_thread import FlaskThread
+from ..utils.import_lock import refresh_locks, release_held_locks, PostLocked
 from .account import get_account_stats
+from .storage import run_object_deletion_retries
+
+# Each importer module provides three phases:
+#   import_posts(import_id, key, account_id, queue_posts, checkpoints, state)
+#     walks the feeds and queues every post found as an `import_post_job`.
+#     `state` is a JSON-able dict kept for the last phase; the importer
+#     updates it in place and it is saved with every `queue_posts` call, so
+#     a restarted walk gets it back as it was (`queue_posts([])` only saves
+#     it). Each page is queued with `queue_posts(posts, walker, next, done)`,
+#     where `walker` names the campaign, fanclub or feed being walked and
+#     `next` is where it carries on (None after its last page). A restarted
+#     walk is passed the saved checkpoints, see `utils.import_checkpoint`.
+#     `done` lists (post id, artist id) for posts the importer found need no
+#     work, so they are only counted towards the import's artists.
+#   import_post(import_id, key, data) imports one queued post and returns the
+#     internal artist id it belongs to, if it got that far. It raises
+#     `PostLocked` if another job holds the post's import lock.
+#   finish_import(import_id, key, account_id, artist_ids, state) runs once,
+#     after the walk is done and every post job has finished.
+importers = {
+    'patreon': patreon,
+    'fanbox': fanbox,
+    'fantia': fantia
+}
+
+# `ongoing_import` and `import_post_job` are the import job queues. The web
+# app only inserts `ongoing_import` rows; import workers
+# (`python3 -m src.import_worker`) claim rows from either table with
+# SELECT ... FOR UPDATE SKIP LOCKED and hold a lease that a heartbeat keeps
+# extending while the job runs. If a worker dies its lease runs out and
+# another worker picks the job up again, up to IMPORT_MAX_ATTEMPTS times.
+#
+# An import goes through `status` 'enumerating' (one worker walks the feeds),
+# 'processing' (any number of workers import its posts) and 'finishing' (the
+# worker that finished the last post runs `finish_import`), and its row is
+# deleted once finished.
+lease_tables = ('ongoing_import', 'import_post_job')
 
-def import_posts(target, import_id, key, service, account_id, override_collision):
-    should_start_import = False
+def get_session_key(job):
     try:
-        (is_collision, ongoing_import_id) = mark_import_as_ongoing(import_id, key, service, account_id)
-        should_start_import = (not is_collision or override_collision) and ongoing_import_id
-        if should_start_import:
-            target(import_id, key, account_id)
-        else:
-            log(import_id, 'This session key is already being imported in the background')
+        return aes_decrypt_session_key(ujson.loads(job['encrypted_session_key']))
+    except:
+        current_app.logger.exception(f'Failed to decrypt session key for import {job["import_id"]}')
+        return None
+
+def run_enumeration(job):
+    import_id = job['import_id']
+    key = get_session_key(job)
+    if key is None:
+        mark_import_as_complete(job['id'])
+        return
+
+    if job['attempts'] > 1:
+        log(import_id, 'Restarting import after it was interrupted')
+    else:
+        log(import_id, f'Starting import. Your import id is {import_id}')
+
+    state = dict(job['import_state'] or {})
+
+    def queue_posts(posts, walker = None, next = None, done = ()):
+        queue_import_posts(job['id'], job['service'], posts, walker, next, done, state)
+
+    try:
+        importers[job['service']].import_posts(import_id, key, job['account_id'], queue_posts, job['checkpoint'] or {}, state)
+    except:
+        log(import_id, 'Internal error. Contact site staff on Telegram.', 'exception')
+    mark_import_enumerated(job['id'], state)
+
+def run_post_job(job):
+    import_job = get_ongoing_import(job['ongoing_import_id'])
+    if import_job is None:
+        return
+    key = get_session_key(import_job)
+    if key is None:
+        finish_post_job(job['id'], None)
+        return
+
+    artist_id = None
+    if job['attempts'] > get_config('IMPORT_MAX_ATTEMPTS', 3):
+        log(import_job['import_id'], f'Giving up on post {job["post_service_id"]} after it was interrupted too many times')
+    else:
+        try:
+            artist_id = importers[job['service']].import_post(import_job['import_id'], key, job['data'])
+        except PostLocked:
+            delay_post_job(job['id'])
+            return
+        except:
+            log(import_job['import_id'], f'Error while importing post {job["post_service_id"]}', 'exception')
+    finish_post_job(job['id'], artist_id)
+
+def run_finish(job):
+    import_id = job['import_id']
+    account_id = job['account_id']
+    key = get_session_key(job)
+    try:
+        if key is not None:
+            artist_ids = get_import_artist_ids(job['id'])
+            importers[job['service']].finish_import(import_id, key, account_id, artist_ids, job['import_state'] or {})
     except:
         log(import_id, 'Internal error. Contact site staff on Telegram.', 'exception')
     finally:
-        if should_start_import:
-            mark_import_as_complete(ongoing_import_id)
+        mark_import_as_complete(job['id'])
     if account_id is not None:
         get_account_stats(account_id, True)
         log(import_id, 'Check your import stats in your account page!')
@@ -53,59 +147,305 @@ def mark_import_as_complete(ongoing_import_id):
     except:
         current_app.logger.exception(f'Unable to remove ongoing import {ongoing_import_id}')
 
+def mark_import_enumerated(ongoing_import_id, state):
+    with get_cursor() as cursor:
+        query = """
+            UPDATE ongoing_import
+            SET status = 'processing', import_state = %s, leased_by = NULL, leased_until = NULL, attempts = 0
+            WHERE id = %s
+        """
+        cursor.execute(query, (Json(state), ongoing_import_id,))
+
+def get_ongoing_import(ongoing_import_id):
+    with get_cursor() as cursor:
+        cursor.execute('SELECT * FROM ongoing_import WHERE id = %s', (ongoing_import_id,))
+        return cursor.fetchone()
+
 def get_ongoing_import_id_by_hash(hash):
     query = 'SELECT id FROM ongoing_import WHERE session_key_sha256_hash = %s'
     with get_cursor() as cursor:
         cursor.execute(query, (hash,))
         return get_value(cursor.fetchone(), 'id')
 
-def get_ongoing_import_session_keys():
-    keys = []
-    rows = []
-    query = 'SELECT id, encrypted_session_key, import_id, service, account_id FROM ongoing_import'
-    with get_cursor() as cursor:
-        cursor.execute(query)
-        rows = cursor.fetchall()
-
-    for row in rows:
-        try:
-            data = ujson.loads(row['encrypted_session_key'])
-            key = aes_decrypt_session_key(data)
-            keys.append({
-                'key': key,
-                'import_id': row['import_id'],
-                'service': row['service'],
-                'account_id': row['account_id']
-            })
-        except:
-            current_app.logger.exception(f'Failed to decrypt session key: {data}')
-            mark_import_as_complete(row['id'])
-    return keys
-
 def is_import_ongoing(import_id):
     query = 'SELECT id FROM ongoing_import WHERE import_id = %s'
     with get_cursor() as cursor:
         cursor.execute(query, (import_id,))
         return cursor.fetchone() is not None
 
-def restart_stopped_imports():
-    current_app.logger.debug('Restarting stopped imports')
-    import_data = get_ongoing_import_session_keys()
-    for key in import_data:
-        log(key['import_id'], 'Restarting import due to server reboot')
-        start_import(key['service'], key['key'], key['import_id'], key['account_id'], True)
-
-def start_import(service, key, import_id, account_id, override_collision = False):
-    target = None
-    if service == 'patreon':
-        target = patreon.import_posts
-    elif service == 'fanbox':
-        target = fanbox.import_posts
-    elif service == 'fantia':
-        target = fantia.import_posts
-
-    if target and key:
-        log(import_id, f'Starting import. Your import id is {import_id}')
-        FlaskThread(target=import_posts, args=(target, import_id, key, service, account_id, override_collision,)).start()
-    else:
+def start_import(service, key, import_id, account_id):
+    if service not in importers or not key:
         log(import_id, f'Error starting import. Your import id was {import_id}')
+        return
+
+    (is_collision, _) = mark_import_as_ongoing(import_id, key, service, account_id)
+    if is_collision:
+        log(import_id, 'This session key is already being imported in the background')
+    else:
+        log(import_id, f'Import queued. Your import id is {import_id}')
+
+def queue_import_posts(ongoing_import_id, service, posts, walker = None, next = None, done = (), state = None):
+    # The page's posts, the walker's checkpoint after it and the import state
+    # are saved together, so a restarted walk never skips a page whose posts
+    # weren't queued. Only this walker's entry of `checkpoint` is replaced.
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        if len(posts) > 0:
+            query = 'INSERT INTO import_post_job (ongoing_import_id, service, post_service_id, data) VALUES %s ON CONFLICT DO NOTHING'
+            execute_values(cursor, query, [(ongoing_import_id, service, post_id, Json(data)) for (post_id, data) in posts])
+        if len(done) > 0:
+            query = """
+                INSERT INTO import_post_job (ongoing_import_id, service, post_service_id, data, artist_id, finished_at)
+                VALUES %s
+                ON CONFLICT DO NOTHING
+            """
+            template = "(%s, %s, %s, '{}', %s, (now() at time zone 'utc'))"
+            execute_values(cursor, query, [(ongoing_import_id, service, post_id, artist_id) for (post_id, artist_id) in done], template = template)
+        if walker is not None:
+            checkpoint = {
+                'next': next,
+                'last_post_id': get_last_post_id(posts, done),
+                'finished': next is None
+            }
+            query = "UPDATE ongoing_import SET checkpoint = coalesce(checkpoint, '{}'::jsonb) || jsonb_build_object(%s::text, %s::jsonb) WHERE id = %s"
+            cursor.execute(query, (walker, Json(checkpoint), ongoing_import_id,))
+        if state is not None:
+            cursor.execute('UPDATE ongoing_import SET import_state = %s WHERE id = %s', (Json(state), ongoing_import_id,))
+        conn.commit()
+        cursor.close()
+
+def get_last_post_id(posts, done):
+    post_ids = [post_id for (post_id, _) in posts] + [post_id for (post_id, _) in done]
+    return post_ids[-1] if len(post_ids) > 0 else None
+
+def finish_post_job(post_job_id, artist_id):
+    with get_cursor() as cursor:
+        query = """
+            UPDATE import_post_job
+            SET finished_at = (now() at time zone 'utc'), artist_id = %s, leased_by = NULL, leased_until = NULL
+            WHERE id = %s
+        """
+        cursor.execute(query, (artist_id, post_job_id,))
+
+# Puts a post job back without counting the attempt, leased to no one until
+# IMPORT_LOCK_RETRY_DELAY seconds from now so it isn't claimed straight away.
+def delay_post_job(post_job_id):
+    with get_cursor() as cursor:
+        query = """
+            UPDATE import_post_job
+            SET leased_by = NULL, leased_until = (now() at time zone 'utc') + make_interval(secs => %s), attempts = greatest(attempts - 1, 0)
+            WHERE id = %s
+        """
+        cursor.execute(query, (get_config('IMPORT_LOCK_RETRY_DELAY', 60), post_job_id,))
+
+def get_import_artist_ids(ongoing_import_id):
+    with get_cursor() as cursor:
+        cursor.execute('SELECT DISTINCT artist_id FROM import_post_job WHERE ongoing_import_id = %s AND artist_id IS NOT NULL', (ongoing_import_id,))
+        return [row['artist_id'] for row in cursor.fetchall()]
+
+# A service's limit counts live leases across all workers and both queues,
+# so it caps concurrent work per service for the whole deployment.
+def get_capacity_condition(alias):
+    return f"""
+        (%(limits)s::jsonb ->> {alias}.service) IS NULL
+        OR (
+            (SELECT count(*) FROM ongoing_import running WHERE running.service = {alias}.service AND running.leased_until >= (now() at time zone 'utc'))
+            + (SELECT count(*) FROM import_post_job running WHERE running.service = {alias}.service AND running.leased_until >= (now() at time zone 'utc'))
+        ) < (%(limits)s::jsonb ->> {alias}.service)::int
+    """
+
+def get_lease_params(worker_id):
+    return {
+        'worker_id': worker_id,
+        'lease_timeout': get_config('IMPORT_LEASE_TIMEOUT', 300),
+        'limits': Json(get_config('IMPORT_SERVICE_LIMITS', {}))
+    }
+
+def claim_post_job(worker_id):
+    query = f"""
+        UPDATE import_post_job
+        SET leased_by = %(worker_id)s, leased_until = (now() at time zone 'utc') + make_interval(secs => %(lease_timeout)s), attempts = attempts + 1
+        WHERE id = (
+            SELECT j.id
+            FROM import_post_job j
+            WHERE
+                j.finished_at IS NULL
+                AND (j.leased_until IS NULL OR j.leased_until < (now() at time zone 'utc'))
+                AND ({get_capacity_condition('j')})
+            ORDER BY j.id
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING *
+    """
+    with get_cursor() as cursor:
+        cursor.execute(query, get_lease_params(worker_id))
+        return cursor.fetchone()
+
+def claim_import(worker_id):
+    # Finishing imports are normally leased straight from `try_finish_import`;
+    # one only shows up here when the worker finishing it went away. The same
+    # goes for a processing import with no unfinished post jobs, whose worker
+    # went away before it could move the import on to finishing.
+    query = f"""
+        UPDATE ongoing_import
+        SET leased_by = %(worker_id)s, leased_until = (now() at time zone 'utc') + make_interval(secs => %(lease_timeout)s), attempts = attempts + 1
+        WHERE id = (
+            SELECT oi.id
+            FROM ongoing_import oi
+            WHERE
+                (
+                    oi.status IN ('enumerating', 'finishing')
+                    OR (
+                        oi.status = 'processing'
+                        AND NOT EXISTS (SELECT 1 FROM import_post_job j WHERE j.ongoing_import_id = oi.id AND j.finished_at IS NULL)
+                    )
+                )
+                AND (oi.leased_until IS NULL OR oi.leased_until < (now() at time zone 'utc'))
+                AND ({get_capacity_condition('oi')})
+            ORDER BY oi.id
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING *
+    """
+    with get_cursor() as cursor:
+        cursor.execute(query, get_lease_params(worker_id))
+        return cursor.fetchone()
+
+def try_finish_import(ongoing_import_id, worker_id):
+    # Every post job commits its own completion before calling this, so
+    # whichever worker finishes last is guaranteed to see no unfinished jobs;
+    # the status change makes sure only one of them moves on.
+    query = """
+        UPDATE ongoing_import
+        SET status = 'finishing', leased_by = %(worker_id)s, leased_until = (now() at time zone 'utc') + make_interval(secs => %(lease_timeout)s)
+        WHERE
+            id = %(id)s
+            AND status = 'processing'
+            AND NOT EXISTS (SELECT 1 FROM import_post_job WHERE ongoing_import_id = %(id)s AND finished_at IS NULL)
+        RETURNING *
+    """
+    with get_cursor() as cursor:
+        cursor.execute(query, { **get_lease_params(worker_id), 'id': ongoing_import_id })
+        return cursor.fetchone()
+
+def extend_lease(table, job_id, worker_id):
+    query = f"""
+        UPDATE {table}
+        SET leased_until = (now() at time zone 'utc') + make_interval(secs => %s)
+        WHERE id = %s AND leased_by = %s
+    """
+    with get_cursor() as cursor:
+        cursor.execute(query, (get_config('IMPORT_LEASE_TIMEOUT', 300), job_id, worker_id,))
+
+# The post import locks held by the abandoned jobs go too, or the jobs'
+# next owner would find their posts locked.
+def release_leases(worker_prefix):
+    try:
+        release_held_locks()
+    except:
+        current_app.logger.exception(f'Error releasing post import locks of {worker_prefix}')
+    with get_cursor() as cursor:
+        for table in lease_tables:
+            query = f"UPDATE {table} SET leased_by = NULL, leased_until = NULL, attempts = greatest(attempts - 1, 0) WHERE leased_by LIKE %s"
+            cursor.execute(query, (worker_prefix + '%',))
+
+# The heartbeat also refreshes the post import locks held by the job's
+# thread, so they don't go stale while the job is alive.
+def keep_leased(table, job_id, worker_id, thread_id, finished):
+    interval = get_config('IMPORT_LEASE_TIMEOUT', 300) / 3
+    while not finished.wait(interval):
+        try:
+            extend_lease(table, job_id, worker_id)
+            refresh_locks(thread_id)
+        except:
+            current_app.logger.exception(f'Error extending lease on {table} {job_id}')
+
+def run_leased(table, job, worker_id, target):
+    finished = Event()
+    FlaskThread(target = keep_leased, args = (table, job['id'], worker_id, get_ident(), finished), daemon = True).start()
+    try:
+        target(job)
+    finally:
+        finished.set()
+
+def finish_import_if_done(ongoing_import_id, worker_id):
+    finish_job = try_finish_import(ongoing_import_id, worker_id)
+    if finish_job is not None:
+        run_leased('ongoing_import', finish_job, worker_id, run_finish)
+
+def run_import_job(job, worker_id):
+    if job['status'] == 'finishing':
+        run_leased('ongoing_import', job, worker_id, run_finish)
+        return
+    if job['status'] == 'processing':
+        finish_import_if_done(job['id'], worker_id)
+        return
+
+    if job['attempts'] > get_config('IMPORT_MAX_ATTEMPTS', 3):
+        log(job['import_id'], 'Import was interrupted too many times. Please try again later')
+        mark_import_as_complete(job['id'])
+        return
+
+    run_leased('ongoing_import', job, worker_id, run_enumeration)
+    finish_import_if_done(job['id'], worker_id)
+
+def run_post_job_leased(job, worker_id):
+    run_leased('import_post_job', job, worker_id, run_post_job)
+    finish_import_if_done(job['ongoing_import_id'], worker_id)
+
+def run_import_worker_thread(worker_id, stopping):
+    poll_interval = get_config('IMPORT_POLL_INTERVAL', 5)
+    while not stopping.is_set():
+        # Posts of imports already underway go first, so imports finish in
+        # roughly the order they were started.
+        try:
+            post_job = claim_post_job(worker_id)
+            import_job = claim_import(worker_id) if post_job is None else None
+        except:
+            current_app.logger.exception('Error claiming import job')
+            (post_job, import_job) = (None, None)
+
+        if post_job is not None:
+            run_post_job_leased(post_job, worker_id)
+        elif import_job is not None:
+            current_app.logger.debug(f'[{worker_id}] Running import {import_job["import_id"]} ({import_job["service"]}, {import_job["status"]}, attempt {import_job["attempts"]})')
+            run_import_job(import_job, worker_id)
+        else:
+            stopping.wait(poll_interval)
+
+def run_import_worker():
+    worker_prefix = f'{socket.gethostname()}:{os.getpid()}:'
+    stopping = Event()
+    threads = []
+    for i in range(get_config('IMPORT_WORKER_CONCURRENCY', 4)):
+        thread = FlaskThread(target = run_import_worker_thread, args = (f'{worker_prefix}{i}', stopping), daemon = True)
+        thread.start()
+        threads.append(thread)
+
+    FlaskThread(target = run_object_deletion_retries, args = (stopping,), daemon = True).start()
+
+    def stop(signum, frame):
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while not stopping.is_set():
+        stopping.wait(1)
+
+    # The threads stop claiming once `stopping` is set; running jobs get
+    # IMPORT_SHUTDOWN_GRACE_PERIOD seconds to finish. Jobs still running
+    # after that are abandoned: their leases are handed back so another
+    # worker can start them straight away, and the process exits at once so
+    # they don't keep running next to their new owner.
+    current_app.logger.info(f'Import worker {worker_prefix} stopping')
+    deadline = time.monotonic() + get_config('IMPORT_SHUTDOWN_GRACE_PERIOD', 20)
+    for thread in threads:
+        thread.join(max(deadline - time.monotonic(), 0))
+    running = len([thread for thread in threads if thread.is_alive()])
+    if running > 0:
+        current_app.logger.info(f'Import worker {worker_prefix} abandoning {running} running jobs')
+        release_leases(worker_prefix)
+        logging.shutdown()
+        os._exit(0)
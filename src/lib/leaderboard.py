@@ -1,20 +1,13 @@
 from ..internals.database.database import get_cursor
 from ..utils.utils import get_value, take
-from ..internals.cache.redis import get_redis, serialize, deserialize
+from ..internals.cache.decorator import cached
 from ..lib.account import get_account_display_name, get_all_account_ids_with_imports
 
+@cached('top_25_account_scores')
 def get_leaderboard_display_data():
-    redis = get_redis()
-    key = 'top_25_account_scores_v3'
-    account_display_list = redis.get(key)
-    if account_display_list is None:
-        account_list = get_top_25_accounts()
-        account_display_list = []
-        for (account_id, score) in account_list:
-            account_display_list.append(make_account_display_data(account_id, score))
-        redis.set(key, serialize(account_display_list), ex = 3600 * 2)
-    else:
-        account_display_list = deserialize(account_display_list)
+    account_display_list = []
+    for (account_id, score) in get_top_25_accounts():
+        account_display_list.append(make_account_display_data(account_id, score))
     return account_display_list
 
 def make_account_display_data(account_id, score):
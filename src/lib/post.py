@@ -1,160 +1,158 @@
 from flask import current_app
 
 import datetime
+import hashlib
 import re
 
-from ..internals.cache.redis import get_redis, serialize, deserialize, delete_keys
+from ..internals.cache.redis import delete_key_list
+from ..internals.cache.decorator import cached, make_key, read_through, read_through_many, get_generation, bump_generation
 from ..internals.database.database import get_cursor, get_conn
-from ..utils.utils import get_value, is_mime_type_image, take, offset, get_config
-from ..utils.object_storage import upload_file_bytes, delete_file
-from ..utils.image_processing import make_thumbnail
-from .file import clean_up_unfinished_files
+from ..utils.utils import get_value, is_mime_type_image, take, offset, get_config, decode_page_cursor, get_keyset_condition, get_variant_path, get_variant_objects
+from ..utils.object_storage import upload_file_bytes
+from ..utils.image_processing import make_post_file_derivatives, get_derivative_variants
+from .file import clean_up_unfinished_files, get_post_storage, delete_post_storage
+from .storage import cancel_object_deletions
 from .artist import get_artist_post_count, get_artist, set_artist_last_post_imported_at_now
 
+# Every column of `post` but `search_vector`, which is only used to filter
+# and would otherwise be fetched and cached along with each post.
+post_columns = [
+    'id', 'service_id', 'artist_id', 'service', 'title', 'content', 'is_manual_upload',
+    'added_at', 'published_at', 'updated_at', 'is_import_finished',
+    'thumbnail_path', 'thumbnail_formats', 'bucket_name', 'file_count'
+]
+
+def get_post_columns(alias):
+    return ', '.join(f'{alias}.{column}' for column in post_columns)
+
+@cached('random_post_keys')
 def get_random_posts_keys(count, reload = False):
-    redis = get_redis()
-    key = f'random_post_keys:{count}'
-    post_keys = redis.get(key)
-    if post_keys is None or reload:
-        with get_cursor() as cursor:
-            query = "SELECT p.id id FROM post p INNER JOIN post_file pf ON p.id = pf.post_id WHERE p.is_import_finished = true ORDER BY random() LIMIT %s"
-            cursor.execute(query, (count,))
-            post_keys = [row['id'] for row in cursor.fetchall()]
-        redis.set(key, serialize(post_keys), ex = 900)
-    else:
-        post_keys = deserialize(post_keys)
-    return post_keys
+    with get_cursor() as cursor:
+        query = "SELECT p.id id FROM post p INNER JOIN post_file pf ON p.id = pf.post_id WHERE p.is_import_finished = true ORDER BY random() LIMIT %s"
+        cursor.execute(query, (count,))
+        return [row['id'] for row in cursor.fetchall()]
 
+@cached('post')
 def get_post(post_id, minimal = False, reload = False):
-    redis = get_redis()
-    key = f'post_v3:{post_id}:{minimal}'
-    post = redis.get(key)
-    if post is None or reload:
-        with get_cursor() as cursor:
-            query = 'SELECT p.*, a.service as service FROM post p INNER JOIN artist a ON a.id = p.artist_id WHERE p.id = %s AND is_import_finished = true'
-            cursor.execute(query, (post_id,))
-            post = cursor.fetchone()
-
-        if post is not None and not minimal:
-            post['files'] = get_post_files(post_id, reload)
-            post['embeds'] = get_post_embeds(post_id, reload)
-            post['extra_contents'] = get_post_extra_contents(post_id, reload)
-
-        redis.set(key, serialize(post))
-    else:
-        post = deserialize(post)
+    with get_cursor() as cursor:
+        query = f'SELECT {get_post_columns("p")}, a.service as service FROM post p INNER JOIN artist a ON a.id = p.artist_id WHERE p.id = %s AND is_import_finished = true'
+        cursor.execute(query, (post_id,))
+        post = cursor.fetchone()
+
+    if post is not None and not minimal:
+        post['files'] = get_post_files(post_id, reload)
+        post['embeds'] = get_post_embeds(post_id, reload)
+        post['extra_contents'] = get_post_extra_contents(post_id, reload)
     return post
 
+@cached('post_extra_contents')
 def get_post_extra_contents(post_id, reload = False):
-    redis = get_redis()
-    key = f'post_extra_contents:{post_id}'
-    contents = redis.get(key)
-    if contents is None or reload:
-        with get_cursor() as cursor:
-            query = 'SELECT title, content FROM extra_post_content WHERE post_id = %s ORDER BY id ASC'
-            cursor.execute(query, (post_id,))
-            contents = cursor.fetchall()
-        redis.set(key, serialize(contents))
-    else:
-        contents = deserialize(contents)
-    return contents
+    with get_cursor() as cursor:
+        query = 'SELECT title, content FROM extra_post_content WHERE post_id = %s ORDER BY id ASC'
+        cursor.execute(query, (post_id,))
+        return cursor.fetchall()
 
+@cached('post_files')
 def get_post_files(post_id, reload = False):
-    redis = get_redis()
-    key = f'post_files_v2:{post_id}'
-    files = redis.get(key)
-    if files is None or reload:
-        with get_cursor() as cursor:
-            query = 'SELECT * FROM post_file WHERE post_id = %s AND is_upload_finished = true ORDER BY id ASC'
-            cursor.execute(query, (post_id,))
-            files = cursor.fetchall()
-        redis.set(key, serialize(files))
-    else:
-        files = deserialize(files)
-    return files
+    with get_cursor() as cursor:
+        query = 'SELECT * FROM post_file WHERE post_id = %s AND is_upload_finished = true ORDER BY id ASC'
+        cursor.execute(query, (post_id,))
+        return cursor.fetchall()
 
+@cached('post_embeds')
 def get_post_embeds(post_id, reload = False):
-    redis = get_redis()
-    key = f'post_embeds:{post_id}'
-    embeds = redis.get(key)
-    if embeds is None or reload:
-        with get_cursor() as cursor:
-            query = 'SELECT * FROM post_embed WHERE post_id = %s ORDER BY id ASC'
-            cursor.execute(query, (post_id,))
-            embeds = cursor.fetchall()
-        redis.set(key, serialize(embeds))
-    else:
-        embeds = deserialize(embeds)
-    return embeds
-
-def get_artist_posts_for_listing(artist_id, offset, reload = False):
-    redis = get_redis()
-    key = f'artist_posts_for_list_v2:{artist_id}:{offset}'
-    posts = redis.get(key)
-    if posts is None or reload:
-        with get_cursor() as cursor:
-            query = """
-                SELECT p.*, count(pf.id) as file_count, a.service as service
-                FROM post p
-                INNER JOIN artist a ON p.artist_id = a.id
-                LEFT JOIN post_file pf ON p.id = pf.post_id
-                WHERE p.artist_id = %s AND p.is_import_finished = true
-                GROUP BY p.id, a.service
-                ORDER BY p.published_at DESC
-                OFFSET %s
-                LIMIT 25
-            """
-            cursor.execute(query, (artist_id, offset,))
-            posts = cursor.fetchall()
-        redis.set(key, serialize(posts))
-    else:
-        posts = deserialize(posts)
-    return posts
+    with get_cursor() as cursor:
+        query = 'SELECT * FROM post_embed WHERE post_id = %s ORDER BY id ASC'
+        cursor.execute(query, (post_id,))
+        return cursor.fetchall()
+
+@cached('artist_posts_for_list')
+def get_artist_posts_for_listing(artist_id, offset, page_cursor = None, reload = False):
+    keyset = decode_page_cursor(page_cursor, 2)
+    with get_cursor() as cursor:
+        if keyset is None:
+            page_condition = 'true'
+            params = (artist_id, offset,)
+        else:
+            page_condition = get_keyset_condition(['p.published_at', 'p.id'])
+            params = (artist_id, *keyset, 0,)
+        query = f"""
+            SELECT {get_post_columns('p')}
+            FROM post p
+            WHERE p.artist_id = %s AND p.is_import_finished = true AND {page_condition}
+            ORDER BY p.published_at DESC, p.id DESC
+            OFFSET %s
+            LIMIT 25
+        """
+        cursor.execute(query, params)
+        return cursor.fetchall()
 
+@cached('post_for_listing')
 def get_post_for_listing(post_id, reload = False):
-    redis = get_redis()
-    key = f'post_for_listing_v2:{post_id}'
-    post = redis.get(key)
-    if post is None or reload:
+    with get_cursor() as cursor:
+        query = f"""
+            SELECT {get_post_columns('p')}
+            FROM post p
+            WHERE p.id = %s AND p.is_import_finished = true
+        """
+        cursor.execute(query, (post_id,))
+        return cursor.fetchone()
+
+def get_posts_for_listing(post_ids):
+    def load(missing_ids):
         with get_cursor() as cursor:
-            query = """
-                SELECT p.*, count(pf.id) as file_count, a.service as service
+            query = f"""
+                SELECT {get_post_columns('p')}
                 FROM post p
-                INNER JOIN artist a ON p.artist_id = a.id
-                LEFT JOIN post_file pf ON p.id = pf.post_id
-                WHERE p.id = %s AND p.is_import_finished = true
-                GROUP BY p.id, a.service
+                WHERE p.id = ANY(%s) AND p.is_import_finished = true
             """
-            cursor.execute(query, (post_id,))
-            post = cursor.fetchone()
-        redis.set(key, serialize(post))
-    else:
-        post = deserialize(post)
-    return post
+            cursor.execute(query, ([int(post_id) for post_id in missing_ids],))
+            return { row['id']: row for row in cursor.fetchall() }
+
+    posts = read_through_many('post_for_listing', post_ids, load)
+    return [post for post in posts if post is not None]
 
-def get_artist_post_search_results(q, artist_id, o):
+def get_artist_post_search_results(q, artist_id, o, reload = False):
+    query_hash = hashlib.sha256(q.encode('utf-8')).hexdigest()
+    key = make_key('artist_post_search', artist_id, f'g{get_generation("artist", artist_id)}', query_hash, o)
+    return read_through('artist_post_search', key, lambda: search_artist_posts(q, artist_id, o), reload)
+
+def search_artist_posts(q, artist_id, o):
     with get_cursor() as cursor:
-        query = """
-            SELECT p.id post_id, count(pf.id) as file_count
-            FROM post p
-            INNER JOIN artist a ON p.artist_id = a.id
-            LEFT JOIN post_file pf ON p.id = pf.post_id
+        query = f"""
+            SELECT {get_post_columns('p')}, ts_rank(p.search_vector, q) as rank, count(*) OVER () as total_count
+            FROM post p, websearch_to_tsquery('english', %(query)s) q
             WHERE
-                a.id = %s
+                p.artist_id = %(artist_id)s
+                AND
+                p.is_import_finished = true
                 AND
-                to_tsvector('english', p.content || ' ' || p.title) @@ websearch_to_tsquery(%s)
-            GROUP BY p.id
-            ORDER BY p.published_at DESC
+                p.search_vector @@ q
+            ORDER BY rank DESC, p.published_at DESC, p.id DESC
+            OFFSET %(offset)s
+            LIMIT 25
         """
-        cursor.execute(query, (artist_id, q))
-        rows = cursor.fetchall()
+        cursor.execute(query, {'query': q, 'artist_id': artist_id, 'offset': o})
+        posts = cursor.fetchall()
 
-    posts = []
-    for row in take(25, offset(o, rows)):
-        post = get_post(row['post_id'])
-        post['file_count'] = row['file_count']
-        posts.append(post)
-    return (posts, len(rows))
+        if len(posts) == 0 and o > 0:
+            query = """
+                SELECT count(*) as count
+                FROM post p
+                WHERE
+                    p.artist_id = %s
+                    AND
+                    p.is_import_finished = true
+                    AND
+                    p.search_vector @@ websearch_to_tsquery('english', %s)
+            """
+            cursor.execute(query, (artist_id, q,))
+            return (posts, cursor.fetchone()['count'])
+
+    total_count = posts[0]['total_count'] if len(posts) > 0 else 0
+    for post in posts:
+        del post['total_count']
+    return (posts, total_count)
 
 def get_next_post_id(post_id, artist_id):
     with get_cursor() as cursor:
@@ -204,52 +202,39 @@ def get_previous_post_id(post_id, artist_id):
             return prev_post['id']
         return None
 
-def get_recent_posts_for_listing(offset):
+def get_recent_posts_for_listing(offset, page_cursor = None):
+    keyset = decode_page_cursor(page_cursor, 2)
     with get_cursor() as cursor:
-        query = """
-            SELECT
-                p.*,
-                (SELECT count(*) FROM post_file pf WHERE pf.post_id = p.id) as file_count,
-                (SELECT service FROM artist a WHERE a.id = p.artist_id) as service
-            FROM (
-                SELECT *
-                FROM post
-                WHERE is_import_finished = true
-                ORDER BY added_at DESC
-                OFFSET %s
-                LIMIT 25
-            ) p
+        if keyset is None:
+            page_condition = 'true'
+            params = (offset,)
+        else:
+            page_condition = get_keyset_condition(['added_at', 'id'])
+            params = (*keyset, 0,)
+        query = f"""
+            SELECT {get_post_columns('post')}
+            FROM post
+            WHERE is_import_finished = true AND {page_condition}
+            ORDER BY added_at DESC, id DESC
+            OFFSET %s
+            LIMIT 25
         """
-        cursor.execute(query, (offset,))
+        cursor.execute(query, params)
         return cursor.fetchall()
 
+@cached('total_post_count')
 def get_total_post_count(reload = False):
-    redis = get_redis()
-    key = f'total_post_count'
-    count = redis.get(key)
-    if count is None or reload:
-        with get_cursor() as cursor:
-            query = 'SELECT count(*) as count FROM post WHERE is_import_finished = true'
-            cursor.execute(query)
-            count = cursor.fetchone()['count']
-        redis.set(key, serialize(count), ex = 3600)
-    else:
-        count = deserialize(count)
-    return count
+    with get_cursor() as cursor:
+        query = 'SELECT count(*) as count FROM post WHERE is_import_finished = true'
+        cursor.execute(query)
+        return cursor.fetchone()['count']
 
+@cached('post_flagged')
 def is_post_flagged(post_id, reload = False):
-    redis = get_redis()
-    key = f'post_flagged:{post_id}'
-    flagged = redis.get(key)
-    if flagged is None or reload:
-        with get_cursor() as cursor:
-            query = 'SELECT 1 FROM reimport_flag WHERE post_id = %s'
-            cursor.execute(query, (post_id,))
-            flagged = cursor.fetchone() is not None
-        redis.set(key, serialize(flagged))
-    else:
-        flagged = deserialize(flagged)
-    return flagged
+    with get_cursor() as cursor:
+        query = 'SELECT 1 FROM reimport_flag WHERE post_id = %s'
+        cursor.execute(query, (post_id,))
+        return cursor.fetchone() is not None
 
 def mark_post_for_reimport(post_id):
     with get_cursor() as cursor:
@@ -260,8 +245,8 @@ def mark_post_for_reimport(post_id):
 def insert_post(post):
     result = None
     with get_cursor() as cursor:
-        query = "INSERT INTO post (service_id, artist_id, title, content, is_manual_upload, published_at, updated_at) VALUES (%s,%s,%s,%s,%s,%s,%s) ON CONFLICT DO NOTHING RETURNING id"
-        cursor.execute(query, (post['service_id'], post['artist_id'], post['title'], post['content'], post['is_manual_upload'],
+        query = "INSERT INTO post (service_id, artist_id, service, title, content, is_manual_upload, published_at, updated_at) VALUES (%s,%s,%s,%s,%s,%s,%s,%s) ON CONFLICT DO NOTHING RETURNING id"
+        cursor.execute(query, (post['service_id'], post['artist_id'], post['service'], post['title'], post['content'], post['is_manual_upload'],
             post['published_at'], post['updated_at'],))
         result = cursor.fetchone()
 
@@ -281,7 +266,7 @@ def set_post_import_not_finished(post_id, artist_id):
     get_post(post_id, True, True)
     get_post(post_id, False, True)
     get_post_for_listing(post_id, True)
-    delete_keys(f'artist_posts_for_list:{artist_id}:*')
+    bump_generation('artist', artist_id)
 
 def finalize_post_import(post_id, artist_id):
     with get_cursor() as cursor:
@@ -294,7 +279,7 @@ def finalize_post_import(post_id, artist_id):
     get_post(post_id, True, True)
     get_post(post_id, False, True)
     get_post_for_listing(post_id, True)
-    delete_keys(f'artist_posts_for_list:{artist_id}:*')
+    bump_generation('artist', artist_id)
     get_total_post_count(True)
     is_post_flagged(post_id, True)
 
@@ -324,17 +309,20 @@ def remove_post_if_flagged_for_reimport(service, service_artist_id, service_post
     if not flag_exists:
         return False
 
+    storage = get_post_storage([post_id])
     with get_conn() as conn:
         cursor = conn.cursor()
         cursor.execute('DELETE FROM post_file WHERE post_id = %s', (post_id,))
         cursor.execute('DELETE FROM post_embed WHERE post_id = %s', (post_id,))
         cursor.execute('DELETE FROM reimport_flag WHERE post_id = %s', (post_id,))
         cursor.execute('DELETE FROM extra_post_content WHERE post_id = %s', (post_id,))
-        cursor.execute('UPDATE post SET is_import_finished = false, thumbnail_path = NULL, bucket_name = NULL WHERE id = %s', (post_id,))
+        cursor.execute('UPDATE post SET is_import_finished = false, thumbnail_path = NULL, thumbnail_formats = DEFAULT, bucket_name = NULL, file_count = 0 WHERE id = %s RETURNING artist_id', (post_id,))
+        artist_id = cursor.fetchone()['artist_id']
         conn.commit()
         cursor.close()
 
-    remove_post_files(post_id)
+    delete_post_storage(storage, f'reimport of post {post_id}')
+    bump_generation('artist', artist_id)
 
     return True
 
@@ -343,9 +331,9 @@ def post_is_missing_thumbnail(post_id):
         cursor.execute("SELECT id FROM post WHERE id = %s AND thumbnail_path IS NULL", (post_id,))
         return cursor.fetchone() is not None
 
-def set_post_thumbnail(post_id, thumbnail_path):
+def set_post_thumbnail(post_id, thumbnail_path, thumbnail_formats = None):
     with get_cursor() as cursor:
-        cursor.execute("UPDATE post SET thumbnail_path = %s, bucket_name = %s WHERE id = %s", (thumbnail_path, get_config('S3_BUCKET_NAME'), post_id,))
+        cursor.execute("UPDATE post SET thumbnail_path = %s, thumbnail_formats = %s, bucket_name = %s WHERE id = %s", (thumbnail_path, thumbnail_formats or [], get_config('S3_BUCKET_NAME'), post_id,))
 
 def get_post_embed_by_content(post_id, subject, description, url):
     with get_cursor() as cursor:
@@ -367,40 +355,25 @@ def insert_post_embed(post_id, embed):
         cursor.execute(query, (post_id, embed['subject'], embed['description'], embed['url'], get_value(embed, 'sub_id')))
         return cursor.fetchone()['id']
 
-def remove_post_files(post_id):
-    paths = []
-    with get_cursor() as cursor:
-        query = 'SELECT * FROM post_file WHERE post_id = %s'
-        cursor.execute(query, (post_id,))
-        for row in cursor.fetchall():
-            preview = get_value(row, 'preview_path')
-            if preview is not None:
-                paths.append(preview)
-            path = get_value(row, 'path')
-            if path is not None:
-                paths.append(path)
-
-        query = 'SELECT thumbnail_path FROM post WHERE id = %s'
-        cursor.execute(query, (post_id,))
-        row = cursor.fetchone()
-        if row['thumbnail_path'] is not None:
-            paths.append(row['thumbnail_path'])
-
-    for path in paths:
-        delete_file(path)
-
 def set_and_upload_post_thumbnail_if_needed(file):
     post_id = file['post_id']
     if post_is_missing_thumbnail(post_id) and is_mime_type_image(file['mime_type']):
         thumbnail_path = f'thumbnails/{file["service"]}/{post_id}/thumbnail.jpeg'
-        image = make_thumbnail(file['local_path'])
+        derivatives = make_post_file_derivatives(file)
+        image = derivatives.get('thumbnail')
         if image is None:
             current_app.logger.debug(f'Skipping thumbnail for post {post_id} (mime: {file["mime_type"]})')
             return
 
         (thumbnail_bytes, thumbnail_mime) = image
+        thumbnail_formats = []
+        for (format, variant_bytes, variant_mime) in get_derivative_variants(derivatives, 'thumbnail'):
+            upload_file_bytes(get_variant_path(thumbnail_path, format), variant_bytes, variant_mime)
+            thumbnail_formats.append(format)
         upload_file_bytes(thumbnail_path, thumbnail_bytes, thumbnail_mime)
-        set_post_thumbnail(post_id, thumbnail_path)
+        bucket_name = get_config('S3_BUCKET_NAME')
+        cancel_object_deletions(get_variant_objects(bucket_name, thumbnail_path, thumbnail_formats))
+        set_post_thumbnail(post_id, thumbnail_path, thumbnail_formats)
 
 def set_post_content(post_id, content):
     with get_cursor() as cursor:
@@ -428,22 +401,17 @@ def insert_extra_post_content(post_id, content, title, sub_id = None):
 
 def delete_post(post_id):
     current_app.logger.debug(f'Deleting post {post_id}')
+    favorited_by = []
+    artist_id = None
     try:
         files = []
         with get_cursor() as cursor:
-            query = """
-                SELECT preview_path path, pf.bucket_name bucket_name FROM post_file pf INNER JOIN post p ON pf.post_id = p.id WHERE p.id = %(post_id)s
-                UNION ALL
-                SELECT path, pf.bucket_name bucket_name FROM post_file pf INNER JOIN post p ON pf.post_id = p.id WHERE p.id = %(post_id)s
-                UNION ALL
-                SELECT thumbnail_path path, bucket_name FROM post WHERE id = %(post_id)s
-            """
-            cursor.execute(query, {'post_id': post_id})
-            rows = cursor.fetchall()
+            cursor.execute('SELECT account_id FROM account_post_favorite WHERE post_id = %s', (post_id,))
+            favorited_by = [row['account_id'] for row in cursor.fetchall()]
+            cursor.execute('SELECT artist_id FROM post WHERE id = %s', (post_id,))
+            artist_id = get_value(cursor.fetchone(), 'artist_id')
 
-        for row in rows:
-            if row['path'] is not None:
-                delete_file(row['path'], row['bucket_name'])
+        storage = get_post_storage([post_id])
 
         with get_conn() as conn:
             cursor = conn.cursor()
@@ -455,11 +423,20 @@ def delete_post(post_id):
             cursor.execute('DELETE FROM extra_post_content WHERE post_id = %s', (post_id,))
             cursor.execute('DELETE FROM post WHERE id = %s', (post_id,))
             conn.commit()
+
+        delete_post_storage(storage, f'post {post_id}')
     except Exception:
         current_app.logger.exception(f'Error deleting artist {post_id}')
     current_app.logger.debug(f'Finished deleting artist {post_id}')
     get_total_post_count(True)
-    delete_keys('favorite_post_count:*')
+    if artist_id is not None:
+        get_artist_post_count(artist_id, True)
+        bump_generation('artist', artist_id)
+    delete_key_list(
+        [make_key('post_for_listing', post_id)]
+        + [make_key('favorite_post_count', account_id) for account_id in favorited_by]
+        + [make_key('post_favorited', account_id, post_id) for account_id in favorited_by]
+    )
 
 def add_post_to_dnp_list(post_id):
     with get_cursor() as cursor:
@@ -472,24 +449,53 @@ def is_post_dnp(service, artist_service_id, service_id):
         cursor.execute('SELECT * FROM banned_post WHERE service = %s AND artist_service_id = %s AND post_service_id = %s', (service, artist_service_id, service_id))
         return cursor.fetchone() is not None
 
-def remove_content_with_sub_id(post_id, sub_id):
-    files_to_delete = []
+# The import checks `is_post_dnp`, `is_artist_dnp`, `get_artist_id_from_service_data`,
+# `is_post_import_finished` and `is_flagged_for_reimport` for a whole page of
+# posts in one query, keyed by (artist_service_id, post_service_id).
+def get_post_import_statuses(service, keys):
+    if len(keys) == 0:
+        return {}
+    query = """
+        SELECT
+            k.artist_service_id,
+            k.post_service_id,
+            a.id AS artist_id,
+            EXISTS (
+                SELECT 1 FROM banned_post bp
+                WHERE bp.service = %(service)s AND bp.artist_service_id = k.artist_service_id AND bp.post_service_id = k.post_service_id
+            ) AS is_post_dnp,
+            EXISTS (
+                SELECT 1 FROM do_not_post_request dnp
+                WHERE dnp.service = %(service)s AND dnp.service_id = k.artist_service_id
+            ) AS is_artist_dnp,
+            coalesce(p.is_import_finished, false) AS is_import_finished,
+            EXISTS (SELECT 1 FROM reimport_flag rf WHERE rf.post_id = p.id) AS is_flagged_for_reimport
+        FROM unnest(%(artist_service_ids)s::varchar[], %(post_service_ids)s::varchar[]) k (artist_service_id, post_service_id)
+        LEFT JOIN artist a ON a.service = %(service)s AND a.service_id = k.artist_service_id
+        LEFT JOIN post p ON p.artist_id = a.id AND p.service_id = k.post_service_id
+    """
+    params = {
+        'service': service,
+        'artist_service_ids': [artist_service_id for (artist_service_id, _) in keys],
+        'post_service_ids': [post_service_id for (_, post_service_id) in keys]
+    }
+    with get_cursor() as cursor:
+        cursor.execute(query, params)
+        return { (row['artist_service_id'], row['post_service_id']): row for row in cursor.fetchall() }
 
+def remove_content_with_sub_id(post_id, sub_id):
+    storage = get_post_storage([post_id], sub_id)
     with get_conn() as conn:
         cursor = conn.cursor()
-        cursor.execute('SELECT preview_path, path, bucket_name FROM post_file WHERE post_id = %s AND sub_id = %s', (post_id, sub_id,))
-        for row in cursor.fetchall():
-            if row['preview_path'] is not None:
-                files_to_delete.append((row['preview_path'], row['bucket_name']))
-            files_to_delete.append((row['path'], row['bucket_name']))
         cursor.execute('DELETE FROM post_file WHERE post_id = %s AND sub_id = %s', (post_id, sub_id,))
+        cursor.execute('UPDATE post SET file_count = file_count - %s WHERE id = %s', (cursor.rowcount, post_id,))
         cursor.execute('DELETE FROM extra_post_content WHERE post_id = %s AND sub_id = %s', (post_id, sub_id,))
         cursor.execute('DELETE FROM post_embed WHERE post_id = %s AND sub_id = %s', (post_id, sub_id,))
         conn.commit()
 
-    for (path, bucket) in files_to_delete:
-        delete_file(path, bucket)
+    delete_post_storage(storage, f'post {post_id} sub_id {sub_id}')
     mark_sub_id_unprocessed(post_id, sub_id)
+    get_post_for_listing(post_id, True)
 
 def is_flagged_for_reimport(service, service_artist_id, service_post_id):
     post_id = get_post_id_from_service_data(service, service_artist_id, service_post_id)
@@ -1,37 +1,24 @@
 from ..internals.database.database import get_cursor
-from ..internals.cache.redis import get_redis, serialize, deserialize, delete_keys
+from ..internals.cache.redis import delete_tag
+from ..internals.cache.decorator import cached, get_tag
 
+@cached('request_list')
 def get_requests_for_list(offset):
-    redis = get_redis()
-    key = f'request_list:{offset}'
-    requests = redis.get(key)
-    if requests is None:
-        with get_cursor() as cursor:
-            query = 'SELECT * FROM request ORDER BY id DESC OFFSET %s LIMIT 25'
-            cursor.execute(query, (offset,))
-            requests = cursor.fetchall()
-        redis.set(key, serialize(requests))
-    else:
-        requests = deserialize(requests)
-    return requests
+    with get_cursor() as cursor:
+        query = 'SELECT * FROM request ORDER BY id DESC OFFSET %s LIMIT 25'
+        cursor.execute(query, (offset,))
+        return cursor.fetchall()
 
 def get_requests_search_results(status, service, sort_by, sort_direction, max_price):
     cursor = get_cursor()
     query = ''
 
+@cached('request')
 def get_request(request_id, reload = False):
-    redis = get_redis()
-    key = f'request:{request_id}'
-    request = redis.get(key)
-    if request is None or reload:
-        with get_cursor() as cursor:
-            query = 'SELECT * FROM request WHERE id = %s'
-            cursor.execute(query, (request_id,))
-            request = cursor.fetchall()
-        redis.set(key, serialize(request))
-    else:
-        request = deserialize(request)
-    return request
+    with get_cursor() as cursor:
+        query = 'SELECT * FROM request WHERE id = %s'
+        cursor.execute(query, (request_id,))
+        return cursor.fetchall()
 
 def ip_has_voted_for_request_already(request_id, ip_address):
     with get_cursor() as cursor:
@@ -46,7 +33,7 @@ def insert_request():
         if cursor.fetchone() is None:
             return False
 
-    delete_keys('request_list:*')
+    delete_tag(get_tag('request_list'))
     return True
 
 def insert_request_vote(request_id, ip_address):
@@ -60,16 +47,9 @@ def insert_request_vote(request_id, ip_address):
     if exists:
         get_request(request_id, True)
 
+@cached('request_count')
 def get_total_request_count(reload = False):
-    redis = get_redis()
-    key = f'request_count'
-    count = redis.get(key)
-    if count is None or reload:
-        with get_cursor() as cursor:
-            query = "SELECT count(*) as count FROM request WHERE status = 'open'"
-            cursor.execute(query)
-            count = cursor.fetchone()['count']
-        redis.set(key, serialize(count))
-    else:
-        count = deserialize(count)
-    return count
+    with get_cursor() as cursor:
+        query = "SELECT count(*) as count FROM request WHERE status = 'open'"
+        cursor.execute(query)
+        return cursor.fetchone()['count']
@@ -0,0 +1,84 @@
+from flask import current_app
+
+from psycopg2.extras import execute_values
+
+from ..internals.database.database import get_cursor
+from ..utils.object_storage import delete_files
+from ..utils.utils import get_config
+
+# Object deletions go through a queue table: the objects are written to it
+# before S3 is touched and only removed once S3 confirms, so a crash or a
+# failed batch leaves a row for `retry_object_deletions` instead of an
+# orphaned object. Import workers retry the queue every
+# OBJECT_DELETION_RETRY_INTERVAL seconds.
+RETRY_AFTER_MINUTES = 60
+
+def delete_storage_objects(objects, label = 'storage'):
+    objects = set((bucket_name, path) for (bucket_name, path) in objects if path is not None)
+    unknown_bucket = [path for (bucket_name, path) in objects if bucket_name is None]
+    if len(unknown_bucket) > 0:
+        current_app.logger.warning(f'[{label}] Not deleting {len(unknown_bucket)} objects with no bucket: {unknown_bucket[:10]}')
+    objects = [(bucket_name, path) for (bucket_name, path) in objects if bucket_name is not None]
+    if len(objects) == 0:
+        return
+
+    queue_object_deletions(objects)
+
+    def on_progress(done, total):
+        current_app.logger.debug(f'[{label}] Deleted {done}/{total} objects')
+
+    failed = delete_files(objects, on_progress)
+    if len(failed) > 0:
+        current_app.logger.warning(f'[{label}] Failed to delete {len(failed)} objects; they will be retried')
+    failed = set(failed)
+    finish_object_deletions([obj for obj in objects if obj not in failed], failed)
+
+def queue_object_deletions(objects):
+    with get_cursor() as cursor:
+        query = 'INSERT INTO object_deletion_queue (bucket_name, path) VALUES %s ON CONFLICT (bucket_name, path) DO NOTHING'
+        execute_values(cursor, query, objects, page_size = 1000)
+
+# A reimport writes to the same keys it queued for deletion when the post
+# was deleted; if that deletion failed, its queue row would later delete the
+# new objects, so they are taken off the queue once they're written.
+def cancel_object_deletions(objects):
+    if len(objects) == 0:
+        return
+    with get_cursor() as cursor:
+        query = 'DELETE FROM object_deletion_queue q USING (VALUES %s) c (bucket_name, path) WHERE q.bucket_name = c.bucket_name AND q.path = c.path'
+        execute_values(cursor, query, objects, page_size = 1000)
+
+def finish_object_deletions(deleted, failed):
+    with get_cursor() as cursor:
+        if len(deleted) > 0:
+            query = 'DELETE FROM object_deletion_queue q USING (VALUES %s) d (bucket_name, path) WHERE q.bucket_name = d.bucket_name AND q.path = d.path'
+            execute_values(cursor, query, deleted, page_size = 1000)
+        if len(failed) > 0:
+            query = 'UPDATE object_deletion_queue q SET attempts = q.attempts + 1 FROM (VALUES %s) f (bucket_name, path) WHERE q.bucket_name = f.bucket_name AND q.path = f.path'
+            execute_values(cursor, query, list(failed), page_size = 1000)
+
+def retry_object_deletions(limit = 10000):
+    with get_cursor() as cursor:
+        query = """
+            SELECT bucket_name, path
+            FROM object_deletion_queue
+            WHERE queued_at < (now() at time zone 'utc') - make_interval(mins => %s)
+            ORDER BY id
+            LIMIT %s
+        """
+        cursor.execute(query, (RETRY_AFTER_MINUTES, limit,))
+        objects = [(row['bucket_name'], row['path']) for row in cursor.fetchall()]
+
+    if len(objects) == 0:
+        return
+
+    failed = set(delete_files(objects))
+    finish_object_deletions([obj for obj in objects if obj not in failed], failed)
+    current_app.logger.debug(f'Retried {len(objects)} queued object deletions, {len(failed)} failed again')
+
+def run_object_deletion_retries(stopping):
+    while not stopping.wait(get_config('OBJECT_DELETION_RETRY_INTERVAL', 600)):
+        try:
+            retry_object_deletions()
+        except Exception:
+            current_app.logger.exception('Error retrying queued object deletions')
@@ -15,10 +15,10 @@ import src.internals.database.database as database
 import src.internals.cache.redis as redis
 from src.lib.ab_test import get_all_variants
 from src.lib.account import is_logged_in
-from src.utils.utils import url_is_for_non_logged_file_extension, render_page_data, get_config, get_value, make_template, cdn, has_preview, make_background_image, pluralify, url_encode, pluralify_word, service_to_display_name
-from src.utils.import_lock import clear_lock_table
+from src.utils.utils import url_is_for_non_logged_file_extension, render_page_data, get_config, get_value, make_template, cdn, has_preview, get_picture_sources, make_background_image, pluralify, url_encode, pluralify_word, service_to_display_name
 from src.utils.download import initialize_temp_download_directory
-from src.lib.importer import restart_stopped_imports
+from src.lib.artist_ranking import start_artist_ranking_job
+from src.lib.storage import retry_object_deletions
 from src.utils.startup_tasks import clear_startup_lock, run_startup_tasks
 
 from src.app.pages.root import root
@@ -59,6 +59,7 @@ app.jinja_env.globals.update(render_page_data=render_page_data)
 app.jinja_env.globals.update(get_value=get_value)
 app.jinja_env.globals.update(cdn=cdn)
 app.jinja_env.globals.update(has_preview=has_preview)
+app.jinja_env.globals.update(get_picture_sources=get_picture_sources)
 app.jinja_env.globals.update(make_background_image=make_background_image)
 app.jinja_env.globals.update(pluralify=pluralify)
 app.jinja_env.globals.update(pluralify_word=pluralify_word)
@@ -90,7 +91,8 @@ with app.app_context():
 def do_app_init_stuff():
     database.init()
     redis.init()
-    run_startup_tasks(clear_lock_table, restart_stopped_imports)
+    run_startup_tasks(retry_object_deletions)
+    start_artist_ranking_job()
 
 @app.before_request
 def do_request_init_stuff():
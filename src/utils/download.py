@@ -7,23 +7,40 @@ import hashlib
 import time
 import os
 import shutil
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+from urllib.parse import urlparse, urlencode, parse_qsl
 
 from .proxy import get_proxy
-from .utils import get_filename_from_cd, slugify, get_value, take, get_file_metadata, get_config, limit_string, sha256_file
+from .utils import get_filename_from_cd, slugify, get_value, take, get_metadata_from_first_bytes, get_config, limit_string, is_mime_type_image
+from ..internals.cache.redis import get_redis, serialize, deserialize
+from ..internals.database.database import get_cursor
+
+# Query parameters that only sign or expire a URL and change on every scan.
+SIGNATURE_PARAMS = {'token', 'token-time', 'token-hash', 'expires', 'signature', 'key-pair-id', 'policy', 'hash'}
+UPSTREAM_FILE_TTL = 2592000
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.avif', '.tif', '.tiff'}
 
 def fetch_file_and_data(url, **kwargs):
     file_data = fetch_file_data(url, **kwargs)
     if file_data is None:
         return None
 
-    (mime_type, extension) = get_file_metadata(file_data['local_path'])
+    known_file = get_value(file_data, 'known_file')
+    if known_file is not None:
+        current_app.logger.debug(f'Skipping download of {url}; already stored as {known_file["sha256"]}')
+        return known_file
+
+    (mime_type, extension) = (file_data['mime_type'], file_data['extension'])
 
     filename = get_value(file_data['headers'], 'x-amz-meta-original-filename')
     if filename is None:
         filename = get_filename_from_cd(get_value(file_data['headers'], 'content-disposition')) or (take(32, file_data['sha256']) + extension)
     filename = limit_string(slugify(filename), 255)
 
-    return {
+    result = {
         'local_path': file_data['local_path'],
         'name': filename,
         'mime_type': mime_type,
@@ -31,39 +48,157 @@ def fetch_file_and_data(url, **kwargs):
         'sha256': file_data['sha256'],
         'size': file_data['size'],
     }
+    if file_data['identity'] is not None and not is_mime_type_image(mime_type):
+        remember_upstream_file(file_data['identity'], result)
+    return result
+
+# Re-scans fetch the same upstream files over and over. The response headers
+# give the ETag, length and original filename before the body is read;
+# together with the URL minus its signature they identify a file we may
+# already have stored, in which case the body is never downloaded. Images
+# are always downloaded because thumbnails are rendered from them.
+def get_upstream_file_identity(url, headers):
+    if is_image_url(url) or is_mime_type_image(get_value(headers, 'content-type', '')):
+        return None
+
+    etag = get_value(headers, 'etag')
+    content_length = get_value(headers, 'content-length')
+    if etag is None or content_length is None:
+        return None
+
+    parsed_url = urlparse(url)
+    query = urlencode([(key, value) for (key, value) in parse_qsl(parsed_url.query) if key.lower() not in SIGNATURE_PARAMS and not key.lower().startswith('x-amz-')])
+    identity = '\n'.join([
+        parsed_url._replace(query = query, fragment = '').geturl(),
+        etag,
+        content_length,
+        get_value(headers, 'x-amz-meta-original-filename', '')
+    ])
+    return hashlib.sha256(identity.encode('utf-8')).hexdigest()
+
+def is_image_url(url):
+    return os.path.splitext(urlparse(url).path)[1].lower() in IMAGE_EXTENSIONS
+
+def get_known_upstream_file(identity):
+    value = get_redis().get(f'upstream_file:{identity}')
+    if value is None:
+        return None
+
+    known_file = deserialize(value)
+    if is_mime_type_image(known_file['mime_type']):
+        return None
+    with get_cursor() as cursor:
+        cursor.execute('SELECT 1 FROM stored_object WHERE sha256_hash = %s', (known_file['sha256'],))
+        if cursor.fetchone() is None:
+            return None
 
+    known_file['local_path'] = None
+    return known_file
+
+def remember_upstream_file(identity, file_data):
+    known_file = { key: file_data[key] for key in ['name', 'mime_type', 'extension', 'sha256', 'size'] }
+    get_redis().set(f'upstream_file:{identity}', serialize(known_file), ex = UPSTREAM_FILE_TTL)
+
+host_semaphores = {}
+host_semaphores_lock = Lock()
+
+def get_host_semaphore(url):
+    host = urlparse(url).netloc
+    with host_semaphores_lock:
+        if host not in host_semaphores:
+            host_semaphores[host] = BoundedSemaphore(get_config('DOWNLOAD_CONCURRENCY_PER_HOST', 4))
+        return host_semaphores[host]
+
+# Downloads the files of a post in parallel and yields the results in the
+# order of `downloads`, so callers can thumbnail and upload one file while
+# the ones after it are still being fetched. At most DOWNLOAD_CONCURRENCY
+# downloads are in flight or waiting to be consumed, so a post with many
+# large files never fills the temp directory ahead of the consumer. Each
+# download is a dict with a `url` and optional `kwargs` for
+# `fetch_file_and_data`; with `ignore_errors` set, a failed download yields
+# None instead of raising. Concurrency is also capped, across all imports in
+# the process, per host (see `fetch_file_data`).
+def fetch_files_and_data(downloads, resource_id):
+    app = current_app._get_current_object()
+
+    def fetch(download):
+        with app.app_context():
+            try:
+                return fetch_file_and_data(download['url'], resource_id = resource_id, **get_value(download, 'kwargs', {}))
+            except Exception:
+                if get_value(download, 'ignore_errors'):
+                    return None
+                raise
+
+    concurrency = get_config('DOWNLOAD_CONCURRENCY', 8)
+    executor = ThreadPoolExecutor(max_workers = concurrency)
+    pending = deque()
+    remaining = iter(downloads)
+    try:
+        for download in itertools.islice(remaining, concurrency):
+            pending.append(executor.submit(fetch, download))
+        while len(pending) > 0:
+            result = pending.popleft().result()
+            for download in itertools.islice(remaining, 1):
+                pending.append(executor.submit(fetch, download))
+            yield result
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait = True)
+        # Files fetched for results the caller never took would otherwise
+        # sit in the temp directory until the whole post is cleaned up.
+        for future in pending:
+            if not future.cancelled() and future.exception() is None:
+                remove_local_file(future.result())
+
+def remove_local_file(file_data):
+    local_path = get_value(file_data, 'local_path')
+    if local_path is not None and os.path.exists(local_path):
+        os.remove(local_path)
+
+# The host's download slot is only held for one attempt at a time, so a
+# host that keeps failing doesn't hold up its other downloads while this one
+# waits to retry.
 def fetch_file_data(url, **kwargs):
     attempts = kwargs.pop('attempts', 10)
     resource_id = kwargs.pop('resource_id', '')
     try:
-        r = requests.get(url, stream = True, proxies = get_proxy(), **kwargs)
-        if r.status_code in [400, 401, 403, 404]:
-            return None
+        with get_host_semaphore(url):
+            r = requests.get(url, stream = True, proxies = get_proxy(), **kwargs)
+            if r.status_code in [400, 401, 403, 404]:
+                return None
 
-        r.raise_for_status()
-        r.raw.read = functools.partial(r.raw.read, decode_content = True)
+            r.raise_for_status()
+            r.raw.read = functools.partial(r.raw.read, decode_content = True)
 
-        if 'text/html' in get_value(r.headers, 'content-type'):
-            return None
+            if 'text/html' in get_value(r.headers, 'content-type'):
+                return None
+
+            identity = get_upstream_file_identity(url, r.headers)
+            known_file = get_known_upstream_file(identity) if identity is not None else None
+            if known_file is not None:
+                r.close()
+                return { 'headers': r.headers, 'identity': identity, 'known_file': known_file }
 
-        file_size = None
-        local_path = os.path.join(get_config('TEMP_STORAGE_DIR'), resource_id)
-        local_file = os.path.join(local_path, str(uuid.uuid4()))
-        create_dir_if_not_exists(local_path)
-        with open(local_file, 'wb') as f:
-            shutil.copyfileobj(r.raw, f)
-            file_size = f.tell()
+            local_path = os.path.join(get_config('TEMP_STORAGE_DIR'), resource_id)
+            local_file = os.path.join(local_path, str(uuid.uuid4()))
+            create_dir_if_not_exists(local_path)
+            (file_size, sha256, first_bytes) = stream_to_file(r.raw, local_file)
 
         content_length = get_value(r.headers, 'content-length')
         if content_length is not None and file_size != int(content_length):
             raise Exception(f'File size is not the same as the content-length header says it should be ({content_length} bytes vs actual {file_size} bytes)')
 
-        sha256 = sha256_file(local_file)
+        (mime_type, extension) = get_metadata_from_first_bytes(first_bytes)
         return {
             'headers': r.headers,
+            'identity': identity,
             'local_path': local_file,
             'sha256': sha256,
             'size': file_size,
+            'mime_type': mime_type,
+            'extension': extension,
         }
     except:
         if attempts > 1:
@@ -74,6 +209,21 @@ def fetch_file_data(url, **kwargs):
             current_app.logger.exception(f'Error fetching url: {url}. All attempts exhausted.')
             raise
 
+# Writes the response to disk while hashing it, counting its bytes and
+# keeping the first 2KB for MIME sniffing, so the file is never read back.
+def stream_to_file(source, local_file, chunk_size = 262144):
+    h = hashlib.sha256()
+    file_size = 0
+    first_bytes = b''
+    with open(local_file, 'wb') as f:
+        for chunk in iter(lambda: source.read(chunk_size), b''):
+            h.update(chunk)
+            f.write(chunk)
+            file_size += len(chunk)
+            if len(first_bytes) < 2048:
+                first_bytes += chunk[:2048 - len(first_bytes)]
+    return (file_size, h.hexdigest(), first_bytes)
+
 def initialize_temp_download_directory():
     directory = get_config('TEMP_STORAGE_DIR')
     if os.path.isdir(directory):
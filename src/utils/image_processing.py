@@ -1,30 +1,201 @@
 from PIL import Image
 import io
+import os
+import sys
+import shutil
+import resource
+import multiprocessing
+from threading import Lock
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
-def make_thumbnail(file_path, size = (225, 225)):
-    return resize_image(file_path, size)
+from flask import current_app
 
-def make_preview(file_path, size = (500, 500)):
-    return resize_image(file_path, size)
+from .utils import get_config, VARIANT_MIME_TYPES
+
+DERIVATIVE_SIZES = {
+    'thumbnail': (225, 225),
+    'preview': (500, 500),
+    'banner': (650, 650),
+    'icon': (100, 100)
+}
+
+# Resizing is CPU bound and would hold the GIL in the import threads that
+# share a uWSGI worker with request handling, so it runs in a small process
+# pool per worker. Every derivative of a file is produced from one decode.
+# Pool processes run under an address space limit and refuse to decode
+# images above a pixel budget, so a huge upload fails one render instead of
+# getting a process OOM-killed.
+pool_lock = Lock()
+pool_cache = {}
+
+def make_thumbnail(file_path):
+    return make_derivatives(file_path, 'thumbnail').get('thumbnail')
+
+def make_preview(file_path):
+    return make_derivatives(file_path, 'preview').get('preview')
 
 def make_banner(file_path):
-    return resize_image(file_path, (650, 650))
+    return make_derivatives(file_path, 'banner').get('banner')
 
 def make_icon(file_path):
-    return resize_image(file_path, (100, 100))
+    return make_derivatives(file_path, 'icon').get('icon')
+
+def make_post_file_derivatives(file):
+    # The thumbnail and preview of a post file are made together and kept on
+    # the file dict, so whichever is asked for first pays for the decode.
+    if 'derivatives' not in file:
+        if file['local_path'] is None:
+            file['derivatives'] = {}
+        else:
+            formats = get_config('IMAGE_VARIANT_FORMATS', ['webp'])
+            file['derivatives'] = make_derivatives(file['local_path'], 'thumbnail', 'preview', formats = formats)
+    return file['derivatives']
+
+def get_derivative_variants(derivatives, name):
+    # [(format, bytes, mime_type)] for the variants rendered of `name`.
+    variants = []
+    for format in VARIANT_MIME_TYPES:
+        variant = derivatives.get(f'{name}.{format}')
+        if variant is not None:
+            variants.append((format, variant[0], variant[1]))
+    return variants
 
-def resize_image(file_path, size, quality = 80):
+def make_derivatives(file_path, *names, formats = ()):
+    sizes = { name: DERIVATIVE_SIZES[name] for name in names }
+    formats = [format for format in formats if format in VARIANT_MIME_TYPES]
+    max_pixels = get_config('IMAGE_MAX_PIXELS', 64000000)
+    try:
+        (derivatives, stats) = get_pool().submit(render_derivatives, file_path, sizes, formats, max_pixels).result()
+    except BrokenProcessPool:
+        current_app.logger.exception(f'Image processing pool died while processing {file_path}')
+        reset_pool()
+        return {}
+
+    if stats['rejected'] is not None:
+        current_app.logger.warning(f'Not making {", ".join(sizes)} for {file_path} ({stats["size"]}): {stats["rejected"]}')
+    elif len(derivatives) > 0:
+        current_app.logger.debug(
+            f'Rendered {", ".join(derivatives)} for {file_path}: {stats["size"]} decoded at {stats["decoded_size"]}, '
+            f'{stats["image_bytes"] // 1024} KB decoded, peak RSS {stats["peak_rss"] // 1024} KB'
+        )
+    return derivatives
+
+def get_pool():
+    pid = os.getpid()
+    pool = pool_cache.get(pid)
+    if pool is not None:
+        return pool
+
+    with pool_lock:
+        if pid not in pool_cache:
+            pool_cache.clear()
+            # Forking a threaded uWSGI worker can copy held locks into the
+            # child, so pool processes are spawned from a clean interpreter.
+            context = multiprocessing.get_context('spawn')
+            context.set_executable(get_python_executable())
+            pool_cache[pid] = ProcessPoolExecutor(
+                max_workers = get_config('IMAGE_PROCESSING_WORKERS', 2),
+                mp_context = context,
+                initializer = limit_memory,
+                initargs = (get_config('IMAGE_PROCESSING_MEMORY_LIMIT', 2 * 1024 * 1024 * 1024),)
+            )
+        return pool_cache[pid]
+
+def reset_pool():
+    with pool_lock:
+        pool = pool_cache.pop(os.getpid(), None)
+    if pool is not None:
+        pool.shutdown(wait = False)
+
+def get_python_executable():
+    # Under uWSGI sys.executable is the uwsgi binary, not an interpreter.
+    if os.path.basename(sys.executable).startswith('python'):
+        return sys.executable
+    return get_config('IMAGE_PROCESSING_PYTHON', shutil.which('python3'))
+
+def limit_memory(limit):
+    if limit is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+def reset_peak_rss():
+    # Resets VmHWM so it measures this render only (Linux 4.0+).
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def get_peak_rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def render_derivatives(file_path, sizes, formats = (), max_pixels = None, quality = 80):
+    largest = max(sizes.values())
+    stats = { 'size': None, 'decoded_size': None, 'image_bytes': 0, 'peak_rss': 0, 'rejected': None }
+    reset_peak_rss()
     try:
         with Image.open(file_path) as image:
-            image.verify()
-    except:
-        return None
-
-    with Image.open(file_path) as image:
-        image = image.convert('RGB')
-        image.thumbnail(size)
-
-        img_byte_arr = io.BytesIO()
-        image.save(img_byte_arr, format = 'JPEG', quality = quality)
-        img_byte_arr.seek(0)
-        return (img_byte_arr.read(), 'image/jpeg')
+            stats['size'] = image.size
+            if image.format == 'JPEG':
+                # Let libjpeg decode at the smallest 1/2, 1/4 or 1/8 scale that
+                # still covers the largest derivative.
+                image.draft('RGB', largest)
+            # Other formats have no reduced decode in Pillow, so anything
+            # still over budget at this point would be decoded in full.
+            (width, height) = image.size
+            if max_pixels is not None and width * height > max_pixels:
+                stats['rejected'] = f'{width * height} pixels to decode is over the budget of {max_pixels}'
+                stats['peak_rss'] = get_peak_rss()
+                return ({}, stats)
+            image.load()
+            stats['decoded_size'] = image.size
+            stats['image_bytes'] = width * height * len(image.getbands())
+
+            # Shrink by a whole factor before converting so the converted
+            # copy is not made at full resolution. Palette modes can't be
+            # reduced directly.
+            factor = min(width // largest[0], height // largest[1]) // 2
+            if factor >= 2 and image.mode not in ('P', 'PA', '1'):
+                image = image.reduce(factor)
+            # Transparency is kept for the variants; the JPEG drops it.
+            has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+            base = image.convert('RGBA' if has_alpha else 'RGB')
+
+        if len(formats) > 0:
+            Image.init()
+        base.thumbnail(largest, reducing_gap = 3.0)
+        derivatives = {}
+        for (name, size) in sizes.items():
+            derivative = base.copy() if size != largest else base
+            derivative.thumbnail(size, reducing_gap = 3.0)
+
+            img_byte_arr = io.BytesIO()
+            derivative.convert('RGB').save(img_byte_arr, format = 'JPEG', quality = quality)
+            derivatives[name] = (img_byte_arr.getvalue(), 'image/jpeg')
+
+            for format in formats:
+                # AVIF needs a Pillow build with an AVIF encoder; skip it otherwise.
+                if format.upper() not in Image.SAVE:
+                    continue
+                img_byte_arr = io.BytesIO()
+                derivative.save(img_byte_arr, format = format.upper(), quality = quality)
+                variant_bytes = img_byte_arr.getvalue()
+                if len(variant_bytes) < len(derivatives[name][0]):
+                    derivatives[f'{name}.{format}'] = (variant_bytes, VARIANT_MIME_TYPES[format])
+    except MemoryError:
+        stats['rejected'] = 'over the image processing memory limit'
+        stats['peak_rss'] = get_peak_rss()
+        return ({}, stats)
+    except Exception:
+        stats['peak_rss'] = get_peak_rss()
+        return ({}, stats)
+
+    stats['peak_rss'] = get_peak_rss()
+    return (derivatives, stats)
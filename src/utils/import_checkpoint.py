@@ -0,0 +1,22 @@
+from .utils import get_value
+from .logger import log
+
+# An import's `checkpoint` holds one entry per walker (a campaign, fanclub
+# or feed), written by `queue_import_posts` with every page queued:
+#   { 'next': where to carry on, 'last_post_id': last post queued, 'finished': bool }
+# `next` is whatever the importer pages by: a page url or a page number.
+def get_walker_checkpoint(import_id, checkpoints, walker, start):
+    # Where a walker should start: `start` for one that was never walked,
+    # where it stopped for one that was interrupted, and None for one whose
+    # last page was already queued.
+    checkpoint = get_value(checkpoints, walker)
+    if checkpoint is None:
+        return start
+    if checkpoint['finished']:
+        log(import_id, f'Skipping {walker}; it was already scanned')
+        return None
+    if checkpoint['last_post_id'] is not None:
+        log(import_id, f'Resuming {walker} after post {checkpoint["last_post_id"]}')
+    else:
+        log(import_id, f'Resuming {walker}')
+    return checkpoint['next']
@@ -1,25 +1,78 @@
 from flask import current_app
 
+import uuid
+from threading import Lock, get_ident
+
 from ..internals.database.database import get_cursor
+from .utils import get_config
+
+# Locks are taken by import workers that can die without releasing them, so
+# a lock not refreshed for IMPORT_LEASE_TIMEOUT seconds (the same timeout
+# after which the dead worker's job is handed out again) can be taken over.
+# Every take writes a new token and a lock is only released or refreshed
+# with the token it was taken with, so a holder whose lock was taken over
+# can't drop the new owner's lock. Locks are registered under the thread
+# that took them so the job heartbeat of that thread can keep them fresh
+# (`refresh_locks`) however long the post takes.
+held_locks_lock = Lock()
+held_locks = {}
+
+# Raised by an importer whose post is locked by another job, so the post job
+# is retried later instead of being finished without the post.
+class PostLocked(Exception):
+    pass
 
 def take_lock(service, artist_service_id, post_service_id):
-    query = 'INSERT INTO post_import_lock (service, artist_service_id, post_service_id) VALUES (%s, %s, %s) ON CONFLICT DO NOTHING RETURNING id'
+    token = str(uuid.uuid4())
+    query = """
+        INSERT INTO post_import_lock (service, artist_service_id, post_service_id, token) VALUES (%s, %s, %s, %s)
+        ON CONFLICT (service, artist_service_id, post_service_id) DO
+            UPDATE SET taken_at = (now() at time zone 'utc'), token = EXCLUDED.token
+            WHERE post_import_lock.taken_at < (now() at time zone 'utc') - make_interval(secs => %s)
+        RETURNING id
+    """
     with get_cursor() as cursor:
-        cursor.execute(query, (service, artist_service_id, post_service_id,))
+        cursor.execute(query, (service, artist_service_id, post_service_id, token, get_config('IMPORT_LEASE_TIMEOUT', 300),))
         result = cursor.fetchone()
         if result is None:
             return None
-        return result['id']
 
-def release_lock(lock_id):
+    lock = (result['id'], token)
+    with held_locks_lock:
+        held_locks.setdefault(get_ident(), set()).add(lock)
+    return lock
+
+def release_lock(lock):
+    (lock_id, token) = lock
+    with held_locks_lock:
+        held_locks.get(get_ident(), set()).discard(lock)
     try:
-        query = 'DELETE FROM post_import_lock WHERE id = %s'
+        query = 'DELETE FROM post_import_lock WHERE id = %s AND token = %s'
         with get_cursor() as cursor:
-            cursor.execute(query, (lock_id,))
+            cursor.execute(query, (lock_id, token,))
     except:
         current_app.logger.exception(f'Could not release post import lock {lock_id}')
 
-def clear_lock_table():
-    query = 'DELETE FROM post_import_lock'
+def release_held_locks():
+    with held_locks_lock:
+        locks = [lock for thread_locks in held_locks.values() for lock in thread_locks]
+        held_locks.clear()
+    if len(locks) == 0:
+        return
+    query = 'DELETE FROM post_import_lock l USING unnest(%s::int[], %s::varchar[]) held (id, token) WHERE l.id = held.id AND l.token = held.token'
+    with get_cursor() as cursor:
+        cursor.execute(query, ([lock_id for (lock_id, _) in locks], [token for (_, token) in locks],))
+
+def refresh_locks(thread_id):
+    with held_locks_lock:
+        locks = list(held_locks.get(thread_id, ()))
+    if len(locks) == 0:
+        return
+    query = """
+        UPDATE post_import_lock l
+        SET taken_at = (now() at time zone 'utc')
+        FROM unnest(%s::int[], %s::varchar[]) held (id, token)
+        WHERE l.id = held.id AND l.token = held.token
+    """
     with get_cursor() as cursor:
-        cursor.execute(query)
+        cursor.execute(query, ([lock_id for (lock_id, _) in locks], [token for (_, token) in locks],))
@@ -3,20 +3,52 @@ import logging
 import requests
 import io
 import os
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 
 from flask import current_app
 
 from .utils import get_config
 
+# boto3 clients are thread-safe but expensive to build (credential lookup,
+# endpoint resolution, a fresh connection pool), so each process builds one
+# and shares it between threads. The pid check keeps a forked worker from
+# reusing its parent's sockets.
+client_lock = Lock()
+client_cache = {}
+
 def get_client():
-    session = boto3.session.Session()
-    return session.client(
-        service_name = 's3',
-        region_name = get_config('S3_REGION_NAME'),
-        use_ssl = get_config('S3_USE_SSL'),
-        endpoint_url = get_config('S3_ENDPOINT_URL'),
-        aws_access_key_id = get_config('S3_AWS_ACCESS_KEY_ID'),
-        aws_secret_access_key = get_config('S3_AWS_SECRET_ACCESS_KEY')
+    pid = os.getpid()
+    client = client_cache.get(pid)
+    if client is not None:
+        return client
+
+    with client_lock:
+        if pid not in client_cache:
+            client_cache.clear()
+            session = boto3.session.Session()
+            client_cache[pid] = session.client(
+                service_name = 's3',
+                region_name = get_config('S3_REGION_NAME'),
+                use_ssl = get_config('S3_USE_SSL'),
+                endpoint_url = get_config('S3_ENDPOINT_URL'),
+                aws_access_key_id = get_config('S3_AWS_ACCESS_KEY_ID'),
+                aws_secret_access_key = get_config('S3_AWS_SECRET_ACCESS_KEY'),
+                config = Config(
+                    max_pool_connections = get_config('S3_MAX_POOL_CONNECTIONS', 50),
+                    retries = { 'max_attempts': get_config('S3_MAX_ATTEMPTS', 5), 'mode': 'standard' }
+                )
+            )
+        return client_cache[pid]
+
+def get_transfer_config():
+    return TransferConfig(
+        multipart_threshold = get_config('S3_MULTIPART_THRESHOLD', 64 * 1024 * 1024),
+        multipart_chunksize = get_config('S3_MULTIPART_CHUNKSIZE', 16 * 1024 * 1024),
+        max_concurrency = get_config('S3_MAX_CONCURRENCY', 10),
+        use_threads = True
     )
 
 def upload_file_bytes(name, file_bytes, mime_type = 'binary/octet-stream', public = False):
@@ -44,7 +76,7 @@ def upload_file_object(name, file_object, mime_type = 'binary/octet-stream', pub
             extra_args['ACL'] = 'public-read'
 
         client = get_client()
-        client.upload_fileobj(file_object, get_config('S3_BUCKET_NAME'), name, ExtraArgs = extra_args)
+        client.upload_fileobj(file_object, get_config('S3_BUCKET_NAME'), name, ExtraArgs = extra_args, Config = get_transfer_config())
     except:
         current_app.logger.exception(f'Error uploading file {name}')
         raise
@@ -56,3 +88,48 @@ def delete_file(name, bucket_name):
     except:
         current_app.logger.exception(f'Error deleting file {name}')
         raise
+
+# Deletes (bucket_name, path) pairs with DeleteObjects, up to 1000 keys per
+# request, running several requests at once. Returns the pairs that could
+# not be deleted. `on_progress(done, total)` is called after every batch.
+def delete_files(objects, on_progress = None):
+    paths_by_bucket = {}
+    for (bucket_name, path) in objects:
+        if path is not None:
+            paths_by_bucket.setdefault(bucket_name, set()).add(path)
+
+    batches = []
+    for (bucket_name, paths) in paths_by_bucket.items():
+        paths = sorted(paths)
+        for i in range(0, len(paths), 1000):
+            batches.append((bucket_name, paths[i:i + 1000]))
+
+    total = sum(len(paths) for (_, paths) in batches)
+    done = 0
+    failed = []
+    client = get_client()
+    with ThreadPoolExecutor(max_workers = get_config('S3_DELETE_CONCURRENCY', 4)) as executor:
+        futures = [executor.submit(delete_file_batch, client, bucket_name, paths) for (bucket_name, paths) in batches]
+        for future in as_completed(futures):
+            batch_failed = future.result()
+            failed.extend(batch_failed)
+            done += len(batches[futures.index(future)][1])
+            if on_progress is not None:
+                on_progress(done, total)
+    return failed
+
+def delete_file_batch(client, bucket_name, paths):
+    if bucket_name is None:
+        return [(bucket_name, path) for path in paths]
+    try:
+        response = client.delete_objects(
+            Bucket = bucket_name,
+            Delete = { 'Objects': [{ 'Key': path } for path in paths], 'Quiet': True }
+        )
+        errors = response.get('Errors', [])
+        if len(errors) > 0:
+            current_app.logger.warning(f'Failed to delete {len(errors)} objects from {bucket_name}: {[(error["Key"], error.get("Code")) for error in errors[:10]]}')
+        return [(bucket_name, error['Key']) for error in errors]
+    except Exception:
+        current_app.logger.exception(f'Error deleting {len(paths)} objects from {bucket_name}: {paths[:10]}')
+        return [(bucket_name, path) for path in paths]
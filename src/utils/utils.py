@@ -6,6 +6,7 @@ import re
 import urllib
 import random
 import hashlib
+import base64
 import io
 import os
 import magic
@@ -174,6 +175,8 @@ def make_template(template, status = 200, headers = {}):
     g.data['base'] = merge_dicts(g.data['base'], request.view_args)
     if 'page' in g.data['base']:
         g.data['base'].pop('page')
+    if 'cursor' in g.data['base']:
+        g.data['base'].pop('cursor')
 
     response = make_response(render_template(
         template,
@@ -189,11 +192,13 @@ def get_request_ip():
 
 def get_file_metadata(file_path):
     with open(file_path, 'rb') as f:
-        first_bytes = f.read(2048)
-        mime_type = magic.from_buffer(first_bytes, mime = True)
-        extension = mimetypes.guess_extension(mime_type, strict = False) or '.txt'
-        if extension == '.jpe':
-            extension = '.jpeg'
+        return get_metadata_from_first_bytes(f.read(2048))
+
+def get_metadata_from_first_bytes(first_bytes):
+    mime_type = magic.from_buffer(first_bytes, mime = True)
+    extension = mimetypes.guess_extension(mime_type, strict = False) or '.txt'
+    if extension == '.jpe':
+        extension = '.jpeg'
 
     return (mime_type, extension)
 
@@ -211,9 +216,40 @@ def is_image_file(file):
 def has_preview(file):
     return get_value(file, 'preview_path') is not None
 
-def make_background_image(path, bucket_name):
+# Post thumbnails and previews can have smaller variants stored next to the
+# JPEG as `{path}.{format}`; the formats a row has are listed in its
+# `thumbnail_formats`/`preview_formats` column. Ordered by preference.
+VARIANT_MIME_TYPES = {
+    'avif': 'image/avif',
+    'webp': 'image/webp'
+}
+
+def get_variant_path(path, format):
+    return f'{path}.{format}'
+
+def get_variant_objects(bucket_name, path, formats):
+    if path is None:
+        return []
+    return [(bucket_name, path)] + [(bucket_name, get_variant_path(path, format)) for format in formats or []]
+
+def get_picture_sources(path, bucket_name, formats):
+    formats = formats or []
+    return [
+        (cdn(get_variant_path(path, format), bucket_name), mime_type)
+        for (format, mime_type) in VARIANT_MIME_TYPES.items()
+        if format in formats
+    ]
+
+def make_background_image(path, bucket_name, formats = None):
     if path is not None:
-        return f'background-image: url(\'{cdn(path, bucket_name)}\');'
+        style = f'background-image: url(\'{cdn(path, bucket_name)}\');'
+        sources = get_picture_sources(path, bucket_name, formats)
+        if len(sources) > 0:
+            # Browsers without image-set() type() support drop this
+            # declaration and keep the plain JPEG above.
+            image_set = ', '.join(f'url(\'{url}\') type(\'{mime_type}\')' for (url, mime_type) in sources)
+            style += f' background-image: image-set({image_set}, url(\'{cdn(path, bucket_name)}\') type(\'image/jpeg\'));'
+        return style
     return ''
 
 def pluralify_word(number, word):
@@ -246,6 +282,40 @@ def get_offset_from_url_query(limit = 25):
         page = 1
     return page_to_offset(page, limit)
 
+# Keyset pagination: the "next" link carries an opaque cursor made from the
+# sort columns of the last row on the page, so deep pages seek straight to
+# their rows instead of walking past OFFSET rows. Page numbers keep working
+# for every other link.
+def get_page_cursor_from_url_query():
+    return request.args.get('cursor') or None
+
+def encode_page_cursor(*values):
+    if any(value is None for value in values):
+        return None
+    data = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(data).encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_page_cursor(page_cursor, length):
+    if page_cursor is None:
+        return None
+    try:
+        data = json.loads(base64.urlsafe_b64decode(page_cursor + '=' * (-len(page_cursor) % 4)))
+        if type(data) is not list or len(data) != length:
+            return None
+        return tuple(datetime.fromisoformat(value) if isinstance(value, str) else value for value in data)
+    except Exception:
+        return None
+
+def get_next_page_cursor(rows, *columns, limit = 25):
+    if len(rows) < limit:
+        return None
+    return encode_page_cursor(*[rows[-1][column] for column in columns])
+
+def get_keyset_condition(columns, sort_direction = 'desc'):
+    operator = '<' if sort_direction == 'desc' else '>'
+    placeholders = ', '.join(['%s'] * len(columns))
+    return f"({', '.join(columns)}) {operator} ({placeholders})"
+
 def do_with_retries(func, attempts, *args, **kwargs):
     sleep_time = kwargs.get('sleep', 10)
     try:
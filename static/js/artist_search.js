@@ -0,0 +1,29 @@
+var autocomplete_timeout = null;
+
+function update_search_suggestions(prefix) {
+    fetch(`/api/artists/autocomplete?q=${encodeURIComponent(prefix)}`).then(res => {
+        if (!res.ok) {
+            return [];
+        }
+        return res.json();
+    }).then(results => {
+        var list = document.getElementById('search-suggestions');
+        list.innerHTML = '';
+        results.forEach(artist => {
+            var option = document.createElement('option');
+            option.value = artist.name;
+            list.appendChild(option);
+        });
+    });
+}
+
+document.getElementById('search').addEventListener('input', function (event) {
+    clearTimeout(autocomplete_timeout);
+    var prefix = event.target.value.trim();
+    if (prefix.length < 2) {
+        return;
+    }
+    autocomplete_timeout = setTimeout(function () {
+        update_search_suggestions(prefix);
+    }, 200);
+});